@@ -1,4 +1,5 @@
 import argparse
+import collections
 import time
 from pathlib import Path
 
@@ -13,8 +14,11 @@ from models.experimental import attempt_load
 from utils.datasets import LoadStreams, LoadImages
 from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
     scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path, save_one_box
+from utils.pipeline import Pipeline
 from utils.plots import colors, plot_one_box
+from utils.roi import RoiDetector, TiledDetector
 from utils.torch_utils import select_device, load_classifier, time_synchronized
+from utils.tracker import Tracker
 
 
 def detect(opt):
@@ -26,6 +30,8 @@ def detect(opt):
     # Directories
     save_dir = increment_path(Path(opt.project) / opt.name, exist_ok=opt.exist_ok)  # increment run
     (save_dir / 'labels' if (save_txt or save_txt_tidl) else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
+    if opt.track:
+        (save_dir / 'tracks').mkdir(parents=True, exist_ok=True)
 
     # Initialize
     set_logging()
@@ -52,86 +58,182 @@ def detect(opt):
         modelc.load_state_dict(torch.load('weights/resnet101.pt', map_location=device)['model']).to(device).eval()
 
     # Set Dataloader
-    vid_path, vid_writer = None, None
+    vid_path, vid_writer, seen = None, None, 0
     if webcam:
         view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, buffers=opt.queue_size + 2, max_lag=opt.max_lag)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride)
+        # batch tensors in flight: up to queue-size queued for preprocess, one in preprocess, one being filled
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, verbose=False, batch_size=opt.batch_size,
+                             buffers=opt.queue_size + 2, pin_memory=device.type != 'cpu')
 
-    # Run inference
-    if device.type != 'cpu':
-        model(torch.zeros(1, 3, imgsz[0], imgsz[1]).to(device).type_as(next(model.parameters())))  # run once
-    t0 = time.time()
-    for path, img, im0s, vid_cap in dataset:
-        img = torch.from_numpy(img).to(device)
+    # Pipeline stages, each batch a dict carried down the queues with per-image lists. The reader runs ahead of the
+    # later stages, so its position (frame, mode, progress string) is captured with the batch instead of read back
+    # from the dataset. Grad mode is thread-local, so the torch stages disable it themselves
+    def frames():  # decode + letterbox
+        for path, img, im0s, _ in dataset:
+            if webcam or opt.batch_size > 1:
+                info = dataset.info  # per image of the batch
+            else:
+                path, im0s = [path], [im0s]
+                info = [(dataset.mode, getattr(dataset, 'frame', 0), dataset.s, getattr(dataset, 'fps', 0))]
+            mode, frame, s, fps = zip(*info)
+            source = dataset.indices if webcam else path  # per-source state key, streams may repeat a URL
+            yield {'path': path, 'img': img, 'im0s': im0s, 'mode': mode, 'frame': frame, 's': s, 'fps': fps,
+                   'source': source}
+
+    # Trackers per video path or stream index. Keyframes are scheduled here, ahead of the tracker updates in
+    # postprocess, so frames already queued do not trigger keyframes twice; the model only runs on batches with a
+    # keyframe
+    nkpt = model.model[-1].nkpt if kpt_label else 0
+    trackers = collections.defaultdict(lambda: Tracker(nkpt, opt.keyframe_interval, opt.track_conf))
+
+    @torch.no_grad()
+    def preprocess(f):
+        f['shape'], f['run'] = f['img'].shape[-2:], list(range(len(f['path'])))  # images the model runs on
+        if opt.track:
+            f['key'] = [trackers[k].schedule() for k in f['source']]
+            f['run'] = [i for i, key in enumerate(f['key']) if key]
+            if not f['run']:
+                f['img'] = None
+                return f
+            if f['img'].ndim == 4:
+                f['img'] = f['img'][f['run']]  # keyframes of the batch only
+        img = torch.as_tensor(f['img']).to(device)  # uint8 batch tensor is copied out before its buffer is reused
         img = img.half() if half else img.float()  # uint8 to fp16/32
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
         if img.ndimension() == 3:
             img = img.unsqueeze(0)
+        f['img'] = img
+        return f
 
-        # Inference
+    # ROI inference: the model runs on native resolution crops around the previous frame's detections of a video or
+    # stream, or around those of the img_size pass on images, new sources, lost objects and every roi-refresh frames
+    roi = RoiDetector(model, check_img_size(opt.roi, s=stride), max_batch=opt.roi_batch, conf_thres=opt.conf_thres,
+                      iou_thres=opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                      nms=opt.nms) if opt.roi else None
+    rois = {}  # video path or stream index: ROI boxes from the last frame, frames since the last img_size pass
+
+    # Tiled inference: overlapping native resolution tiles replace the img_size pass, for frames too large to downscale
+    assert not (opt.roi and opt.tile), '--roi and --tile are exclusive'
+    tiler = TiledDetector(model, check_img_size(opt.tile, s=stride), opt.tile_overlap, opt.tile_batch,
+                          conf_thres=opt.conf_thres, iou_thres=opt.iou_thres, classes=opt.classes,
+                          agnostic=opt.agnostic_nms, nms=opt.nms) if opt.tile else None
+
+    @torch.no_grad()
+    def inference(f):
         t1 = time_synchronized()
-        pred = model(img, augment=opt.augment)[0]
-        print(pred[...,4].max())
-        # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms, kpt_label=kpt_label)
-        t2 = time_synchronized()
-
-        # Apply Classifier
-        if classify:
-            pred = apply_classifier(pred, modelc, img, im0s)
-
-        # Process detections
-        for i, det in enumerate(pred):  # detections per image
-            if webcam:  # batch_size >= 1
-                p, s, im0, frame = path[i], '%g: ' % i, im0s[i].copy(), dataset.count
-            else:
-                p, s, im0, frame = path, '', im0s.copy(), getattr(dataset, 'frame', 0)
+        if f['img'] is None:
+            f['pred'] = None
+        elif tiler is not None:
+            f['pred'] = tiler([f['im0s'][i] for i in f['run']])
+        elif roi is None:
+            f['pred'] = model(f['img'], augment=opt.augment)[0]
+        else:
+            keys, im0s = [f['source'][i] for i in f['run']], [f['im0s'][i] for i in f['run']]
+            boxes = [rois[k][0] if k in rois and rois[k][1] < opt.roi_refresh else None for k in keys]
+            full = [j for j, b in enumerate(boxes) if b is None]
+            if full:  # img_size pass
+                pred = non_max_suppression(model(f['img'][full], augment=opt.augment)[0], opt.conf_thres,
+                                           opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                                           kpt_label=kpt_label, nms=opt.nms)
+                for j, det in zip(full, pred):
+                    boxes[j] = scale_coords(f['shape'], det[:, :4], im0s[j].shape).cpu()
+            f['pred'] = roi(im0s, boxes)
+            for j, (k, det) in enumerate(zip(keys, f['pred'])):
+                if len(det) and f['mode'][f['run'][j]] != 'image':
+                    rois[k] = det[:, :4], 0 if j in full else rois[k][1] + 1
+                else:
+                    rois.pop(k, None)  # lost, look at the whole frame again
+        f['dt'] = time_synchronized() - t1
+        return f
+
+    @torch.no_grad()
+    def postprocess(f):
+        t1 = time_synchronized()
+        pred, img = f.pop('pred'), f.pop('img')
+        if pred is not None and roi is None and tiler is None:  # ROI and tile detections are merged and rescaled
+            # Apply NMS
+            pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes,
+                                       agnostic=opt.agnostic_nms, kpt_label=kpt_label, nms=opt.nms)
+
+            # Apply Classifier
+            im0s, shape = [f['im0s'][i] for i in f['run']], f['shape']
+            if classify:
+                pred = apply_classifier(pred, modelc, img, im0s)
+
+            # Rescale boxes and keypoints from img_size to im0 size
+            for i, det in enumerate(pred):
+                if len(det):
+                    scale_coords(shape, det[:, :4], im0s[i].shape, kpt_label=False)
+                    scale_coords(shape, det[:, 6:], im0s[i].shape, kpt_label=kpt_label, step=3)
+            pred = [det.cpu() for det in pred]
+
+        # Track: associate keyframe detections, propagate tracks in between
+        if opt.track:
+            pred = dict(zip(f['run'], pred or []))
+            pred, f['ids'] = zip(*[trackers[k].update(pred[i]) if f['key'][i] else trackers[k].predict()
+                                   for i, k in enumerate(f['source'])])
+        f['pred'] = pred
+        f['dt'] += time_synchronized() - t1
+        return f
+
+    def draw(f):  # draw, save and encode, on the main thread for cv2.imshow
+        nonlocal vid_path, vid_writer, seen
+        shape = f['shape']
+        seen += len(f['pred'])
+        for i, det in enumerate(f['pred']):  # detections per image
+            p, s, im0, frame = f['path'][i], f['s'][i], f['im0s'][i].copy(), f['frame'][i]
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # img.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # img.txt
-            s += '%gx%g ' % img.shape[2:]  # print string
+            txt_path = str(save_dir / 'labels' / p.stem) + ('' if f['mode'][i] == 'image' else f'_{frame}')  # img.txt
+            s += '%gx%g ' % shape  # print string
+            if opt.track:
+                s += 'keyframe ' if f['key'][i] else 'tracked '
             gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
             if len(det):
-                # Rescale boxes from img_size to im0 size
-                scale_coords(img.shape[2:], det[:, :4], im0.shape, kpt_label=False)
-                print(det.shape)
-                scale_coords(img.shape[2:], det[:, 6:], im0.shape, kpt_label=kpt_label, step=3)
-
                 # Print results
                 for c in det[:, 5].unique():
                     n = (det[:, 5] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
                 # Write results
-                for det_index, (*xyxy, conf, cls) in enumerate(reversed(det[:,:6])):
+                for det_index in reversed(range(len(det))):
+                    *xyxy, conf, cls = det[det_index, :6]
                     if save_txt:  # Write to file
                         xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
                         line = (cls, *xywh, conf) if opt.save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                        with open(txt_path + '.txt', 'a') as file:
+                            file.write(('%g ' * len(line)).rstrip() % line + '\n')
 
                     if save_img or opt.save_crop or view_img:  # Add bbox to image
                         c = int(cls)  # integer class
                         label = None if opt.hide_labels else (names[c] if opt.hide_conf else f'{names[c]} {conf:.2f}')
+                        if opt.track and not opt.hide_labels:
+                            label = f"{int(f['ids'][i][det_index])} {label}"  # track id
                         kpts = det[det_index, 6:]
                         plot_one_box(xyxy, im0, label=label, color=colors(c, True), line_thickness=opt.line_thickness, kpt_label=kpt_label, kpts=kpts, steps=3, orig_shape=im0.shape[:2])
                         if opt.save_crop:
-                            save_one_box(xyxy, im0s, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+                            save_one_box(xyxy, f['im0s'][i], file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+
 
+                if opt.track:  # trajectories: frame, track id, keyframe, class, conf, xyxy, keypoints (pixels)
+                    stem = f"{p.stem}_{f['source'][i]}" if webcam else p.stem  # one file per stream
+                    with open(save_dir / 'tracks' / f'{stem}.txt', 'a') as file:
+                        for k, d in zip(f['ids'][i].tolist(), det.tolist()):
+                            file.write(('%g ' * (len(d) + 3)).rstrip() % (frame, k, f['key'][i], d[5], d[4], *d[:4], *d[6:]) + '\n')
 
                 if save_txt_tidl:  # Write to file in tidl dump format
                     for *xyxy, conf, cls in det_tidl:
                         xyxy = torch.tensor(xyxy).view(-1).tolist()
                         line = (conf, cls,  *xyxy) if opt.save_conf else (cls, *xyxy)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                        with open(txt_path + '.txt', 'a') as file:
+                            file.write(('%g ' * len(line)).rstrip() % line + '\n')
 
             # Print time (inference + NMS)
-            print(f'{s}Done. ({t2 - t1:.3f}s)')
+            print(f'{s}Done. ({f["dt"]:.3f}s)')
 
             # Stream results
             if view_img:
@@ -140,23 +242,33 @@ def detect(opt):
 
             # Save results (image with detections)
             if save_img:
-                if dataset.mode == 'image':
+                if f['mode'][i] == 'image':
                     cv2.imwrite(save_path, im0)
                 else:  # 'video' or 'stream'
                     if vid_path != save_path:  # new video
                         vid_path = save_path
                         if isinstance(vid_writer, cv2.VideoWriter):
                             vid_writer.release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
+                        fps, w, h = f['fps'][i], im0.shape[1], im0.shape[0]  # fps read with the frame
+                        if f['mode'][i] == 'stream':
                             save_path += '.mp4'
                         vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
                     vid_writer.write(im0)
 
+    # Run inference
+    if device.type != 'cpu':
+        model(torch.zeros(1, 3, imgsz[0], imgsz[1]).to(device).type_as(next(model.parameters())))  # run once
+    t0 = time.time()
+    pipeline = Pipeline(frames(), [('preprocess', preprocess), ('inference', inference),
+                                   ('postprocess', postprocess), ('draw/encode', draw)], maxsize=opt.queue_size).run()
+    if isinstance(vid_writer, cv2.VideoWriter):
+        vid_writer.release()  # flush the last video
+    print(f'\n{pipeline.summary()}\n{seen} images at {seen / max(pipeline.t, 1E-9):.1f} FPS')
+    if webcam:
+        print(dataset.summary())
+    if roi or tiler:
+        print((roi or tiler).summary())
+
     if save_txt or save_txt_tidl or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt or save_txt_tidl else ''
         print(f"Results saved to {save_dir}{s}")
@@ -181,6 +293,7 @@ if __name__ == '__main__':
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --class 0, or --class 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--nms', default='iou', choices=['iou', 'oks', 'soft-gaussian', 'soft-linear'], help='NMS mode')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
     parser.add_argument('--update', action='store_true', help='update all models')
     parser.add_argument('--project', default='runs/detect', help='save results to project/name')
@@ -190,6 +303,18 @@ if __name__ == '__main__':
     parser.add_argument('--hide-labels', default=False, action='store_true', help='hide labels')
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
     parser.add_argument('--kpt-label', action='store_true', help='use keypoint labels')
+    parser.add_argument('--batch-size', type=int, default=1, help='frames per inference batch for images and videos')
+    parser.add_argument('--max-lag', type=float, default=0., help='drop stream frames older than this (s), 0 for no limit')
+    parser.add_argument('--track', action='store_true', help='track objects, running the model on keyframes only')
+    parser.add_argument('--keyframe-interval', type=int, default=5, help='frames per model run when tracking')
+    parser.add_argument('--track-conf', type=float, default=0.3, help='track confidence forcing an earlier keyframe')
+    parser.add_argument('--roi', type=int, default=0, help='ROI inference on crops of this size (pixels), 0 for off')
+    parser.add_argument('--roi-refresh', type=int, default=10, help='frames between img-size passes for new ROIs')
+    parser.add_argument('--roi-batch', type=int, default=16, help='max ROI crops per inference batch')
+    parser.add_argument('--tile', type=int, default=0, help='tiled inference on tiles of this size (pixels), 0 for off')
+    parser.add_argument('--tile-overlap', type=float, default=0.2, help='tile overlap, fraction of the tile size')
+    parser.add_argument('--tile-batch', type=int, default=0, help='tiles per inference batch, 0 to fit free memory')
+    parser.add_argument('--queue-size', type=int, default=4, help='frames queued between pipeline stages, 0 for sequential')
     opt = parser.parse_args()
     print(opt)
     check_requirements(exclude=('tensorboard', 'pycocotools', 'thop'))
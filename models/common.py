@@ -12,9 +12,10 @@ import torch.nn as nn
 from PIL import Image
 from torch.cuda import amp
 
-from utils.datasets import letterbox
 from utils.general import non_max_suppression, non_max_suppression_export, make_divisible, scale_coords, increment_path, xyxy2xywh, save_one_box
 from utils.plots import colors, plot_one_box
+from utils.preprocess import letterbox_into
+from utils.roi import RoiDetector
 from utils.torch_utils import time_synchronized
 
 from torchvision import models
@@ -402,7 +403,7 @@ class autoShape(nn.Module):
         return self
 
     @torch.no_grad()
-    def forward(self, imgs, size=640, augment=False, profile=False):
+    def forward(self, imgs, size=640, augment=False, profile=False, roi=0):
         # Inference from various sources. For height=640, width=1280, RGB images example inputs are:
         #   filename:   imgs = 'data/images/zidane.jpg'
         #   URI:             = 'https://github.com/ultralytics/yolov5/releases/download/v1.0/zidane.jpg'
@@ -411,6 +412,7 @@ class autoShape(nn.Module):
         #   numpy:           = np.zeros((640,1280,3))  # HWC
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
+        # roi > 0 runs a second pass on roi x roi native resolution crops around the detections of the size pass
 
         t = [time_synchronized()]
         p = next(self.model.parameters())  # for device and type
@@ -437,9 +439,9 @@ class autoShape(nn.Module):
             shape1.append([y * g for y in s])
             imgs[i] = im if im.data.contiguous else np.ascontiguousarray(im)  # update
         shape1 = [make_divisible(x, int(self.stride.max())) for x in np.stack(shape1, 0).max(0)]  # inference shape
-        x = [letterbox(im, new_shape=shape1, auto=False)[0] for im in imgs]  # pad
-        x = np.stack(x, 0) if n > 1 else x[0][None]  # stack
-        x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
+        x = np.empty((n, 3, *shape1), dtype=np.result_type(*imgs))  # BCHW batch, uint8 unless given float images
+        for i, im in enumerate(imgs):
+            letterbox_into(im, x[i], new_shape=shape1, bgr2rgb=False)  # pad, HWC to CHW
         x = torch.from_numpy(x).to(p.device).type_as(p) / 255.  # uint8 to fp16/32
         t.append(time_synchronized())
 
@@ -449,9 +451,16 @@ class autoShape(nn.Module):
             t.append(time_synchronized())
 
             # Post-process
-            y = non_max_suppression(y, conf_thres=self.conf, iou_thres=self.iou, classes=self.classes)  # NMS
+            nkpt = self.model.model[-1].nkpt or 0  # keypoints of pose models
+            y = non_max_suppression(y, conf_thres=self.conf, iou_thres=self.iou, classes=self.classes,
+                                    kpt_label=nkpt > 0, nkpt=nkpt)  # NMS
             for i in range(n):
                 scale_coords(shape1, y[i][:, :4], shape0[i])
+                scale_coords(shape1, y[i][:, 6:], shape0[i], kpt_label=nkpt > 0, step=3)
+            if roi:  # ROI pass, images are RGB
+                y = RoiDetector(self.model, make_divisible(roi, int(self.stride.max())), conf_thres=self.conf,
+                                iou_thres=self.iou, classes=self.classes)(imgs, [d[:, :4].cpu() for d in y], False)
+                y = [d.to(p.device) for d in y]
 
             t.append(time_synchronized())
             return Detections(imgs, y, files, t, self.names, x.shape)
@@ -462,7 +471,8 @@ class Detections:
     def __init__(self, imgs, pred, files, times=None, names=None, shape=None):
         super(Detections, self).__init__()
         d = pred[0].device  # device
-        gn = [torch.tensor([*[im.shape[i] for i in [1, 0, 1, 0]], 1., 1.], device=d) for im in imgs]  # normalizations
+        gn = [torch.tensor([*[im.shape[i] for i in [1, 0, 1, 0]], 1., 1.] + [im.shape[1], im.shape[0], 1.] *
+                           ((x.shape[1] - 6) // 3), device=d) for im, x in zip(imgs, pred)]  # normalizations (+kpts)
         self.imgs = imgs  # list of images as numpy arrays
         self.pred = pred  # list of tensors pred[0] = (xyxy, conf, cls)
         self.names = names  # class names
@@ -479,11 +489,11 @@ class Detections:
         for i, (im, pred) in enumerate(zip(self.imgs, self.pred)):
             str = f'image {i + 1}/{len(self.pred)}: {im.shape[0]}x{im.shape[1]} '
             if pred is not None:
-                for c in pred[:, -1].unique():
-                    n = (pred[:, -1] == c).sum()  # detections per class
+                for c in pred[:, 5].unique():
+                    n = (pred[:, 5] == c).sum()  # detections per class
                     str += f"{n} {self.names[int(c)]}{'s' * (n > 1)}, "  # add to string
                 if show or save or render or crop:
-                    for *box, conf, cls in pred:  # xyxy, confidence, class
+                    for *box, conf, cls in pred[:, :6]:  # xyxy, confidence, class
                         label = f'{self.names[int(cls)]} {conf:.2f}'
                         if crop:
                             save_one_box(box, im, file=save_dir / 'crops' / self.names[int(cls)] / self.files[i])
@@ -616,6 +626,21 @@ class FusionEncoder(nn.Module):
         return self.conv(x)
 
 
+def fuse_inject(m):
+    # Fold h_sigmoid into the BN-fused global_act conv of an (Weighted)Inject m and drop its unused convs,
+    # returns 1 if changed
+    if type(m.act) is not h_sigmoid or hasattr(m.global_act, 'bn'):
+        return 0
+    conv = m.global_act.conv  # relu6(wx + b + 3) / 6 = hardtanh(wx / 6 + (b + 3) / 6, 0, 1)
+    conv.weight = nn.Parameter(conv.weight.detach() / 6)
+    conv.bias = nn.Parameter((conv.bias.detach() + 3) / 6)
+    m.global_act.act, m.act = nn.Hardtanh(0., 1.), nn.Identity()
+    for k in 'conv1', 'conv2', 'global_embedding':
+        if hasattr(m, k):
+            delattr(m, k)
+    return 1
+
+
 # import torch
 class WeightedInject(nn.Module):
     def __init__(
@@ -648,6 +673,15 @@ class WeightedInject(nn.Module):
         out = torch.cat((local_feat , global_inj), dim=1)
         return out
 
+    def fuse(self):
+        return fuse_inject(self)
+
+
+def select_channels(x, indices):
+    # Per-sample channel selection x[b, indices[b]] as a single gather, traceable for ONNX/TorchScript
+    return x.gather(1, indices[:, :, None, None].expand(-1, -1, *x.shape[2:]))
+
+
 class SE_HALF(nn.Module):
     def __init__(self, c1, ratio=16):
         super(SE_HALF, self).__init__()
@@ -667,19 +701,12 @@ class SE_HALF(nn.Module):
         y = self.l2(y)
         y = self.sig(y)
 
-        # Sort channel weights
-        _, indices = torch.sort(y, descending=True)
-
-        # Retrieve the index of the top 50% channels
+        # Sorted index of the top 50% channels
         half_ch = c // 2
-        indices = indices[:, :half_ch]
+        y_half, indices = torch.topk(y, half_ch, 1)
 
         # Rearrange input channels based on sorting and only retain the first half
-        x_sorted_half = x.new_zeros((b, half_ch, h, w))
-        for b_idx in range(x.size(0)):
-            x_sorted_half[b_idx] = x[b_idx, indices[b_idx]]
-
-        y_half = y.gather(1, indices)
+        x_sorted_half = select_channels(x, indices)
 
         y_half = y_half.view(b, half_ch, 1, 1)
 
@@ -696,25 +723,20 @@ class ECA_SORT(nn.Module):
         self.conv = nn.Conv1d(1, 1, kernel_size=k_size, padding=(k_size - 1) // 2, bias=False)
         self.sigmoid = nn.Sigmoid()
 
-    def forward(self, x):
+    def weights(self, x):
         # Calculate channel weights
         y = self.avg_pool(x)
         y = self.conv(y.squeeze(-1).transpose(-1, -2)).transpose(-1, -2).unsqueeze(-1)
-        y = self.sigmoid(y).squeeze(-1).squeeze(-1)  # 将权重调整为一维
+        return self.sigmoid(y).squeeze(-1).squeeze(-1)  # 将权重调整为一维
 
-        # Sort the channel weights
-        _, indices = torch.sort(y, descending=True)
+    def forward(self, x):
+        y = self.weights(x)
 
-        # Retrieve the index of the first c2 channels
-        indices = indices[:, :self.c2]
+        # Sorted index of the first c2 channels
+        _, indices = torch.topk(y, self.c2, 1)
 
         # Rearrange input channels based on sorting and only retain the first c2 channels
-        b, _, h, w = x.size()
-        x_sorted_out = x.new_zeros((b, self.c2, h, w))
-        for b_idx in range(b):
-            x_sorted_out[b_idx] = x[b_idx, indices[b_idx]]
-
-        return x_sorted_out
+        return select_channels(x, indices)
 
 class SE_SORT(nn.Module):
     def __init__(self, c1,c2 ,ratio=16):
@@ -728,26 +750,82 @@ class SE_SORT(nn.Module):
         self.l2 = nn.Linear(c1 // ratio, c1, bias=False)
         self.sig = nn.Sigmoid()
 
-    def forward(self, x):
+    def weights(self, x):
         b, c, h, w = x.size()
         y = self.avgpool(x).view(b, c)
         y = self.l1(y)
         y = self.relu(y)
         y = self.l2(y)
-        y = self.sig(y)
-        # Sort channel weights
-        _, indices = torch.sort(y, descending=True)
-        # Obtain the index of the output channel
+        return self.sig(y)
+
+    def forward(self, x):
+        y = self.weights(x)
+        # Sorted index of the output channels
         out_ch =self.c2
-        indices = indices[:, :out_ch]
+        _, indices = torch.topk(y, out_ch, 1)
         # Rearranges the input channels according to sorting and retains only the top half.
-        x_sorted_out = x.new_zeros((b, out_ch, h, w))
-        for b_idx in range(x.size(0)):
-            x_sorted_out[b_idx] = x[b_idx, indices[b_idx]]
+        x_sorted_out = select_channels(x, indices)
         # y_out = y.gather(1, indices)
         # y_out = y_out.view(b, out_ch, 1, 1)
         return x_sorted_out
+
+
+class ChannelSlice(nn.Module):
+    # Fixed channel selection in ascending channel order, replaces SE_SORT/ECA_SORT for static deployments
+    def __init__(self, index):
+        super(ChannelSlice, self).__init__()
+        self.register_buffer('index', torch.as_tensor(index, dtype=torch.long))
+        i = self.index.tolist()
+        self.slice = slice(i[0], i[-1] + 1) if i == list(range(i[0], i[-1] + 1)) else None  # contiguous channels
+
+    def forward(self, x):
+        return x[:, self.slice] if self.slice else x.index_select(1, self.index)
+
+
+def freeze_selection(m, conv, score):
+    # Replaces the ranking of m (SE_SORT/ECA_SORT) by its top-scored channels and folds the order into conv.
+    # conv input j saw the j-th ranked channel, the kept channels are read in ascending order instead
+    order = score.topk(m.c2)[1]  # channel feeding conv input j, highest score first
+    index, perm = order.sort()
+    conv.conv.weight = nn.Parameter(conv.conv.weight[:, perm.to(conv.conv.weight.device)])
+    return ChannelSlice(index).to(conv.conv.weight.device), conv
+
+
+class Resampled(nn.Module):
+    # Upsampled branch cv(interpolate(x)) computed as act(interpolate(conv(select(x)))). Channel selection and the BN-fused
+    # 1x1 conv are per-pixel affine maps, they commute with bilinear upsampling and run at the lower input resolution
+    def __init__(self, select, conv):
+        super(Resampled, self).__init__()
+        self.select, self.conv, self.act = select, conv.conv, conv.act
+
+    def forward(self, x, size):
+        return self.act(F.interpolate(self.conv(self.select(x)), size=size, mode='bilinear', align_corners=False))
+
+
+def upsample_branch(cv, x, size):
+    # Branch cv applied to x bilinearly upsampled to size
+    if isinstance(cv, Resampled):
+        return cv(x, size)
+    return cv(F.interpolate(x, size=size, mode='bilinear', align_corners=False))
+
+
+def reorder_upsampling(m):
+    # Moves the 1x1 conv of the upsampled branches of m ahead of the upsampling, returns the number of branches.
+    # Dynamic SE_SORT selections are kept, their ranking depends on the upsampled map
+    n = 0
+    for k in getattr(m, 'upsampled', ()):
+        cv = getattr(m, k)
+        if isinstance(cv, nn.Sequential) and len(cv) == 2 and type(cv[0]) in (nn.Identity, ChannelSlice) and \
+                type(cv[1]) is Conv and not hasattr(cv[1], 'bn') and cv[1].conv.kernel_size == (1, 1) and \
+                cv[1].conv.stride == (1, 1):
+            setattr(m, k, Resampled(cv[0], cv[1]))
+            n += 1
+    return n
+
+
 class ChannelSelection_Top(nn.Module):
+    upsampled = ('cv2', 'cv3')  # branches fed by bilinear upsampling, reordered by reorder_upsampling()
+
     def __init__(self, in_channel_list, out_channels):
         super().__init__()
         out_channels_2=int(out_channels/3)
@@ -775,12 +853,14 @@ class ChannelSelection_Top(nn.Module):
             self.downsample = onnx_AdaptiveAvgPool2d
             output_size = np.array([H, W])
         x_l = self.cv0(self.downsample(x[0], output_size))
-        x_s =self.cv2(F.interpolate(x[2], size=(H, W), mode='bilinear', align_corners=False))
-        x_n = self.cv3(F.interpolate(x[3], size=(H, W), mode='bilinear', align_corners=False))
+        x_s =upsample_branch(self.cv2, x[2], (H, W))
+        x_n = upsample_branch(self.cv3, x[3], (H, W))
         out = torch.cat([x_l,x_s,x_n], 1)
         return out
 
 class ChannelSelection_Medium(nn.Module):
+    upsampled = ('cv3',)  # branches fed by bilinear upsampling, reordered by reorder_upsampling()
+
     def __init__(self, in_channel_list, out_channels):
         super().__init__()
         out_channels_2 = int(out_channels /3)
@@ -813,7 +893,7 @@ class ChannelSelection_Medium(nn.Module):
         #
         x_l = self.cv0(self.downsample(x[0], output_size))
         x_m = self.cv1(self.downsample(x[1], output_size))
-        x_n = self.cv3(F.interpolate(x[3], size=(H, W), mode='bilinear', align_corners=False))
+        x_n = upsample_branch(self.cv3, x[3], (H, W))
         out = torch.cat([x_l, x_m, x_n], 1)
         return out
 
@@ -930,9 +1010,13 @@ class Inject(nn.Module):
         # out = torch.cat((x_l, x_g ), dim=1)
         return out
 
+    def fuse(self):
+        return fuse_inject(self)
 
 
 class Fusion_4in_Top(nn.Module):
+    upsampled = ('cv2', 'cv3')  # branches fed by bilinear upsampling, reordered by reorder_upsampling()
+
     def __init__(self, in_channel_list, out_channels):
         super().__init__()
         out_channels_2=int(out_channels/3)
@@ -976,8 +1060,8 @@ class Fusion_4in_Top(nn.Module):
             self.downsample = onnx_AdaptiveAvgPool2d
             output_size = np.array([H, W])
         x_l = self.cv0(self.downsample(x[0], output_size))
-        x_s =self.cv2(F.interpolate(x[2], size=(H, W), mode='bilinear', align_corners=False))
-        x_n = self.cv3(F.interpolate(x[3], size=(H, W), mode='bilinear', align_corners=False))
+        x_s =upsample_branch(self.cv2, x[2], (H, W))
+        x_n = upsample_branch(self.cv3, x[3], (H, W))
         # x_l = self.downsample(x[0], output_size)
         # x_s = F.interpolate(x[2], size=(H, W), mode='bilinear', align_corners=False)
         # x_n = F.interpolate(x[3], size=(H, W), mode='bilinear', align_corners=False)
@@ -986,6 +1070,8 @@ class Fusion_4in_Top(nn.Module):
         return out
 
 class Fusion_4in_Medium(nn.Module):
+    upsampled = ('cv3',)  # branches fed by bilinear upsampling, reordered by reorder_upsampling()
+
     def __init__(self, in_channel_list, out_channels):
         super().__init__()
         # out_channels_2 = int(out_channels * 0.4)
@@ -1035,7 +1121,7 @@ class Fusion_4in_Medium(nn.Module):
         #
         x_l = self.cv0(self.downsample(x[0], output_size))
         x_m = self.cv1(self.downsample(x[1], output_size))
-        x_n = self.cv3(F.interpolate(x[3], size=(H, W), mode='bilinear', align_corners=False))
+        x_n = upsample_branch(self.cv3, x[3], (H, W))
         # x_l = self.downsample(x[0], output_size)
         # x_m = self.downsample(x[1], output_size)
         # x_n = F.interpolate(x[3], size=(H, W), mode='bilinear', align_corners=False)
@@ -111,7 +111,7 @@ class Ensemble(nn.ModuleList):
 
 
 def attempt_load(weights, map_location=None, inplace=True):
-    from models.yolo import Detect, Model
+    from models.yolo import Detect, Model, liveness
 
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
     model = Ensemble()
@@ -126,6 +126,10 @@ def attempt_load(weights, map_location=None, inplace=True):
             m.inplace = inplace  # pytorch 1.7.0 compatibility
         elif type(m) is Conv:
             m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatibility
+        if type(m) is Model:
+            liveness(m.model)  # checkpoints saved before layer liveness
+        if type(m) is Detect:
+            m.cache = [{} for _ in range(m.nl)]  # checkpoints saved before cached decode tensors
 
     if len(model) == 1:
         return model[-1]  # return model
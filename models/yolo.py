@@ -26,6 +26,7 @@ except ImportError:
 class Detect(nn.Module):
     stride = None  # strides computed during build
     export = False  # onnx export
+    fused = False  # box and keypoint heads fused by fuse()
 
     def __init__(self, nc=80, anchors=(), nkpt=None, ch=(), inplace=True, dw_conv_kpt=False):  # detection layer
         super(Detect, self).__init__()
@@ -39,7 +40,7 @@ class Detect(nn.Module):
 
         self.nl = len(anchors)  # number of detection layers
         self.na = len(anchors[0]) // 2  # number of anchors
-        self.grid = [torch.zeros(1)] * self.nl  # init grid
+        self.cache = [{} for _ in range(self.nl)]  # decode tensors per layer and resolution
         self.flip_test = False
         a = torch.tensor(anchors).float().view(self.nl, -1, 2)
 
@@ -74,48 +75,74 @@ class Detect(nn.Module):
         z = []  # inference output
         self.training |= self.export
         for i in range(self.nl):
-            if self.nkpt is None or self.nkpt==0:
-
-                x[i] = self.m[i](x[i])
-            else:
-                x[i] = torch.cat((self.m[i](x[i]), self.m_kpt[i](x[i])), axis=1)
-
-            bs, _, ny, nx = x[i].shape  # x(bs,81,20,20) to x(bs,3,20,20,27)
-            x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
-            x_det = x[i][..., :6]
-            x_kpt = x[i][..., 6:]
+            x[i] = self._head(i, x[i])  # x(bs,81,20,20) to x(bs,3,20,20,27)
+            bs, _, ny, nx, _ = x[i].shape
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-                kpt_grid_x = self.grid[i][..., 0:1]
-                kpt_grid_y = self.grid[i][..., 1:2]
-
-                if self.nkpt == 0:
-                    y = x[i].sigmoid()
-                else:
-                    y = x_det.sigmoid()
-                if self.inplace:
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i].view(1, self.na, 1, 1, 2) # wh
-                    if self.nkpt != 0:
-                        x_kpt[..., 0::3] = (x_kpt[..., ::3] + kpt_grid_x.repeat(1,1,1,1,7)) * self.stride[i]  # xy
-                        x_kpt[..., 1::3] = (x_kpt[..., 1::3] + kpt_grid_y.repeat(1,1,1,1,7)) * self.stride[i]  # xy
-                        x_kpt[..., 2::3] = x_kpt[..., 2::3]
-
-                    y = torch.cat((xy, wh, y[..., 4:], x_kpt), dim=-1)
-
-                else:  # for YOLOv5 on AWS Inferentia
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                    if self.nkpt != 0:
-                        y[..., 6:] = (y[..., 6:] + self.grid[i].repeat((1,1,1,1,self.nkpt))) * self.stride[i]  # xy
-                    y = torch.cat((xy, wh, y[..., 4:]), -1)
+                xy0, s, wh0, kpt0 = self._decode_grid(i, ny, nx, x[i].device, x[i].dtype)
+                y = x[i][..., :self.no_det].sigmoid()
+                xy = y[..., 0:2] * (2 * s) + xy0  # xy
+                wh = y[..., 2:4] ** 2 * wh0  # wh
+                kpt = x[i][..., self.no_det:]
+                if self.nkpt:
+                    k = kpt.view(bs, self.na, ny, nx, self.nkpt, 3)
+                    if self.inplace:
+                        k[..., :2].mul_(s).add_(kpt0)  # xy, broadcast over keypoints
+                    else:  # for YOLOv5 on AWS Inferentia
+                        kpt = torch.cat((k[..., :2] * s + kpt0, k[..., 2:]), -1).view(bs, self.na, ny, nx, -1)
+                y = torch.cat((xy, wh, y[..., 4:], kpt), -1)
 
                 z.append(y.view(bs, -1, self.no))
 
         return x if self.training else (torch.cat(z, 1), x)
 
+    def _head(self, i, x):
+        # Box and keypoint outputs of layer i, x(bs,c,ny,nx) to (bs,na,ny,nx,no)
+        bs, _, ny, nx = x.shape
+        if not self.nkpt or (self.fused and not self.dw_conv_kpt):  # single conv, box + keypoint after fuse()
+            x = self.m[i](x)
+        elif self.fused and not torch.onnx.is_in_onnx_export():  # both heads written straight into the output
+            y = x.new_empty(bs, self.na, ny, nx, self.no)
+            self._write(y, self.m[i](x), 0)
+            self._write(y, self.m_kpt[i](x), self.na * self.no_det)
+            return y
+        else:
+            x = torch.cat((self.m[i](x), self.m_kpt[i](x)), axis=1)
+        return x.view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
+
+    def _write(self, y, x, c):
+        # Copies conv output channels x(bs,n,ny,nx) into the channels c:c+n of output y(bs,na,ny,nx,no), the layout
+        # of torch.cat() along channels followed by the view and permute in _head()
+        y, n = y.permute(0, 1, 4, 2, 3), x.shape[1]  # (bs,na,no,ny,nx) view
+        for a in range(c // self.no, (c + n - 1) // self.no + 1):  # anchors spanned
+            i0, i1 = max(c, a * self.no), min(c + n, (a + 1) * self.no)
+            y[:, a, i0 - a * self.no:i1 - a * self.no] = x[:, i0 - c:i1 - c]
+
+    def fuse(self):  # merge the box and keypoint heads for inference
+        if self.nkpt and not self.dw_conv_kpt:  # one 1x1 conv per layer
+            for i, (m, mk) in enumerate(zip(self.m, self.m_kpt)):
+                conv = nn.Conv2d(m.in_channels, m.out_channels + mk.out_channels, 1).to(m.weight.device)
+                conv.weight = nn.Parameter(torch.cat((m.weight, mk.weight)).detach())
+                conv.bias = nn.Parameter(torch.cat((m.bias, mk.bias)).detach())
+                self.m[i] = conv
+            del self.m_kpt
+        self.fused = True
+        return self
+
+    def _decode_grid(self, i, ny, nx, device, dtype):
+        # Pre-scaled grid, stride and anchor tensors of layer i, cached per (ny, nx, device, dtype) and rebuilt
+        # when the anchors change, e.g. by autoanchor or EMA updates
+        key, version = (ny, nx, device, dtype), (self.anchor_grid.data_ptr(), self.anchor_grid._version)
+        if self.cache[i].get(key, (None,))[0] != version:
+            s = float(self.stride[i])
+            grid = self._make_grid(nx, ny).to(device, dtype)  # (1, 1, ny, nx, 2)
+            self.cache[i][key] = (version,
+                                  (grid - 0.5) * s,  # box xy offset
+                                  s,  # stride
+                                  (self.anchor_grid[i] * 4).view(1, self.na, 1, 1, 2).to(device, dtype),  # box wh gain
+                                  (grid * s).unsqueeze(-2))  # keypoint xy offset (1, 1, ny, nx, 1, 2)
+        return self.cache[i][key][1:]
+
     @staticmethod
     def _make_grid(nx=20, ny=20):
         yv, xv = torch.meshgrid([torch.arange(ny), torch.arange(nx)])
@@ -191,10 +218,11 @@ class Model(nn.Module):
                 x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
 
             if profile:
-                o = thop.profile(m, inputs=(x,), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPS
+                c = isinstance(x, list)  # copy input lists, Detect() writes into them
+                o = thop.profile(m, inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPS
                 t = time_synchronized()
                 for _ in range(10):
-                    _ = m(x)
+                    _ = m(x.copy() if c else x)
                 dt.append((time_synchronized() - t) * 100)
                 if m == self.model[0]:
                     logger.info(f"{'time (ms)':>10s} {'GFLOPS':>10s} {'params':>10s}  {'module'}")
@@ -202,9 +230,12 @@ class Model(nn.Module):
 
             x = m(x)  # run
             y.append(x if m.i in self.save else None)  # save output
+            for j in m.free:
+                y[j] = None  # release outputs no later layer reads
 
         if profile:
             logger.info('%.1fms total' % sum(dt))
+            self.dt = dt  # ms per layer of the last profiled pass
         return x
 
     def _descale_pred(self, p, flips, scale, img_size):
@@ -253,6 +284,63 @@ class Model(nn.Module):
                 m.conv = fuse_conv_and_bn(m.conv, m.bn)  # update conv
                 delattr(m, 'bn')  # remove batchnorm
                 m.forward = m.fuseforward  # update forward
+            elif type(m) is Detect and not m.fused:
+                m.fuse()  # single box + keypoint head
+        self.info()
+        return self
+
+    def reparameterize(self, img, tol=1E-4):  # inference graph optimizations, verified and profiled on img
+        self.fuse().eval()  # BatchNorm and Detect head
+        with torch.no_grad():
+            logger.info('Reparameterizing layers... ')
+            y0 = self.forward_once(img, profile=True)[0]
+            dt0, changed = self.dt, []
+            for layer in self.model:
+                n = 0
+                for m in list(layer.modules()):
+                    if type(m) in (Inject, WeightedInject):
+                        n += m.fuse()  # h_sigmoid folded into global_act
+                    n += reorder_upsampling(m)  # 1x1 convs ahead of bilinear upsampling
+                if n:
+                    changed.append(layer.i)
+            y1 = self.forward_once(img, profile=True)[0]
+        err = float((y1 - y0).abs().max() / y0.abs().max())  # relative to the largest output
+        assert err < tol, f'reparameterized outputs differ by {err:.3g} > tol={tol}'
+        logger.info(f"{'layer':>6s} {'module':>40s} {'before (ms)':>12s} {'after (ms)':>12s} {'saved (ms)':>12s}")
+        for i in changed:
+            logger.info(f'{i:6d} {self.model[i].type:>40s} {dt0[i]:12.2f} {self.dt[i]:12.2f} {dt0[i] - self.dt[i]:12.2f}')
+        logger.info(f'{len(changed)} layers reparameterized, {sum(dt0) - sum(self.dt):.1f}ms saved in total, '
+                    f'max relative output difference {err:.3g}')
+        return self
+
+    def freeze_channels(self, imgs):  # fix SE_SORT/ECA_SORT selections to the channels they rank top on imgs
+        logger.info('Freezing channel selection... ')
+        sel = [s for s in self.model.modules() if isinstance(s, nn.Sequential) and len(s) > 1 and
+               type(s[0]) in (SE_SORT, ECA_SORT) and type(s[1]) is Conv]
+        counts, weights, n = {}, {}, 0  # per module: times in the per-image top-k, summed weights per channel
+
+        def hook(m, x):
+            y = m.weights(x[0]).float()
+            counts[m] = counts.get(m, 0) + torch.zeros_like(y).scatter_(1, y.topk(m.c2, 1)[1], 1).sum(0)
+            weights[m] = weights.get(m, 0) + y.sum(0)
+
+        hooks = [s[0].register_forward_pre_hook(hook) for s in sel]
+        with torch.no_grad():
+            for x in imgs:
+                self.forward_once(x)
+                n += x.shape[0]
+        for h in hooks:
+            h.remove()
+
+        overlap = []  # mean share of the per-image selections kept by the frozen selection
+        for s in sel:
+            m = s[0]
+            score = counts[m] + weights[m] / (n + 1)  # most selected channels, ties by mean weight
+            overlap.append(float(counts[m][score.topk(m.c2)[1]].sum() / (n * m.c2)))
+            s[0], s[1] = freeze_selection(m, s[1], score)
+        if sel:
+            logger.info(f'{len(sel)} selections frozen on {n} images, {min(overlap):.3f} min and '
+                        f'{sum(overlap) / len(overlap):.3f} mean overlap with the per-image selections')
         self.info()
         return self
 
@@ -362,13 +450,26 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
         if i == 0:
             ch = []
         ch.append(c2)
+    liveness(layers)
     return nn.Sequential(*layers), sorted(save)
 
 
+def liveness(layers):
+    # Attaches m.free to every layer, the saved outputs it reads last. forward_once() drops them after running m
+    last = {}  # last reader per saved output
+    for m in layers:
+        for j in [m.f] if isinstance(m.f, int) else m.f:
+            if j != -1:
+                last[j % m.i] = m.i
+    for m in layers:
+        m.free = [j for j, i in last.items() if i == m.i]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cfg', type=str, default='yolov5s.yaml', help='model.yaml')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--reparam', action='store_true', help='reparameterize for inference and profile the layers')
     opt = parser.parse_args()
     opt.cfg = check_file(opt.cfg)  # check file
     set_logging()
@@ -377,6 +478,8 @@ if __name__ == '__main__':
     # Create model
     model = Model(opt.cfg).to(device)
     model.train()
+    if opt.reparam:
+        model.reparameterize(torch.rand(1, 3, 320, 320).to(device))
 
     # Profile
     # img = torch.rand(8 if torch.cuda.is_available() else 1, 3, 320, 320).to(device)
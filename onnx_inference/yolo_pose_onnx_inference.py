@@ -1,14 +1,27 @@
 import os
+import sys
+import argparse
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import numpy as np
 import cv2
-import argparse
 import onnxruntime
 from tqdm import tqdm
 
+sys.path.append(Path(__file__).parent.parent.absolute().__str__())  # to run '$ python *.py' files in subdirectories
+
+from utils.preprocess import letterbox_into
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--model-path", type=str, default="runs/train/superNB_scale0.3/weights/best.onnx")
 parser.add_argument("--img-path", type=str, default="/data/mousedata_20230422/LL8-3.MPG")
 parser.add_argument("--dst-path", type=str, default="./img_output")
+parser.add_argument("--batch-size", type=int, default=1, help="frames per session run, capped by a static model batch")
+parser.add_argument("--intra-threads", type=int, default=0, help="intra-op threads, 0 for the onnxruntime default")
+parser.add_argument("--inter-threads", type=int, default=1, help="inter-op threads")
+parser.add_argument("--writers", type=int, default=4, help="threads drawing and writing results")
 args = parser.parse_args()
 
 
@@ -42,52 +55,136 @@ pose_kpt_color = palette[[0, 1, 2, 3, 4, 5, 6]]
 radius = 5
 
 
-def read_img(img, img_mean=127.5, img_scale=1/127.5):
-    img = img[:, :, ::-1]
-    img = cv2.resize(img, (320, 320), interpolation=cv2.INTER_LINEAR)
-    img = (img - img_mean) * img_scale
-    img = np.asarray(img, dtype=np.float32)
-    img = np.expand_dims(img, 0)
-    img = img.transpose(0, 3, 1, 2)
-    return img
+def read_img(img, img_mean=127.5, img_scale=1/127.5, out=None):
+    # Stretch resize, BGR to RGB and (x - mean) * scale in one pass, into out (3,h,w) or a new (1,3,320,320) array
+    img_out = np.empty((1, 3, 320, 320), dtype=np.float32) if out is None else out[None]
+    letterbox_into(img, img_out[0], img_out.shape[2:], auto=False, scaleFill=True, mean=img_mean, scale=img_scale)
+    return img_out
+
+
+class InferenceEngine:
+    """
+    ONNX Runtime session created once and reused for every batch, with the input bound to a preallocated buffer.
+    Models exported with --export-nms return one detections output per image of a static batch, so a partial last
+    batch is zero-padded and the extra outputs dropped. Fixed-shape outputs are bound to preallocated buffers too,
+    data-dependent ones (NMS) are allocated by onnxruntime.
+    """
+    def __init__(self, model_path, batch_size=1, intra_threads=0, inter_threads=1):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = intra_threads
+        options.inter_op_num_threads = inter_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=onnxruntime.get_available_providers())
+
+        inp = self.session.get_inputs()[0]
+        static = isinstance(inp.shape[0], int)  # batch fixed at export
+        self.batch_size = inp.shape[0] if static else batch_size
+        if static and batch_size != self.batch_size:
+            print("{} has a static batch of {}, running batches of {}".format(model_path, self.batch_size, self.batch_size))
+        h, w = (d if isinstance(d, int) else 320 for d in inp.shape[2:])
+        self.input = np.zeros((self.batch_size, 3, h, w), dtype=np.float32)
+
+        self.binding = self.session.io_binding()
+        self.input_value = onnxruntime.OrtValue.ortvalue_from_numpy(self.input)  # shares memory with self.input
+        self.binding.bind_ortvalue_input(inp.name, self.input_value)
+        self.outputs = []  # preallocated output buffers, None where onnxruntime allocates
+        for out in self.session.get_outputs():
+            shape = [self.batch_size if d == inp.shape[0] else d for d in out.shape]  # resolve a dynamic batch dim
+            if out.type == 'tensor(float)' and all(isinstance(d, int) for d in shape):
+                buf = np.empty(shape, dtype=np.float32)
+                self.binding.bind_output(out.name, 'cpu', 0, np.float32, shape, buf.ctypes.data)
+                self.outputs.append(buf)
+            else:
+                self.binding.bind_output(out.name, 'cpu')
+                self.outputs.append(None)
+
+    def __call__(self, n=None):
+        # Runs the first n (default all) images of self.input, returns one output list per image
+        n = self.batch_size if n is None else n
+        self.input[n:] = 0  # padding of a partial batch
+        self.session.run_with_iobinding(self.binding)
+        outputs = [y if y is None else y.copy() for y in self.outputs]  # buffers are overwritten by the next run
+        if any(y is None for y in outputs):
+            allocated = self.binding.copy_outputs_to_cpu()
+            outputs = [allocated[i] if y is None else y for i, y in enumerate(outputs)]
+        if outputs[0].ndim == 2:  # --export-nms model, one (n,6+3*nkpt) detections output per image
+            return [[y] for y in outputs[:n]]
+        return [[y[i] for y in outputs] for i in range(n)]
+
+
+@functools.lru_cache()
+def load_engine(model_path, batch_size=1):
+    return InferenceEngine(model_path, batch_size)
 
 
 def model_inference(model_path=None, input=None):
-    #onnx_model = onnx.load(args.model_path)
-    session = onnxruntime.InferenceSession(model_path, None)
-    input_name = session.get_inputs()[0].name
-    output = session.run([], {input_name: input})
-    return output
+    # Single preprocessed image through the session cached per model
+    engine = load_engine(model_path)
+    engine.input[0] = input[0]
+    return engine(1)[0]
+
+
+class AsyncWriter:
+    # Thread pool for drawing and writing results, with at most 2 jobs per thread queued to bound memory
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(max(workers, 1))
+        self.futures = collections.deque()
+        self.limit = 2 * max(workers, 1)
+
+    def submit(self, fn, *a, **k):
+        while len(self.futures) >= self.limit:
+            self.futures.popleft().result()  # also re-raises writer errors
+        self.futures.append(self.pool.submit(fn, *a, **k))
+
+    def close(self):
+        while self.futures:
+            self.futures.popleft().result()
+        self.pool.shutdown()
 
 
-def model_inference_image_list(model_path, img_path=None, mean=None, scale=None, dst_path=None):
-    os.makedirs(args.dst_path, exist_ok=True)
+def read_frames(img_path):
+    # (image, destination file name) pairs from an image list *.txt or a video
     if img_path.endswith("txt"):
-        img_file_list = list(open(img_path))
-        pbar = enumerate(img_file_list)
-        pbar = tqdm(pbar, total=len(img_file_list))
-        for img_index, img_file in pbar:
-            pbar.set_description("{}/{}".format(img_index, len(img_file_list)))
+        for img_file in open(img_path):
             img_file = img_file.rstrip()
-            img = cv2.imread(img_file)
-            input = read_img(img, mean, scale)
-            output = model_inference(model_path, input)
-            dst_file = os.path.join(dst_path, os.path.basename(img_file))
-            post_process(img, dst_file, output[0], score_threshold=0.3)
+            yield cv2.imread(img_file), os.path.basename(img_file)
     elif img_path.endswith("MPG"):
-        img_file_list = cv2.VideoCapture(img_path)
+        cap = cv2.VideoCapture(img_path)
         count = 0
         while True:
-            b, img = img_file_list.read()
+            b, img = cap.read()
             if not b:
                 break
-            # img_file = img_file.rstrip()
-            # img = cv2.imread(img_file)
-            input = read_img(img.copy(), mean, scale)
-            output = model_inference(model_path, input)
-            dst_file = os.path.join(dst_path, os.path.basename(str(count).zfill(6) + '.png'))
-            post_process(img.copy(), dst_file, output[0], score_threshold=0.3)
+            yield img, str(count).zfill(6) + '.png'
             count += 1
+        cap.release()
+
+
+def model_inference_image_list(model_path, img_path=None, mean=None, scale=None, dst_path=None, batch_size=1,
+                               intra_threads=0, inter_threads=1, writers=4):
+    os.makedirs(dst_path, exist_ok=True)
+    engine = InferenceEngine(model_path, batch_size, intra_threads, inter_threads)
+    writer = AsyncWriter(writers)
+    total = len(list(open(img_path))) if img_path.endswith("txt") else None
+    batch = []
+
+    def flush():
+        for i, output in enumerate(engine(len(batch))):
+            img, name = batch[i]
+            writer.submit(post_process, img, os.path.join(dst_path, name), output[0], score_threshold=0.3)
+        batch.clear()
+
+    try:
+        for img, name in tqdm(read_frames(img_path), total=total):
+            read_img(img, mean, scale, out=engine.input[len(batch)])
+            batch.append((img, name))
+            if len(batch) == engine.batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        writer.close()
 
 
 def post_process(img, dst_file, output, score_threshold=0.3):
@@ -111,7 +208,6 @@ def post_process(img, dst_file, output, score_threshold=0.3):
             cv2.putText(img, "id:{}".format(int(det_labels[idx])), (int(det_bbox[0] / 320 * w +5),int(det_bbox[1] / 320 * h)+15), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color_map[::-1], 2)
             cv2.putText(img, "score:{:2.1f}".format(det_scores[idx]), (int(det_bbox[0] / 320 * w + 5), int(det_bbox[1] / 320 * h) + 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color_map[::-1], 2)
             plot_skeleton_kpts(img, kpt, h=h, w=w)
-    print(dst_file, img.shape)
     cv2.imwrite(dst_file, img)
     f.close()
 
@@ -139,7 +235,8 @@ def plot_skeleton_kpts(im, kpts, steps=3, h=0, w=0):
 def main():
     model_inference_image_list(model_path=args.model_path, img_path=args.img_path,
                                mean=0.0, scale=0.00392156862745098,
-                               dst_path=args.dst_path)
+                               dst_path=args.dst_path, batch_size=args.batch_size, intra_threads=args.intra_threads,
+                               inter_threads=args.inter_threads, writers=args.writers)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,21 @@
 import argparse
 import json
 import os
+from itertools import islice
 from pathlib import Path
 from threading import Thread
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import yaml
 from tqdm import tqdm
 
 from models.experimental import attempt_load
-from utils.datasets import create_dataloader
+from utils.datasets import create_dataloader, ShardSampler
 from utils.general import coco80_to_coco91_class, check_dataset, check_file, check_img_size, check_requirements, \
-    box_iou, non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
-from utils.metrics import ap_per_class, ConfusionMatrix
+    non_max_suppression_batched, scale_coords_batch, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
+from utils.metrics import ConfusionMatrix, PoseMetrics
 from utils.plots import plot_images, output_to_target, plot_study_txt
 from utils.torch_utils import select_device, time_synchronized
 import cv2
@@ -46,7 +48,9 @@ def test(data,
          tidl_load=False,
          dump_img=False,
          kpt_label=False,
-         flip_test=False):
+         flip_test=False,
+         nms='iou',
+         freeze_channels=0):
     # Initialize/load model and set device
     training = model is not None
     if training:  # called by train.py
@@ -85,7 +89,7 @@ def test(data,
     check_dataset(data)  # check
     nc = 1 if single_cls else int(data['nc'])  # number of classes
     iouv = torch.linspace(0.5, 0.95, 10).to(device)  # iou vector for mAP@0.5:0.95
-    niou = iouv.numel()
+    nkpt = model.yaml['nkpt'] if kpt_label else 0  # number of keypoints
 
     # Logging
     log_imgs = 0
@@ -98,6 +102,9 @@ def test(data,
         task = opt.task if opt.task in ('train', 'val', 'test') else 'val'  # path to train/val/test images
         dataloader = create_dataloader(data[task], imgsz, batch_size, gs, opt, pad=0.5, rect=True,
                                        prefix=colorstr(f'{task}: '), tidl_load=tidl_load, kpt_label=kpt_label)[0]
+        if freeze_channels:  # static channel selection calibrated on the first freeze_channels batches
+            model.freeze_channels((img.to(device).half() if half else img.to(device).float()) / 255.0
+                                  for img, *_ in islice(dataloader, freeze_channels))
 
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=nc)
@@ -109,16 +116,11 @@ def test(data,
     'pck0.02', 'pck0.04', 'pck0.06', 'pck0.08', 'pck0.1', 'pck0.12', 'pck0.14', 'pck0.16','pck0.18', 'pck0.2')
     p, r, f1, mp, mr, map50,map75,map90, map, t0, t1 = 0., 0.,0.,0., 0., 0., 0., 0., 0., 0., 0.
     loss = torch.zeros(5, device=device)
-    jdict, stats, ap, ap_class, wandb_images = [], [], [], [], []
-    #jdict_kpt = [] if kpt_label else None
-    pt_mse = torch.zeros([7]).to(device)
-    pckh = 0.
-    pt_num = 0
-    pcky_Nnum = pcky_REnum = pcky_RLnum = pcky_Tnum = pcky_LLnum = pcky_LEnum = pcky_Bnum = 0
-    pckn_Nnum = pckn_REnum = pckn_RLnum = pckn_Tnum = pckn_LLnum = pckn_LEnum = pckn_Bnum = 1e-8
-    pcky02_num = pcky04_num = pcky06_num = pcky08_num = pcky10_num = pcky12_num = pcky14_num = pcky16_num = pcky18_num = pcky20_num = 0
-    pckn02_num = pckn04_num = pckn06_num = pckn08_num = pckn10_num = pckn12_num = pckn14_num = pckn16_num = pckn18_num = pckn20_num = 1e-8
-    for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
+    jdict, ap, ap_class, wandb_images = [], [], [], []
+    metrics = PoseMetrics(nkpt, iouv, nc=nc, device=device)
+    ddp = isinstance(dataloader.sampler, ShardSampler)  # validation sharded over DDP ranks, reduced below
+    main = not ddp or dist.get_rank() == 0  # prints on the first rank only
+    for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s, disable=not main)):
         img = img.to(device, non_blocking=True)
         if dump_img:
             dst_file = os.path.join(save_dir, 'dump_img', 'images', 'val2017', Path(paths[0]).stem + '.png')
@@ -146,7 +148,7 @@ def test(data,
 
             # Compute loss
             if compute_loss:
-                loss += compute_loss([x.float() for x in train_out], targets, training=False)[1][:-1]  # box, obj, cls
+                loss += compute_loss([x.float() for x in train_out], targets)[1][:-1]  # box, obj, cls
 
             # Run NMS
             if kpt_label:
@@ -156,174 +158,79 @@ def test(data,
                 targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
             lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
             t = time_synchronized()
-            out = non_max_suppression(out, conf_thres, iou_thres, labels=lb, multi_label=True, agnostic=single_cls, kpt_label=kpt_label, nc=model.yaml['nc'], nkpt=model.yaml['nkpt'])
+            out, n = non_max_suppression_batched(out, conf_thres, iou_thres, labels=lb, multi_label=True,
+                                                 agnostic=single_cls, kpt_label=kpt_label, nc=model.yaml['nc'],
+                                                 nkpt=model.yaml['nkpt'], nms=nms)
             t1 += time_synchronized() - t
 
-        # Statistics per image
-        for si, pred in enumerate(out):
-            # if len(pred)>0 and torch.max(pred[:,4])>0.3:
-            #     with open(save_dir / 'persons.txt' , 'a') as f:
-            #         path = Path(paths[si])
-            #         f.write('./images/test2017/'+path.stem + '.jpg' + '\n')
-
-            labels = targets[targets[:, 0] == si, 1:]
-            nl = len(labels)
-            tcls = labels[:, 0].tolist() if nl else []  # target class
-            path = Path(paths[si])
-            seen += 1
-
-
-            if len(pred) == 0:
-                if nl:
-                    stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
-                continue
-
-            # Predictions
-            if single_cls:
-                pred[:, 5] = 0
-            predn = pred.clone()
-            scale_coords(img[si].shape[1:], predn[:,:4], shapes[si][0], shapes[si][1], kpt_label=False)  # native-space pred
-            if kpt_label:
-                scale_coords(img[si].shape[1:], predn[:,6:], shapes[si][0], shapes[si][1], kpt_label=kpt_label, step=3)  # native-space pred
-            # Append to text file
-            if save_txt:
-                gn = torch.tensor(shapes[si][0])[[1, 0, 1, 0]]  # normalization gain whwh
-                for *xyxy, conf, cls in predn.tolist():
-                    xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                    line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                    with open(save_dir / 'labels' / (path.stem + '.txt'), 'a') as f:
-                        f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-            if save_txt_tidl:  # Write to file in tidl dump format
-                for *xyxy, conf, cls in predn[:, :6].tolist():
-                    xyxy = torch.tensor(xyxy).view(-1).tolist()
-                    line = (conf, cls, *xyxy) if opt.save_conf else (cls, *xyxy)  # label format
-                    with open(save_dir / 'labels' / (path.stem + '.txt'), 'a') as f:
-                        f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-             # W&B logging - Media Panel Plots
-            if len(wandb_images) < log_imgs and wandb_logger.current_epoch > 0:  # Check for test operation
-                if wandb_logger.current_epoch % wandb_logger.bbox_interval == 0:
-                    box_data = [{"position": {"minX": xyxy[0], "minY": xyxy[1], "maxX": xyxy[2], "maxY": xyxy[3]},
-                                 "class_id": int(cls),
-                                 "box_caption": "%s %.3f" % (names[cls], conf),
-                                 "scores": {"class_score": conf},
-                                 "domain": "pixel"} for *xyxy, conf, cls in pred.tolist()]
-                    boxes = {"predictions": {"box_data": box_data, "class_labels": names}}  # inference-space
-                    wandb_images.append(wandb_logger.wandb.Image(img[si], boxes=boxes, caption=path.name))
-            wandb_logger.log_training_progress(predn, path, names) if wandb_logger and wandb_logger.wandb_run else None
-
-            # Append to pycocotools JSON dictionary
-            if save_json or save_json_kpt:
-                # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
-                image_id = int(path.stem) if path.stem.isnumeric() else path.stem
-                box = xyxy2xywh(predn[:, :4])  # xywh
-                box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
-                for p, b in zip(predn.tolist(), box.tolist()):
-                    det_dict = {'image_id': image_id,
-                                'category_id': coco91class[int(p[5])] if is_coco else int(p[5]),
-                                #'bbox': [round(x, 3) for x in b],
-                                'score': round(p[4], 5)}
-                    if kpt_label:
-                        key_point = p[6:]
-                        det_dict.update({'keypoints': key_point})
-
-                    jdict.append(det_dict)
-
-            # Assign all predictions as incorrect
-            correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
-            if nl:
-                detected = []  # target indices
-                tcls_tensor = labels[:, 0]
-
-                # target boxes
-                tbox = xywh2xyxy(labels[:, 1:5])
-                scale_coords(img[si].shape[1:], tbox, shapes[si][0], shapes[si][1], kpt_label=False)  # native-space labels, kpt_label is set to False as we are dealing with boxes here
-                if kpt_label:
-                    tkpt = labels[:, 5:]
-                    scale_coords(img[si].shape[1:], tkpt, shapes[si][0], shapes[si][1], kpt_label=kpt_label)  # native-space labels
-
-                if plots:
-                    confusion_matrix.process_batch(predn, torch.cat((labels[:, 0:1], tbox), 1))
-
-                # Per target class
-                for cls in torch.unique(tcls_tensor):
-                    ti = (cls == tcls_tensor).nonzero(as_tuple=False).view(-1)  # prediction indices
-                    pi = (cls == pred[:, 5]).nonzero(as_tuple=False).view(-1)  # target indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        ious, i = box_iou(predn[pi, :4], tbox[ti]).max(1)  # best ious, indices
-
-                        # Append detections
-                        detected_set = set()
-                        for j in (ious > iouv[0]).nonzero(as_tuple=False):
-                            d = ti[i[j]]  # detected target
-                            if d.item() not in detected_set:
-                                detected_set.add(d.item())
-                                detected.append(d)
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if kpt_label:
-                                    pxx = predn[j, 6::3]
-                                    pyy = predn[j, 7::3]
-                                    txx = tkpt[i[j], 0::2].to(device)
-                                   
-                                    tyy = tkpt[i[j], 1::2].to(device)
-                                    txyi = torch.bitwise_not(torch.bitwise_and(txx == 0, tyy == 0))
-                                    
-                                    mse = (torch.sqrt((pxx - txx) ** 2 + (pyy - tyy) ** 2) * txyi).mean(0)
-                                    #The hypotenuse of the groundtruth box is used as the Body length
-                                    whole_dist = torch.sqrt(
-                                        (tbox[0, 0] - tbox[0, 2]) ** 2 + (tbox[0, 1] - tbox[0, 3]) ** 2)
-                                   
-                                    pck = (torch.sqrt((pxx - txx) ** 2 + (pyy - tyy) ** 2) * txyi) / whole_dist
-
-                                    pcky_Nnum += torch.sum(torch.logical_and(pck[:, 0] < 0.1, pck[:, 0] > 0)).item()
-                                    pcky_REnum += torch.sum(torch.logical_and(pck[:, 1] < 0.1, pck[:, 1] > 0)).item()
-                                    pcky_RLnum += torch.sum(torch.logical_and(pck[:, 2] < 0.1, pck[:, 2] > 0)).item()
-                                    pcky_Tnum += torch.sum(torch.logical_and(pck[:, 3] < 0.1, pck[:, 3] > 0)).item()
-                                    pcky_LLnum += torch.sum(torch.logical_and(pck[:, 4] < 0.1, pck[:, 4] > 0)).item()
-                                    pcky_LEnum += torch.sum(torch.logical_and(pck[:, 5] < 0.1, pck[:, 5] > 0)).item()
-                                    pcky_Bnum += torch.sum(torch.logical_and(pck[:, 6] < 0.1, pck[:, 6] > 0)).item()
-                                    pckn_Nnum += torch.sum(torch.logical_and(pck[:, 0] >= 0.1, pck[:, 0] > 0)).item()
-                                    pckn_REnum += torch.sum(torch.logical_and(pck[:, 1] >= 0.1, pck[:, 1] > 0)).item()
-                                    pckn_RLnum += torch.sum(torch.logical_and(pck[:, 2] >= 0.1, pck[:, 2] > 0)).item()
-                                    pckn_Tnum += torch.sum(torch.logical_and(pck[:, 3] >= 0.1, pck[:, 3] > 0)).item()
-                                    pckn_LLnum += torch.sum(torch.logical_and(pck[:, 4] >= 0.1, pck[:, 4] > 0)).item()
-                                    pckn_LEnum += torch.sum(torch.logical_and(pck[:, 5] >= 0.1, pck[:, 5] > 0)).item()
-                                    pckn_Bnum += torch.sum(torch.logical_and(pck[:, 6] >= 0.1, pck[:, 6] > 0)).item()
-                                
-
-                                    pckn02_num += torch.sum(torch.logical_and(pck >= 0.02, pck > 0)).item()
-                                    pcky02_num += torch.sum(torch.logical_and(pck < 0.02, pck > 0)).item()
-                                    pckn04_num += torch.sum(torch.logical_and(pck >= 0.04, pck > 0)).item()
-                                    pcky04_num += torch.sum(torch.logical_and(pck < 0.04, pck > 0)).item()
-                                    pckn06_num += torch.sum(torch.logical_and(pck >= 0.06, pck > 0)).item()
-                                    pcky06_num += torch.sum(torch.logical_and(pck < 0.06, pck > 0)).item()
-                                    pckn08_num += torch.sum(torch.logical_and(pck >= 0.08, pck > 0)).item()
-                                    pcky08_num += torch.sum(torch.logical_and(pck < 0.08, pck > 0)).item()
-                                    pckn10_num += torch.sum(torch.logical_and(pck >= 0.10, pck > 0)).item()
-                                    pcky10_num += torch.sum(torch.logical_and(pck < 0.10, pck > 0)).item()
-                                    pckn12_num += torch.sum(torch.logical_and(pck >= 0.12, pck > 0)).item()
-                                    pcky12_num += torch.sum(torch.logical_and(pck < 0.12, pck > 0)).item()
-                                    pckn14_num += torch.sum(torch.logical_and(pck >= 0.14, pck > 0)).item()
-                                    pcky14_num += torch.sum(torch.logical_and(pck < 0.14, pck > 0)).item()
-                                    pckn16_num += torch.sum(torch.logical_and(pck >= 0.16, pck > 0)).item()
-                                    pcky16_num += torch.sum(torch.logical_and(pck < 0.16, pck > 0)).item()
-                                    pckn18_num += torch.sum(torch.logical_and(pck >= 0.18, pck > 0)).item()
-                                    pcky18_num += torch.sum(torch.logical_and(pck < 0.18, pck > 0)).item()
-                                    pckn20_num += torch.sum(torch.logical_and(pck >= 0.20, pck > 0)).item()
-                                    pcky20_num += torch.sum(torch.logical_and(pck < 0.20, pck > 0)).item()
-                                    pt_mse += mse
-                                    # pt_mse += (torch.sqrt((pyy - tyy) ** 2) * txyi).mean(0)
-                                    # vv = txyi[:, [0, 6]]
-                                    # pt_mse += (torch.sqrt((pxx - txx) ** 2 + (pyy - tyy) ** 2) * txyi)[:, [0, 6]].mean()  # 2 point mse
-                                    pt_num += 1
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
-            # Append statistics (correct, conf, pcls, tcls)
-            stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+        # Native-space predictions and labels of the whole batch
+        if single_cls:
+            out[..., 5] = 0
+        gain = torch.tensor([x[1][0][0] for x in shapes], device=device).view(-1, 1, 1)  # letterbox ratio
+        pad = torch.tensor([x[1][1] for x in shapes], device=device).view(-1, 1, 2)
+        shape0 = torch.tensor([x[0] for x in shapes], device=device).view(-1, 1, 2)  # original hw
+        predn = out.clone()
+        scale_coords_batch(predn[..., :4], gain, pad, shape0)
+        if kpt_label:
+            scale_coords_batch(predn[..., 6:], gain, pad, shape0, step=3)
+        ti = targets[:, 0].long()  # image index
+        labelsn = torch.cat((targets[:, :2], xywh2xyxy(targets[:, 2:6]), targets[:, 6:]), 1)
+        scale_coords_batch(labelsn[:, 2:], gain[ti, 0], pad[ti, 0], shape0[ti, 0])
+        metrics.process_batch(predn, n, labelsn)  # no host sync
+        seen += nb
+
+        # Per image outputs
+        if save_txt or save_txt_tidl or save_json or save_json_kpt or plots or log_imgs or \
+                (wandb_logger and wandb_logger.wandb_run):
+            n = n.tolist()
+            out = [x[:k] for x, k in zip(out, n)]
+            for si, pred in enumerate(out):
+                predn_si, labels = predn[si, :n[si]], labelsn[ti == si, 1:6]
+                path = Path(paths[si])
+                if plots and len(labels):
+                    confusion_matrix.process_batch(predn_si, labels)
+                if not len(pred):
+                    continue
+
+                # Append to text file
+                if save_txt:
+                    gn = torch.tensor(shapes[si][0])[[1, 0, 1, 0]]  # normalization gain whwh
+                    for *xyxy, conf, cls in predn_si[:, :6].tolist():
+                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+                        with open(save_dir / 'labels' / (path.stem + '.txt'), 'a') as f:
+                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+                if save_txt_tidl:  # Write to file in tidl dump format
+                    for *xyxy, conf, cls in predn_si[:, :6].tolist():
+                        xyxy = torch.tensor(xyxy).view(-1).tolist()
+                        line = (conf, cls, *xyxy) if opt.save_conf else (cls, *xyxy)  # label format
+                        with open(save_dir / 'labels' / (path.stem + '.txt'), 'a') as f:
+                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+                # W&B logging - Media Panel Plots
+                if len(wandb_images) < log_imgs and wandb_logger.current_epoch > 0:  # Check for test operation
+                    if wandb_logger.current_epoch % wandb_logger.bbox_interval == 0:
+                        box_data = [{"position": {"minX": xyxy[0], "minY": xyxy[1], "maxX": xyxy[2], "maxY": xyxy[3]},
+                                     "class_id": int(cls),
+                                     "box_caption": "%s %.3f" % (names[cls], conf),
+                                     "scores": {"class_score": conf},
+                                     "domain": "pixel"} for *xyxy, conf, cls in pred[:, :6].tolist()]
+                        boxes = {"predictions": {"box_data": box_data, "class_labels": names}}  # inference-space
+                        wandb_images.append(wandb_logger.wandb.Image(img[si], boxes=boxes, caption=path.name))
+                wandb_logger.log_training_progress(predn_si, path, names) if wandb_logger and wandb_logger.wandb_run else None
+
+                # Append to pycocotools JSON dictionary
+                if save_json or save_json_kpt:
+                    # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
+                    image_id = int(path.stem) if path.stem.isnumeric() else path.stem
+                    for p in predn_si.tolist():
+                        det_dict = {'image_id': image_id,
+                                    'category_id': coco91class[int(p[5])] if is_coco else int(p[5]),
+                                    'score': round(p[4], 5)}
+                        if kpt_label:
+                            det_dict.update({'keypoints': p[6:]})
+                        jdict.append(det_dict)
 
         # Plot images
         if plots and batch_i < 3000:
@@ -335,38 +242,32 @@ def test(data,
             plot_images(img, output_to_target(out), paths, f, names, kpt_label=kpt_label, steps=3, orig_shape=shapes[si])
 
     # Compute statistics
-    stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        p, r, ap, f1, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
+    nb = torch.tensor([len(dataloader)], dtype=loss.dtype, device=device)  # batches
+    if ddp:  # sum the shards of all ranks, which may differ by a batch or be empty
+        metrics.reduce()
+        loss_nb = torch.cat((loss, nb))
+        dist.all_reduce(loss_nb)
+        loss, nb = loss_nb[:-1], loss_nb[-1:]
+    loss /= nb.clamp(min=1)  # mean per batch
+    (p, r, ap, f1, ap_class), nt, mse, pck_kpt, pck = metrics.compute(plot=plots, save_dir=save_dir, names=names)  # single host sync
+    if len(ap_class):
         ap50,ap75,ap90, ap = ap[:, 0],ap[:, 5], ap[:, 8],ap.mean(1)  # AP@0.5, AP@0.5:0.95
         mp, mr, map50,map75, map90,map = p.mean(), r.mean(), ap50.mean(),ap75.mean(), ap90.mean(),ap.mean()
-        nt = np.bincount(stats[3].astype(np.int64), minlength=nc)  # number of targets per class
-    else:
-        nt = torch.zeros(1)
-    pt_num += 1e-8
     # Print results
 
-    pf = '%20s' + '%12i' * 2 + '%12.3g' * 24
+    pf = '%20s' + '%12i' * 2 + '%12.3g' * (7 + len(pck_kpt) + len(pck))
     # pf = '%20s' + '%12i' * 2 + '%12.3g' * 10  # print format
-    print(pf % (
-    'all', seen, nt.sum(), mp, mr, map50, map75, map90, map, pt_mse.mean() / pt_num,
-    (pcky_Nnum / (pcky_Nnum + pckn_Nnum)), (pcky_REnum / (pcky_REnum + pckn_REnum)),
-    (pcky_RLnum / (pcky_RLnum + pckn_RLnum)), (pcky_Tnum / (pcky_Tnum + pckn_Tnum)),
-    (pcky_LLnum / (pcky_LLnum + pckn_LLnum)), (pcky_LEnum / (pcky_LEnum + pckn_LEnum)),
-    (pcky_Bnum / (pcky_Bnum + pckn_Bnum)),
-    (pcky02_num / (pcky02_num + pckn02_num)), (pcky04_num / (pcky04_num + pckn04_num)),
-    (pcky06_num / (pcky06_num + pckn06_num)), (pcky08_num / (pcky08_num + pckn08_num)),
-    (pcky10_num / (pcky10_num + pckn10_num)), (pcky12_num / (pcky12_num + pckn12_num)),
-    (pcky14_num / (pcky14_num + pckn14_num)), (pcky16_num / (pcky16_num + pckn16_num)),
-    (pcky18_num / (pcky18_num + pckn18_num)), (pcky20_num / (pcky20_num + pckn20_num))))
+    seen_all = int(metrics.seen)  # images on all ranks
+    if main:
+        print(pf % ('all', seen_all, nt.sum(), mp, mr, map50, map75, map90, map, mse, *pck_kpt, *pck))
 
     # Print results per class
-    if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
+    if (verbose or (nc < 50 and not training)) and nc > 1 and main:
         for i, c in enumerate(ap_class):
-            print(pf % (names[c], seen, nt[c], p[i], r[i], ap50[i], ap[i]))
+            print(pf % (names[c], seen_all, nt[c], p[i], r[i], ap50[i], ap[i]))
 
     # Print speeds
-    t = tuple(x / seen * 1E3 for x in (t0, t1, t0 + t1)) + (imgsz, imgsz, batch_size)  # tuple
+    t = tuple(x / max(seen, 1) * 1E3 for x in (t0, t1, t0 + t1)) + (imgsz, imgsz, batch_size)  # tuple
     if not training:
         print('Speed: %.1f/%.1f/%.1f ms inference/NMS/total per %gx%g image at batch-size %g' % t)
 
@@ -435,7 +336,7 @@ def test(data,
     maps = np.zeros(nc) + map
     for i, c in enumerate(ap_class):
         maps[c] = ap[i]
-    return (mp, mr, map50,map75,map90 ,map, (pt_mse.mean()/pt_num).cpu().tolist(),(pcky_Nnum / (pcky_Nnum + pckn_Nnum)), (pcky_REnum / (pcky_REnum + pckn_REnum)), (pcky_RLnum / (pcky_RLnum + pckn_RLnum)),(pcky_Tnum / (pcky_Tnum + pckn_Tnum)), (pcky_LLnum / (pcky_LLnum + pckn_LLnum)), (pcky_LEnum / (pcky_LEnum + pckn_LEnum)), (pcky_Bnum / (pcky_Bnum + pckn_Bnum)),(pcky02_num / (pcky02_num + pckn02_num)),(pcky04_num / (pcky04_num + pckn04_num)),(pcky06_num / (pcky06_num + pckn06_num)),(pcky08_num / (pcky08_num + pckn08_num)),(pcky10_num / (pcky10_num + pckn10_num)),(pcky12_num / (pcky12_num + pckn12_num)),(pcky14_num / (pcky14_num + pckn14_num)),(pcky16_num / (pcky16_num + pckn16_num)),(pcky18_num / (pcky18_num + pckn18_num)),(pcky20_num / (pcky20_num + pckn20_num)), *((loss.cpu() / len(dataloader)).tolist())), maps, t
+    return (mp, mr, map50, map75, map90, map, mse, *pck_kpt, *pck, *loss.cpu().tolist()), maps, t
 
 
 if __name__ == '__main__':
@@ -446,7 +347,7 @@ if __name__ == '__main__':
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.001, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.6, help='IOU threshold for NMS')
-    parser.add_argument('--task', default='val', help='train, val, test, speed or study')
+    parser.add_argument('--task', default='val', help='train, val, test, speed, study or freeze')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
@@ -464,6 +365,8 @@ if __name__ == '__main__':
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--kpt-label', action='store_true', help='Whether kpt-label is enabled or not')
     parser.add_argument('--flip-test', action='store_true', help='Whether to run flip_test or not')
+    parser.add_argument('--nms', default='iou', choices=['iou', 'oks', 'soft-gaussian', 'soft-linear'], help='NMS mode')
+    parser.add_argument('--freeze-batches', type=int, default=0, help='freeze channel selection on this many batches')
     opt = parser.parse_args()
     opt.save_json |= opt.data.endswith('coco.yaml')
     opt.save_json_kpt |= opt.data.endswith('coco_kpts.yaml')
@@ -492,12 +395,23 @@ if __name__ == '__main__':
              dump_img = opt.dump_img,
              kpt_label = opt.kpt_label,
              flip_test = opt.flip_test,
+             nms=opt.nms,
+             freeze_channels=opt.freeze_batches,
              )
 
     elif opt.task == 'speed':  # speed benchmarks
         for w in opt.weights:
             test(opt.data, w, opt.batch_size, opt.img_size, 0.25, 0.45, save_json=False, plots=False, opt=opt)
 
+    elif opt.task == 'freeze':  # accuracy delta of static channel selection
+        # python test.py --task freeze --data mouse_kpts.yaml --weights best.pt --kpt-label --freeze-batches 8
+        for w in opt.weights:
+            r0, r1 = (test(opt.data, w, opt.batch_size, opt.img_size, opt.conf_thres, opt.iou_thres, plots=False, opt=opt,
+                           kpt_label=opt.kpt_label, nms=opt.nms, freeze_channels=n)[0]
+                      for n in (0, opt.freeze_batches or 8))
+            print(('\n%20s' + '%12s' * 4) % ('freeze delta', 'mAP@.5', 'mAP@.5:.95', 'mse', 'pck0.1'))
+            print(('%20s' + '%12.4g' * 4) % (Path(w).stem, *(r1[i] - r0[i] for i in (2, 5, 6, -11))))  # -11 pck0.1
+
     elif opt.task == 'study':  # run over a range of settings and save/plot
         # python test.py --task study --data coco.yaml --iou 0.7 --weights yolov5s.pt yolov5m.pt yolov5l.pt yolov5x.pt
         x = list(range(256, 1536 + 128, 128))  # x axis (image sizes)
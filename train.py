@@ -149,7 +149,7 @@ def train(hyp, opt, device, tb_writer=None):
     # plot_lr_scheduler(optimizer, scheduler, epochs)
 
     # EMA
-    ema = ModelEMA(model) if rank in [-1, 0] else None
+    ema = ModelEMA(model)  # on all ranks, validation is sharded over DDP ranks
 
     # Resume
     start_epoch, best_fitness = 0, 0.0
@@ -206,13 +206,14 @@ def train(hyp, opt, device, tb_writer=None):
     nb = len(dataloader)  # number of batches
     assert mlc < nc, 'Label class %g exceeds nc=%g in %s. Possible class labels are 0-%g' % (mlc, nc, opt.data, nc - 1)
 
+    # Testloader, a contiguous shard of the validation set per DDP rank
+    testloader = create_dataloader(test_path, imgsz_test, test_batch_size, gs, opt,  # testloader
+                                   hyp=hyp, cache=opt.cache_images if not opt.notest else False, rect=True, rank=rank,
+                                   world_size=opt.world_size, workers=opt.workers,
+                                   pad=0.5, prefix=colorstr('val: '), kpt_label=kpt_label, shard=True)[0]
+
     # Process 0
     if rank in [-1, 0]:
-        testloader = create_dataloader(test_path, imgsz_test, test_batch_size, gs, opt,  # testloader
-                                       hyp=hyp, cache=opt.cache_images and not opt.notest, rect=True, rank=-1,
-                                       world_size=opt.world_size, workers=opt.workers,
-                                       pad=0.5, prefix=colorstr('val: '), kpt_label=kpt_label)[0]
-
         if not opt.resume:
             labels = np.concatenate(dataset.labels, 0)
             c = torch.tensor(labels[:, 0])  # classes
@@ -253,7 +254,7 @@ def train(hyp, opt, device, tb_writer=None):
     results = (0, 0, 0, 0, 0, 0, 0)  # P, R, mAP@.5, mAP@.5-.95, val_loss(box, obj, cls)
     scheduler.last_epoch = start_epoch - 1  # do not move
     scaler = amp.GradScaler(enabled=cuda)
-    compute_loss = ComputeLoss(model, kpt_label=kpt_label)  # init loss class
+    compute_loss = ComputeLoss(model, kpt_label=kpt_label, check_nan=opt.check_nan)  # init loss class
     logger.info(f'Image sizes {imgsz} train, {imgsz_test} test\n'
                 f'Using {dataloader.num_workers} dataloader workers\n'
                 f'Logging results to {save_dir}\n'
@@ -316,7 +317,7 @@ def train(hyp, opt, device, tb_writer=None):
             # Forward
             with amp.autocast(enabled=cuda):
                 pred = model(imgs)  # forward
-                loss, loss_items = compute_loss(pred, targets.to(device), training=True)  # loss scaled by batch_size
+                loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
                 if rank != -1:
                     loss *= opt.world_size  # gradient averaged between devices in DDP mode
                 if opt.quad:
@@ -355,53 +356,55 @@ def train(hyp, opt, device, tb_writer=None):
 
             # end batch ------------------------------------------------------------------------------------------------
         # end epoch ----------------------------------------------------------------------------------------------------
+        compute_loss.check_anomalies()  # log NaN/Inf predictions of this epoch
 
         # Scheduler
         lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
         scheduler.step()
 
+        # mAP, on all DDP ranks with the metrics reduced over their validation shards
+        # test_counter = 0
+        ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
+        final_epoch = epoch + 1 == epochs
+        validate = (not opt.notest or final_epoch) and ((epoch == 0) or ((epoch + 1) % 5 == 0))
+        # if(epoch==0) or test_counter == 20:
+        if validate:
+            if rank in [-1, 0]:
+                wandb_logger.current_epoch = epoch + 1
+            results, maps, times = test.test(data_dict,
+                                             batch_size=test_batch_size,
+                                             imgsz=imgsz_test,
+                                             model=ema.ema,
+                                             single_cls=opt.single_cls,
+                                             dataloader=testloader,
+                                             save_dir=save_dir,
+                                             verbose=nc < 50 and final_epoch,
+                                             plots=plots and final_epoch and rank in [-1, 0],
+                                             wandb_logger=wandb_logger if rank in [-1, 0] else None,
+                                             compute_loss=compute_loss,
+                                             is_coco=is_coco,
+                                             kpt_label=kpt_label)
+
         # DDP process 0 or single-GPU
         if rank in [-1, 0]:
-            # mAP
-            # test_counter = 0
-            ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
-            final_epoch = epoch + 1 == epochs
-            if not opt.notest or final_epoch:  # Calculate mAP
-                wandb_logger.current_epoch = epoch + 1
-                if (epoch == 0) or ((epoch + 1) % 5 == 0):
-                    # if(epoch==0) or test_counter == 20:
-                    results, maps, times = test.test(data_dict,
-                                                     batch_size=test_batch_size,
-                                                     imgsz=imgsz_test,
-                                                     model=ema.ema,
-                                                     single_cls=opt.single_cls,
-                                                     dataloader=testloader,
-                                                     save_dir=save_dir,
-                                                     verbose=nc < 50 and final_epoch,
-                                                     plots=plots and final_epoch,
-                                                     wandb_logger=wandb_logger,
-                                                     compute_loss=compute_loss,
-                                                     is_coco=is_coco,
-                                                     kpt_label=kpt_label)
-
-
-                    # Write
-                    with open(results_file, 'a') as f:
-
-                        f.write(s + '%10.4g' * 29 % results + '\n') # append metrics, val_loss
-                    if len(opt.name) and opt.bucket:
-                        os.system('gsutil cp %s gs://%s/results/results%s.txt' % (results_file, opt.bucket, opt.name))
-                    ckpt = {'epoch': epoch,
-                            'best_fitness': best_fitness,
-                            'training_results': results_file.read_text(),
-                            'model': deepcopy(model.module if is_parallel(model) else model).half(),
-                            'ema': deepcopy(ema.ema).half(),
-                            'updates': ema.updates,
-                            'optimizer': optimizer.state_dict(),
-                            'wandb_id': wandb_logger.wandb_run.id if wandb_logger.wandb else None}
-                    rang = wdir / f'epoch{epoch}.pt'
-                    if epoch > 300:
-                      torch.save(ckpt, rang)
+            if validate:
+                # Write
+                with open(results_file, 'a') as f:
+
+                    f.write(s + '%10.4g' * len(results) % results + '\n') # append metrics, val_loss
+                if len(opt.name) and opt.bucket:
+                    os.system('gsutil cp %s gs://%s/results/results%s.txt' % (results_file, opt.bucket, opt.name))
+                ckpt = {'epoch': epoch,
+                        'best_fitness': best_fitness,
+                        'training_results': results_file.read_text(),
+                        'model': deepcopy(model.module if is_parallel(model) else model).half(),
+                        'ema': deepcopy(ema.ema).half(),
+                        'updates': ema.updates,
+                        'optimizer': optimizer.state_dict(),
+                        'wandb_id': wandb_logger.wandb_run.id if wandb_logger.wandb else None}
+                rang = wdir / f'epoch{epoch}.pt'
+                if epoch > 300:
+                  torch.save(ckpt, rang)
 
 
             # Log
@@ -457,6 +460,9 @@ def train(hyp, opt, device, tb_writer=None):
         # Test best.pt
         logger.info('%g epochs completed in %.3f hours.\n' % (epoch - start_epoch + 1, (time.time() - t0) / 3600))
         if opt.data.endswith('coco.yaml') and nc == 80:  # if COCO
+            if rank != -1:  # whole validation set on this rank
+                testloader = create_dataloader(test_path, imgsz_test, test_batch_size, gs, opt, hyp=hyp, rect=True,
+                                               pad=0.5, prefix=colorstr('val: '), kpt_label=kpt_label)[0]
             for m in (last, best) if best.exists() else (last):  # speed, mAP tests
                 results, _, _ = test.test(opt.data,
                                           batch_size=test_batch_size,
@@ -506,7 +512,8 @@ if __name__ == '__main__':
     parser.add_argument('--noautoanchor', action='store_true', help='disable autoanchor check')
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache-images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--cache-images', nargs='?', const='ram', default=False, choices=['ram', 'disk'],
+                        help='cache images in "ram" (default) or in memory-mapped shards on "disk"')
     parser.add_argument('--image-weights', action='store_true', help='use weighted image selection for training')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--multi-scale', action='store_true', help='vary img-size +/- 50%%')
@@ -527,6 +534,7 @@ if __name__ == '__main__':
     parser.add_argument('--save_period', type=int, default=-1, help='Log model after every "save_period" epoch')
     parser.add_argument('--artifact_alias', type=str, default="latest", help='version of dataset artifact to be used')
     parser.add_argument('--kpt-label', action='store_true', help='use keypoint labels for training')
+    parser.add_argument('--check-nan', action='store_true', help='count NaN/Inf predictions in the loss, logged every epoch')
     opt = parser.parse_args()
 
     # Set DDP variables
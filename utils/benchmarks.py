@@ -0,0 +1,163 @@
+# Benchmarks of data loading and inference hot paths
+# Usage: python -m utils.benchmarks --task labels --data data/mouse_kpts.yaml
+#        python -m utils.benchmarks --task channels
+#        python -m utils.benchmarks --task memory --cfg models/hub/YOLO-MousePose-S.yaml
+#        python -m utils.benchmarks --task letterbox --img-size 320
+
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+
+from models.common import ECA_SORT, SE_HALF, SE_SORT, select_channels
+from utils.datasets import img2label_paths, img_formats, letterbox, parse_labels, read_label_file
+from utils.preprocess import letterbox_into
+from utils.torch_utils import profile
+
+
+def dataset_files(path):
+    # Returns the sorted image files of a dataset directory or *.txt list, like LoadImagesAndLabels
+    p = Path(path)
+    if p.is_dir():
+        f = glob.glob(str(p / '**' / '*.*'), recursive=True)
+    else:
+        parent = str(p.parent) + os.sep
+        f = [x.replace('./', parent) if x.startswith('./') else x for x in p.read_text().strip().splitlines()]
+    return sorted(x.replace('/', os.sep).split(' ')[0] for x in f if x.split(' ')[0].split('.')[-1].lower() in img_formats)
+
+
+def parse_labels_loop(lb_files, kpt_label=True):
+    # Reference per-file, per-row label conversion that parse_labels() replaces
+    labels = []
+    for lb_file in lb_files:
+        try:
+            text = read_label_file(lb_file)
+            l = np.array([x.split() for x in text.strip().splitlines()], dtype=np.float32) if text else None
+            if l is None or not len(l):
+                labels.append(np.zeros((0, 19 if kpt_label else 5), dtype=np.float32))  # missing or empty
+                continue
+            assert (l >= 0).all() and (l[:, 5::3] <= 1).all() and (l[:, 6::3] <= 1).all()
+            if kpt_label:
+                assert l.shape[1] == 26
+                kpts = np.zeros((l.shape[0], 19))
+                for i in range(len(l)):
+                    kpt = np.delete(l[i, 5:], np.arange(2, l.shape[1] - 5, 3))  # remove the occlusion paramater
+                    kpts[i] = np.hstack((l[i, :5], kpt))
+                l = kpts
+            assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            labels.append(l.astype(np.float32))
+        except (ValueError, AssertionError):
+            labels.append(None)  # corrupted
+    return labels
+
+
+def benchmark_labels(path, kpt_label=True, n=3):
+    # Times the per-row reference against batched parse_labels() on the label files of a dataset
+    lb_files = img2label_paths(dataset_files(path))
+    print(f'{len(lb_files)} label files in {path}')
+    for f in parse_labels_loop, parse_labels:
+        t = []
+        for _ in range(n):
+            t0 = time.time()
+            y = f(lb_files, kpt_label)
+            t.append(time.time() - t0)
+        print(f'{f.__name__:>20s}: {min(t) * 1E3:10.1f} ms ({min(t) * 1E6 / max(len(lb_files), 1):.1f} us/file)')
+    l, offsets, errors = y[0], y[2], y[5]
+    for k, a in enumerate(parse_labels_loop(lb_files, kpt_label)):  # same labels for all valid files
+        assert (a is None) == bool(errors[k]) and (a is None or np.array_equal(a, l[offsets[k]:offsets[k + 1]])), k
+
+
+def select_channels_loop(x, indices):
+    # Reference per-sample channel copy that select_channels() replaces
+    y = x.new_zeros((x.shape[0], indices.shape[1], *x.shape[2:]))
+    for b in range(x.shape[0]):
+        y[b] = x[b, indices[b]]
+    return y
+
+
+def benchmark_channels(c1=128, c2=64, s=40, batch_sizes=(1, 2, 4, 8, 16, 32, 64), n=20):
+    # Profiles the per-sample loop against the batched gather of the channel selection modules, per batch size
+    for bs in batch_sizes:
+        x = torch.randn(bs, c1, s, s)
+        i = torch.randn(bs, c1).topk(c2, 1)[1]
+        assert torch.equal(select_channels_loop(x, i), select_channels(x, i))
+        print(f'\nbatch-size {bs}: select_channels_loop, select_channels, SE_SORT, ECA_SORT, SE_HALF')
+        profile(x, [lambda x: select_channels_loop(x, i.to(x.device)), lambda x: select_channels(x, i.to(x.device)),
+                    SE_SORT(c1, c2), ECA_SORT(c1, c2), SE_HALF(c1)], n=n)
+
+
+def forward_peak_memory(cfg, bs, imgsz, free=True):
+    # Peak memory (MB) of one no-grad forward pass, CUDA allocator peak or the rise of the process peak RSS on CPU.
+    # free=False keeps every saved layer output to the end of the pass, as before layer liveness
+    from models.yolo import Model
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model = Model(cfg).to(device).fuse().eval()
+    for m in model.model:
+        m.free = m.free if free else []
+    x = torch.rand(bs, 3, imgsz, imgsz, device=device)
+    with torch.no_grad():
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+            m0 = torch.cuda.memory_allocated()
+            model(x)
+            return (torch.cuda.max_memory_allocated() - m0) / 2 ** 20
+        m0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        model(x)
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - m0) / 2 ** 10  # ru_maxrss in KB
+
+
+def benchmark_memory(cfg, imgsz=640, batch_sizes=(1, 4, 16)):
+    # Peak forward memory with and without freeing dead layer outputs, every run in a fresh process
+    ctx = multiprocessing.get_context('spawn')
+    print(f"{'batch-size':>12s}{'keep (MB)':>14s}{'free (MB)':>14s}{'saved':>10s}")
+    for bs in batch_sizes:
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            keep, free = (pool.apply(forward_peak_memory, (cfg, bs, imgsz, f)) for f in (False, True))
+        print(f'{bs:12d}{keep:14.1f}{free:14.1f}{1 - free / max(keep, 1E-9):10.1%}')
+
+
+def benchmark_letterbox(imgsz=320, shape=(480, 640), batch_size=8, n=200):
+    # Per-frame letterbox + BGR to RGB + CHW (+ float scaling) with fresh arrays against letterbox_into() a batch buffer
+    img = np.random.randint(0, 255, (*shape, 3), dtype=np.uint8)
+    x = np.empty((batch_size, 3, imgsz, imgsz), dtype=np.uint8)
+    xf = np.empty((batch_size, 3, imgsz, imgsz), dtype=np.float32)
+    fns = {'letterbox uint8': lambda i: np.ascontiguousarray(letterbox(img, imgsz, auto=False)[0][:, :, ::-1].transpose(2, 0, 1)),
+           'letterbox_into uint8': lambda i: letterbox_into(img, x[i], imgsz),
+           'letterbox float32': lambda i: np.ascontiguousarray(letterbox(img, imgsz, auto=False)[0][:, :, ::-1].transpose(2, 0, 1)).astype(np.float32) / 255,
+           'letterbox_into float32': lambda i: letterbox_into(img, xf[i], imgsz, scale=1 / 255)}
+    print(f'{shape[1]}x{shape[0]} frames to {imgsz}x{imgsz}')
+    for k, f in fns.items():
+        t0 = time.time()
+        for i in range(n):
+            f(i % batch_size)
+        print(f'{k:>24s}: {(time.time() - t0) * 1E3 / n:8.3f} ms/frame')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmarks.py')
+    parser.add_argument('--task', default='labels', help='labels, channels, memory, letterbox')
+    parser.add_argument('--data', type=str, default='data/mouse_kpts.yaml', help='*.data path')
+    parser.add_argument('--split', default='train', help='train, val')
+    parser.add_argument('--cfg', type=str, default='models/hub/YOLO-MousePose-S.yaml', help='model.yaml')
+    parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1, 4, 16], help='batch sizes')
+    opt = parser.parse_args()
+    print(opt)
+
+    if opt.task == 'labels':
+        with open(opt.data) as f:
+            data = yaml.safe_load(f)  # data dict
+        benchmark_labels(data[opt.split])
+    elif opt.task == 'channels':
+        benchmark_channels()
+    elif opt.task == 'memory':
+        benchmark_memory(opt.cfg, opt.img_size, opt.batch_size)
+    elif opt.task == 'letterbox':
+        benchmark_letterbox(opt.img_size)
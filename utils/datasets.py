@@ -1,16 +1,19 @@
 # Dataset utils and dataloaders
 
+import collections
+import copy
 import glob
+import hashlib
 import logging
 import math
 import os
 import random
 import shutil
+import tempfile
 import time
-from itertools import repeat
-from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import ThreadPool, Pool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread
 
 import cv2
 import numpy as np
@@ -23,6 +26,7 @@ from imgaug import augmenters as iaa
 import albumentations as A
 from utils.general import check_requirements, xyxy2xywh, xywh2xyxy, xywhn2xyxy, xyn2xy, segment2box, segments2boxes, \
     resample_segments, clean_str
+from utils.preprocess import letterbox_geometry, letterbox_into
 from utils.torch_utils import torch_distributed_zero_first
 
 
@@ -30,6 +34,8 @@ from utils.torch_utils import torch_distributed_zero_first
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo']  # acceptable image suffixes
 vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv']  # acceptable video suffixes
+num_threads = min(8, os.cpu_count())  # number of multiprocessing threads
+cache_version = 0.3  # label cache version
 logger = logging.getLogger(__name__)
 
 # Get orientation exif tag
@@ -38,9 +44,16 @@ for orientation in ExifTags.TAGS.keys():
         break
 
 
-def get_hash(files):
-    # Returns a single hash value of a list of files
-    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+def get_fingerprint(im_file, lb_file):
+    # Returns an (mtime_ns, size) fingerprint of an image and its label file, (0, 0) for a missing file
+    fp = []
+    for f in im_file, lb_file:
+        try:
+            st = os.stat(f)
+            fp.extend((st.st_mtime_ns, st.st_size))
+        except OSError:
+            fp.extend((0, 0))
+    return tuple(fp)
 
 
 def exif_size(img):
@@ -59,14 +72,16 @@ def exif_size(img):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=False, cache=False, pad=0.0, rect=False,
-                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', tidl_load=False, kpt_label=False):
+                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', tidl_load=False, kpt_label=False,
+                      shard=False):
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
+    ram = shard and rank != -1 and cache and cache != 'disk'  # RAM cache of this rank's validation shard only
     with torch_distributed_zero_first(rank):
         dataset = LoadImagesAndLabels(path, imgsz, batch_size,
                                       augment=augment,  # augment images
                                       hyp=hyp,  # augmentation hyperparameters
                                       rect=rect,  # rectangular training
-                                      cache_images=cache,
+                                      cache_images=False if ram else cache,
                                       single_cls=opt.single_cls,
                                       stride=int(stride),
                                       pad=pad,
@@ -77,7 +92,14 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
-    sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
+    if rank == -1:
+        sampler = None
+    elif shard:  # distributed validation, every image once
+        sampler = ShardSampler(dataset, batch_size, rank, world_size)
+        if ram:
+            dataset.cache_ram(sampler.indices, prefix)
+    else:
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset)
     loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
     # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
     dataloader = loader(dataset,
@@ -90,6 +112,25 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
     return dataloader, dataset
 
 
+class ShardSampler(torch.utils.data.Sampler):
+    """ Contiguous shard of the dataset per DDP rank, for validation.
+
+    Unlike DistributedSampler no images are padded or interleaved: shards start on batch boundaries so rectangular
+    batch shapes are kept, and metrics summed over all ranks count every image exactly once.
+    """
+
+    def __init__(self, dataset, batch_size, rank, world_size):
+        nb = math.ceil(len(dataset) / batch_size)  # number of batches
+        i0, i1 = nb * rank // world_size * batch_size, nb * (rank + 1) // world_size * batch_size
+        self.indices = range(i0, min(i1, len(dataset)))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
 class InfiniteDataLoader(torch.utils.data.dataloader.DataLoader):
     """ Dataloader that reuses workers
 
@@ -125,7 +166,7 @@ class _RepeatSampler(object):
 
 
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640, stride=32):
+    def __init__(self, path, img_size=640, stride=32, verbose=True, batch_size=1, buffers=2, pin_memory=False):
         p = str(Path(path).absolute())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -141,7 +182,12 @@ class LoadImages:  # for inference
         ni, nv = len(images), len(videos)
 
         self.img_size = img_size
+        self.shape = (img_size, img_size) if isinstance(img_size, int) else tuple(img_size)  # letterbox (h, w)
         self.stride = stride
+        self.verbose = verbose  # print progress, else only keep it in self.s for a consumer running behind the reader
+        self.batch_size = batch_size  # frames per __next__, >1 returns lists and a uint8 batch tensor
+        self.buffers = [None] * buffers  # batch tensors reused round-robin, enough to cover the batches in flight
+        self.pin_memory = pin_memory
         self.files = images + videos
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
@@ -155,9 +201,39 @@ class LoadImages:  # for inference
 
     def __iter__(self):
         self.count = 0
+        self.nb = 0  # batches returned
         return self
 
     def __next__(self):
+        if self.batch_size == 1:
+            return self.read()
+
+        # Batch of up to batch_size frames, across file boundaries, letterboxed into a preallocated (pinned) uint8 tensor.
+        # Returns paths, (n,3,h,w) batch, original frames and video captures, one per frame, and per-frame
+        # (mode, frame, progress string, video fps) in self.info. The tensor is overwritten len(self.buffers) batches later
+        k = self.nb % len(self.buffers)
+        if self.buffers[k] is None:
+            self.buffers[k] = torch.empty((self.batch_size, 3, *self.shape), dtype=torch.uint8)
+            if self.pin_memory:
+                self.buffers[k] = self.buffers[k].pin_memory()
+        batch = self.buffers[k]
+        paths, im0s, caps, self.info = [], [], [], []
+        for i in range(self.batch_size):
+            try:
+                path, _, img0, cap = self.read(out=batch[i].numpy())  # letterboxed straight into the batch
+            except StopIteration:
+                break
+            paths.append(path)
+            im0s.append(img0)
+            caps.append(cap)
+            self.info.append((self.mode, getattr(self, 'frame', 0), self.s, getattr(self, 'fps', 0)))
+        if not paths:
+            raise StopIteration
+        self.nb += 1
+        return paths, batch[:len(paths)], im0s, caps
+
+    def read(self, out=None):
+        # Next frame: path, letterboxed CHW RGB image (into out if given), original BGR image, video capture
         if self.count == self.nf:
             raise StopIteration
         path = self.files[self.count]
@@ -177,21 +253,20 @@ class LoadImages:  # for inference
                     ret_val, img0 = self.cap.read()
 
             self.frame += 1
-            print(f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: ', end='')
+            self.s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: '
 
         else:
             # Read image
             self.count += 1
             img0 = cv2.imread(path)  # BGR
             assert img0 is not None, 'Image Not Found ' + path
-            print(f'image {self.count}/{self.nf} {path}: ', end='')
-
-        # Padded resize
-        img = letterbox(img0, self.img_size, stride=self.stride, auto=False)[0]
+            self.s = f'image {self.count}/{self.nf} {path}: '
+        if self.verbose:
+            print(self.s, end='')
 
-        # Convert
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-        img = np.ascontiguousarray(img)
+        # Padded resize, BGR to RGB, to 3x416x416
+        img = np.empty((3, *self.shape), dtype=np.uint8) if out is None else out
+        letterbox_into(img0, img, self.shape, stride=self.stride)
 
         return path, img, img0, self.cap
 
@@ -199,6 +274,7 @@ class LoadImages:  # for inference
         self.frame = 0
         self.cap = cv2.VideoCapture(path)
         self.nframes = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)  # kept for consumers behind the reader, the capture is released at EOF
 
     def __len__(self):
         return self.nf  # number of files
@@ -263,10 +339,16 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    # One reader thread per source pushes timestamped frames into a per-source ring buffer. __next__ batches only the
+    # streams with a new frame, waiting for the first one instead of re-serving stale frames, so a slow camera does
+    # not hold back the others. latest=True serves the freshest frame and drops older unserved ones, else frames are
+    # served in order and dropped only when the ring overflows. Frames older than max_lag seconds (0 for no limit)
+    # are dropped. Per-stream read/served/dropped counters and lag are in self.streams, see summary()
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, buffers=2, ring=4, latest=True, max_lag=0.):
         self.mode = 'stream'
-        self.img_size = img_size
+        self.img_size = tuple(img_size) if isinstance(img_size, list) else img_size
         self.stride = stride
+        self.latest, self.max_lag = latest, max_lag
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -275,8 +357,9 @@ class LoadStreams:  # multiple IP or RTSP cameras
             sources = [sources]
 
         n = len(sources)
-        self.imgs = [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.streams = []
+        self.ready = Condition()  # notified on every new frame and when a stream ends
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
             print(f'{i + 1}/{n}: {s}... ', end='')
@@ -289,33 +372,48 @@ class LoadStreams:  # multiple IP or RTSP cameras
             assert cap.isOpened(), f'Failed to open {s}'
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
+            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100 or 30  # 30 FPS fallback
 
-            _, self.imgs[i] = cap.read()  # guarantee first frame
-            thread = Thread(target=self.update, args=([i, cap]), daemon=True)
+            st = Stream(s, self.fps, ring, file=isinstance(s, str) and os.path.isfile(s))
+            _, im = cap.read()  # guarantee first frame
+            st.push(im, time.time())
+            self.streams.append(st)
+            Thread(target=self.update, args=([st, cap]), daemon=True).start()
             print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
-            thread.start()
         print('')  # newline
 
         # check for common shapes
-        s = np.stack([letterbox(x, self.img_size, stride=self.stride)[0].shape for x in self.imgs], 0)  # shapes
+        s = np.stack([letterbox_geometry(x.ring[-1][2].shape[:2], self.img_size, stride=self.stride)[1]
+                      for x in self.streams], 0)  # shapes
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
+        self.shape = s[0] if self.rect else letterbox_geometry(self.streams[0].ring[-1][2].shape[:2], self.img_size,
+                                                                auto=False)[1]  # batch (h, w)
+        self.buffers = [np.empty((n, 3, *self.shape), dtype=np.uint8) for _ in range(buffers)]  # reused round-robin
 
-    def update(self, index, cap):
-        # Read next stream frame in a daemon thread
-        n = 0
-        while cap.isOpened():
-            n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
-                success, im = cap.retrieve()
-                print(success)
-                self.imgs[index] = im if success else self.imgs[index] * 0
-                n = 0
-            time.sleep(1 / self.fps)  # wait time
+    def update(self, st, cap):
+        # Read stream frames in a daemon thread, reconnecting live sources and pacing video files to their fps
+        t = time.time()
+        while True:
+            success, im = cap.read()
+            if not success:
+                if st.file:  # end of video
+                    break
+                cap.release()
+                time.sleep(1)
+                cap.open(st.source)  # reconnect
+                continue
+            with self.ready:
+                st.push(im, time.time())
+                self.ready.notify()
+            if st.file:
+                t = max(t + 1 / st.fps, time.time() - 1)  # real-time pacing, without catching up after a stall
+                time.sleep(max(t - time.time(), 0))
+        cap.release()
+        with self.ready:
+            st.alive = False
+            self.ready.notify()
 
     def __iter__(self):
         self.count = -1
@@ -323,33 +421,327 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
         if cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
 
-        # Letterbox
-        img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
-
-        # Stack
-        img = np.stack(img, 0)
-
-        # Convert
-        img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3x416x416
-        img = np.ascontiguousarray(img)
-
-        return self.sources, img, img0, None
+        # Wait for new frames, batch every stream that has one
+        with self.ready:
+            while True:
+                now = time.time()
+                frames = [(i, st.take(self.latest, self.max_lag, now)) for i, st in enumerate(self.streams)]
+                frames = [(i, x) for i, x in frames if x is not None]
+                if frames:
+                    break
+                if not any(st.alive for st in self.streams):
+                    raise StopIteration
+                self.ready.wait(1)
+
+        # Letterbox into a batch buffer
+        img = self.buffers[self.count % len(self.buffers)][:len(frames)]
+        img0, self.info = [], []
+        for j, (i, (seq, t, im)) in enumerate(frames):
+            letterbox_into(im, img[j], self.img_size, auto=self.rect, stride=self.stride)
+            img0.append(im)
+            self.info.append((self.mode, seq, '%g: ' % i, self.streams[i].fps))
+        self.indices = [i for i, _ in frames]  # streams in this batch
+        return [self.sources[i] for i in self.indices], img, img0, None
+
+    def summary(self):
+        # Per-stream frame counters and serving lag (age of a frame when batched)
+        s = f"{'stream':>8s}{'fps':>8s}{'read':>10s}{'served':>10s}{'dropped':>10s}{'lag ms':>10s}{'max':>10s}  source\n"
+        for i, st in enumerate(self.streams):
+            lag = st.lag_sum / max(st.served, 1) * 1E3
+            s += f'{i:8d}{st.fps:8.1f}{st.read:10d}{st.served:10d}{st.dropped:10d}{lag:10.1f}{st.lag_max * 1E3:10.1f}  ' \
+                 f'{self.sources[i]}\n'
+        return s.rstrip()
 
     def __len__(self):
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+class Stream:
+    # Ring buffer of (frame number, timestamp, image) of one LoadStreams source, with counters. Guarded by
+    # LoadStreams.ready
+    def __init__(self, source, fps, ring=4, file=False):
+        self.source, self.fps, self.file = source, fps, file
+        self.ring = collections.deque(maxlen=ring)  # unserved frames
+        self.alive = True
+        self.read = self.served = self.dropped = 0  # frames
+        self.lag_sum = self.lag_max = 0.  # seconds from read to served
+
+    def push(self, im, t):
+        self.read += 1
+        self.dropped += len(self.ring) == self.ring.maxlen  # oldest unserved frame overwritten
+        self.ring.append((self.read, t, im))
+
+    def take(self, latest=True, max_lag=0., now=0.):
+        # Next frame to serve or None, dropping the frames skipped over
+        while self.ring and max_lag and now - self.ring[0][1] > max_lag:  # too old
+            self.ring.popleft()
+            self.dropped += 1
+        if not self.ring:
+            return None
+        if latest:
+            self.dropped += len(self.ring) - 1
+            x = self.ring.pop()
+            self.ring.clear()
+        else:
+            x = self.ring.popleft()
+        lag = now - x[1]
+        self.served += 1
+        self.lag_sum += lag
+        self.lag_max = max(self.lag_max, lag)
+        return x
+
+
 def img2label_paths(img_paths):
     # Define label paths as a function of image paths
     sa, sb = os.sep + 'images' + os.sep, os.sep + 'labels' + os.sep  # /images/, /labels/ substrings
     return ['txt'.join(x.replace(sa, sb, 1).rsplit(x.split('.')[-1], 1)) for x in img_paths]
 
 
+def verify_image(im_file):
+    # Verify one image in a worker process, returns (shape, message), shape is None for a corrupted image
+    try:
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+        return shape, ''
+    except Exception as e:
+        return None, str(e)
+
+
+def read_label_file(lb_file):
+    # Returns the text of a label file, None if missing
+    if os.path.isfile(lb_file):
+        with open(lb_file, 'r') as f:
+            return f.read()
+    return None
+
+
+def duplicate_rows(x, group, n):
+    # Returns a boolean mask of the n groups holding a repeated row, using one hashed pass over all rows of x
+    u = np.ascontiguousarray(x + 0.0, dtype=np.float32).view(np.uint32).astype(np.uint64)  # +0.0 folds -0.0 into 0.0
+    h = (u * np.arange(1, 2 * x.shape[1], 2, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)).sum(1)  # row hash
+    h ^= group.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+    i = np.argsort(h, kind='stable')
+    j = np.nonzero(h[i[1:]] == h[i[:-1]])[0]  # hash collisions, confirmed exactly below
+    a, b = i[j], i[j + 1]
+    dup = (group[a] == group[b]) & (x[a] == x[b]).all(1)
+    return np.bincount(group[a[dup]], minlength=n) > 0
+
+
+def parse_labels(lb_files, kpt_label=True, nkpt=7):
+    # Batched label parsing. All label files are read into one float32 buffer, checked row-wise at once and converted
+    # with a single strided gather that splits the keypoint visibility off the (x, y, v) triplets
+    # Returns labels (N, 5 + 2 * nkpt), visibility (N, nkpt), row offsets (n + 1,), status (n, 3) as (nm, nf, ne),
+    # segments {file index: segments} and an error message per file ('' for valid files)
+    n, nl = len(lb_files), 5 + 3 * nkpt if kpt_label else 5  # files, columns per label row
+    status, errors, segments = np.zeros((n, 3), dtype=np.int64), [''] * n, {}
+    rows, chunks, boxes = np.zeros(n, dtype=np.int64), [[]] * n, {}
+    with ThreadPool(num_threads) as pool:
+        for k, text in enumerate(pool.imap(read_label_file, lb_files, chunksize=64)):
+            if text is None:
+                status[k, 0] = 1  # label missing
+                continue
+            status[k, 1] = 1  # label found
+            l = [x.split() for x in text.strip().splitlines()]
+            if not l:
+                status[k, 2] = 1  # label empty
+            elif any(len(x) > 8 for x in l) and not kpt_label:  # is segment
+                try:
+                    classes = np.array([x[0] for x in l], dtype=np.float32)
+                    segments[k] = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+                    boxes[k] = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments[k])), 1)  # (cls, xywh)
+                    rows[k] = len(l)
+                except ValueError as e:
+                    errors[k] = str(e)
+            elif any(len(x) != nl for x in l):
+                errors[k] = f'labels require {nl} columns each'
+            else:
+                chunks[k], rows[k] = [v for x in l for v in x], len(l)
+
+    # Convert all tokens at once, locating the offending files only if that fails
+    try:
+        buf = np.array([v for c in chunks for v in c], dtype=np.float32)
+    except ValueError:
+        for k, c in enumerate(chunks):
+            try:
+                np.array(c, dtype=np.float32)
+            except ValueError as e:
+                errors[k], chunks[k], rows[k] = str(e), [], 0
+        buf = np.array([v for c in chunks for v in c], dtype=np.float32)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(rows)
+    group = np.repeat(np.arange(n), rows)  # file index of every row
+    l = np.zeros((offsets[-1], nl), dtype=np.float32)
+    l[np.repeat([len(c) > 0 for c in chunks], rows)] = buf.reshape(-1, nl)
+    for k, b in boxes.items():
+        l[offsets[k]:offsets[k + 1]] = b
+
+    # Row-wise checks, reduced per file in the original order of precedence
+    neg = (l < 0).any(1)  # all columns, visibility included
+    if kpt_label:
+        norm = (l[:, 5::3] > 1).any(1) | (l[:, 6::3] > 1).any(1)
+        flags = ((l[:, 7::3] != np.round(l[:, 7::3])) | (l[:, 7::3] > 255)).any(1)  # not a whole number storable as uint8
+        v = l[:, 7::3].astype(np.uint8)  # keypoint visibility flags
+        l = l[:, np.r_[0:5, 5 + np.arange(nkpt * 3).reshape(-1, 3)[:, :2].ravel()]]  # remove the occlusion parameter
+    else:
+        norm = (l[:, 1:5] > 1).any(1)
+        flags = np.zeros(len(l), dtype=bool)
+        v = np.zeros((len(l), 0), dtype=np.uint8)
+    checks = (np.bincount(group, weights=neg, minlength=n) > 0, 'negative labels'), \
+             (np.bincount(group, weights=flags, minlength=n) > 0, 'invalid keypoint visibility labels'), \
+             (np.bincount(group, weights=norm, minlength=n) > 0, 'non-normalized or out of bounds coordinate labels'), \
+             (duplicate_rows(l, group, n), 'duplicate labels')
+    for bad, msg in checks:
+        for k in np.nonzero(bad)[0]:
+            errors[k] = errors[k] or msg
+    return l, v, offsets, status, segments, errors
+
+
+class LabelStore:
+    """ Flat, memory-mapped label columns shared zero-copy by all dataloader workers
+
+    All columns live in one binary file, their dtype, byte offset and shape are kept in the .cache layout dict:
+        labels   (N, 5 + 2 * nkpt) float32  class, xywh and keypoint xy of all images, row-concatenated
+        visible  (N, nkpt) uint8            keypoint visibility flags
+        offsets  (n + 1,) int64             labels of file k are rows offsets[k]:offsets[k + 1]
+    store[i] returns a read-only view of the labels of image index[i]
+    """
+
+    def __init__(self, file, layout, index=None, single_cls=False):
+        self.file, self.layout, self.single_cls = Path(file), layout, single_cls
+        self.open()
+        self.index = np.arange(len(self.offsets) - 1) if index is None else np.asarray(index)
+
+    def open(self):
+        for k, (dtype, offset, shape) in self.layout.items():
+            a = np.memmap(self.file, dtype=dtype, mode='r', offset=offset, shape=tuple(shape)) if np.prod(shape) \
+                else np.zeros(shape, dtype=dtype)  # empty arrays can not be mapped
+            setattr(self, k, a)
+
+    @staticmethod
+    def save(file, **columns):
+        # Write columns into one 64-byte aligned file, returns their layout {name: (dtype, offset, shape)}
+        layout, offset, tmp = {}, 0, Path(f'{file}.{os.getpid()}.tmp')  # per process, ranks may race
+        with open(tmp, 'wb') as f:
+            for k, a in columns.items():
+                a = np.ascontiguousarray(a)
+                offset = -(-offset // 64) * 64  # align
+                f.seek(offset)
+                f.write(a.tobytes())
+                layout[k] = (a.dtype.str, offset, a.shape)
+                offset += a.nbytes
+        os.replace(tmp, file)
+        return layout
+
+    def take(self, i):
+        # Returns a store over the reordered / selected image indices i, sharing the same mapping
+        store = copy.copy(self)
+        store.index = self.index[i]
+        return store
+
+    def visibility(self, i):
+        k = self.index[i]
+        return self.visible[self.offsets[k]:self.offsets[k + 1]]
+
+    def __getitem__(self, i):
+        k = self.index[i]
+        l = self.labels[self.offsets[k]:self.offsets[k + 1]]
+        if self.single_cls:
+            l = l.copy()
+            l[:, 0] = 0
+        return l
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):  # re-map instead of pickling the arrays into spawned workers
+        return {k: v for k, v in self.__dict__.items() if k not in self.layout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+
+class ImageShards:
+    """ Pre-decoded, pre-resized uint8 images in memory-mapped shard files on disk
+
+    Images are appended back to back into shards of up to shard_bytes, the index file holds per image
+        (shard, byte offset, h, w, h0, w0)
+    Dataloader workers map the shards read-only and share them through the OS page cache, shards[i] returns a view
+    """
+    shard_bytes = 2 ** 30  # 1 GB per shard
+
+    def __init__(self, path, files, index):
+        self.path, self.index = Path(path), index
+        self.pos = {f: i for i, f in enumerate(files)}
+        self.shards = {}  # shard number: np.memmap, opened lazily in every worker
+
+    @classmethod
+    def load(cls, path, files, key):
+        # Returns the shards at path if they were built for these image files and key, else None
+        index = Path(f'{path}.index')
+        if not index.is_file():
+            return None
+        x = torch.load(index)
+        fingerprints = [get_fingerprint(f, '')[:2] for f in files]
+        if x.get('version') != cache_version or x['key'] != key or \
+                any(x['fingerprints'].get(f) != fp for f, fp in zip(files, fingerprints)) or \
+                not all(Path(f'{path}.{i}.shard').is_file() for i in range(x['nshards'])):
+            return None
+        return cls(path, x['files'], x['index'])
+
+    @classmethod
+    def build(cls, path, files, loader, key, prefix=''):
+        # Decode and resize all images with loader(i) -> (img, hw_original, hw_resized) and write them into shards
+        n, shard, offset, gb = len(files), 0, 0, 0
+        index = np.zeros((n, 6), dtype=np.int64)
+        f = open(Path(f'{path}.{shard}.shard.tmp'), 'wb')
+        with ThreadPool(num_threads) as pool:
+            pbar = tqdm(enumerate(pool.imap(loader, range(n))), total=n)
+            for i, (img, (h0, w0), (h, w)) in pbar:
+                img = np.ascontiguousarray(img)
+                if offset and offset + img.nbytes > cls.shard_bytes:  # start a new shard
+                    f.close()
+                    os.replace(f.name, f.name[:-4])
+                    shard, offset = shard + 1, 0
+                    f = open(Path(f'{path}.{shard}.shard.tmp'), 'wb')
+                f.write(img.tobytes())
+                index[i] = shard, offset, h, w, h0, w0
+                offset += img.nbytes
+                gb += img.nbytes
+                pbar.desc = f'{prefix}Caching images to disk ({gb / 1E9:.1f}GB, {shard + 1} shards)'
+            pbar.close()
+        f.close()
+        os.replace(f.name, f.name[:-4])
+        x = {'files': files, 'index': index, 'nshards': shard + 1, 'key': key, 'version': cache_version,
+             'fingerprints': {f: get_fingerprint(f, '')[:2] for f in files}}
+        torch.save(x, Path(f'{path}.index'))
+        return cls(path, files, index)
+
+    def shard(self, i):
+        if i not in self.shards:
+            self.shards[i] = np.memmap(Path(f'{self.path}.{i}.shard'), dtype=np.uint8, mode='r')
+        return self.shards[i]
+
+    def get(self, file):
+        # Returns img (read-only view), hw_original, hw_resized
+        shard, offset, h, w, h0, w0 = self.index[self.pos[file]]
+        img = self.shard(shard)[offset:offset + h * w * 3].reshape(h, w, 3)
+        return img, (h0, w0), (h, w)
+
+    def __getstate__(self):  # workers map the shards themselves
+        return {**self.__dict__, 'shards': {}}
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
                  cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='',square=False, tidl_load=False, kpt_label=True):
@@ -398,31 +790,33 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Check cache
         self.label_files = img2label_paths(self.img_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
+        fingerprints = np.array([get_fingerprint(*x) for x in zip(self.img_files, self.label_files)], dtype=np.int64)
         if cache_path.is_file():
             cache, exists = torch.load(cache_path), True  # load
-            if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-                cache, exists = self.cache_labels(cache_path, prefix, self.kpt_label), False  # re-cache
+            if cache.get('version') != cache_version or cache['files'] != self.img_files or \
+                    not np.array_equal(cache['fingerprints'], fingerprints) or \
+                    not cache_path.with_suffix('.labels').is_file():  # changed
+                cache, exists = self.cache_labels(cache_path, prefix, self.kpt_label, fingerprints, cache), False  # re-cache
         else:
-            cache, exists = self.cache_labels(cache_path, prefix, self.kpt_label), False  # cache
+            cache, exists = self.cache_labels(cache_path, prefix, self.kpt_label, fingerprints), False  # cache
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
+        nf, nm, ne, nc, n = cache['results']  # found, missing, empty, corrupted, total
         if exists:
             d = f"Scanning '{cache_path}' images and labels... {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
             tqdm(None, desc=prefix + d, total=n, initial=n)  # display cache results
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {help_url}'
 
-        # Read cache
-        cache.pop('hash')  # remove hash
-        cache.pop('version')  # remove version
-        labels, shapes, self.segments = zip(*cache.values())
-        self.labels = list(labels)
+        # Read cache, labels are mapped from the label store instead of being held per image
+        valid = np.nonzero(cache['status'][:, 3] == 0)[0]  # indices of non-corrupted files
+        store_file = cache.get('store_file', cache_path.with_suffix('.labels'))  # temporary if the cache is read-only
+        self.labels = LabelStore(store_file, cache['store'], index=valid, single_cls=single_cls)
+        shapes = cache['shapes'][valid]
         self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
-        if single_cls:
-            for x in self.labels:
-                x[:, 0] = 0
+        self.img_files = [cache['files'][k] for k in valid]  # update
+        self.label_files = img2label_paths(self.img_files)  # update
+        no_segments = []
+        self.segments = [cache['segments'].get(k, no_segments) for k in valid]
 
         n = len(shapes)  # number of images
         bi = np.floor(np.arange(n) / batch_size).astype(np.int_)  # batch index
@@ -439,7 +833,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             irect = ar.argsort()
             self.img_files = [self.img_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            self.labels = self.labels.take(irect)
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -457,90 +851,101 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             else:
                 self.batch_shapes = (np.array(shapes) * img_size / stride + pad).astype(np.int) * stride
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        self.imgs = [None] * n
-        if cache_images:
-            gb = 0  # Gigabytes of cached images
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            results = ThreadPool(8).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))  # 8 threads
-            pbar = tqdm(enumerate(results), total=n)
+        # or into memory-mapped shards on disk ('disk') that all workers share through the page cache
+        self.imgs, self.img_shards = [None] * n, None
+        if cache_images == 'disk':
+            key = (img_size, augment)  # resized size and interpolation
+            shard_path = cache_path.parent / f'{cache_path.stem}.images{img_size}{"_aug" if augment else ""}'
+            self.img_shards = ImageShards.load(shard_path, self.img_files, key)
+            if self.img_shards is None:
+                self.img_shards = ImageShards.build(shard_path, self.img_files, lambda i: load_image(self, i), key, prefix)
+        elif cache_images:
+            self.cache_ram(range(n), prefix)
+
+    def cache_ram(self, indices, prefix=''):
+        # Cache images indices into memory, e.g. only the shard of a DDP rank
+        gb = 0  # Gigabytes of cached images
+        self.img_hw0, self.img_hw = [None] * len(self.imgs), [None] * len(self.imgs)
+        with ThreadPool(8) as pool:  # 8 threads
+            pbar = tqdm(zip(indices, pool.imap(lambda i: load_image(self, i), indices)), total=len(indices))
             for i, x in pbar:
                 self.imgs[i], self.img_hw0[i], self.img_hw[i] = x  # img, hw_original, hw_resized = load_image(self, i)
                 gb += self.imgs[i].nbytes
                 pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
             pbar.close()
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix='', kpt_label=False):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
-            try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-                #print(lb_file)
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]) and not kpt_label:  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert (l >= 0).all(), 'negative labels'
-                        if kpt_label:
-                            assert l.shape[1] == 26, 'labels require 26 columns each'
-                            assert (l[:, 5::3] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                            assert (l[:, 6::3] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                            # print("l shape", l.shape)
-                            kpts = np.zeros((l.shape[0], 19))
-                            for i in range(len(l)):
-                                kpt = np.delete(l[i,5:], np.arange(2, l.shape[1]-5, 3))  #remove the occlusion paramater from the GT
-                                kpts[i] = np.hstack((l[i, :5], kpt))
-                            l = kpts
-                            assert l.shape[1] == 19, 'labels require 39 columns each after removing occlusion paramater'
-                        else:
-                            assert l.shape[1] == 5, 'labels require 5 columns each'
-                            assert (l[:, 1:5] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', kpt_label=False, fingerprints=None, cache=None):
+        # Cache dataset labels, check images and read shapes. Labels are written to a LabelStore next to the cache,
+        # files whose fingerprints match a previous cache are reused, new or modified files are verified in a process pool
+        n = len(self.img_files)
+        if fingerprints is None:
+            fingerprints = np.array([get_fingerprint(*f) for f in zip(self.img_files, self.label_files)], dtype=np.int64)
+        status = np.zeros((n, 4), dtype=np.int64)  # nm, nf, ne, nc per file
+        shapes = np.zeros((n, 2), dtype=np.int64)
+        labels, visible, segments, todo = [None] * n, [None] * n, {}, []
+        store_path = path.with_suffix('.labels')
+        old = {}
+        if cache and cache.get('version') == cache_version and store_path.is_file():
+            store = LabelStore(store_path, cache['store'])
+            old = {f: k for k, f in enumerate(cache['files'])}
+        for i, (im_file, fp) in enumerate(zip(self.img_files, fingerprints)):
+            k = old.get(im_file)
+            if k is not None and np.array_equal(cache['fingerprints'][k], fp):  # unchanged, reuse
+                status[i], shapes[i] = cache['status'][k], cache['shapes'][k]
+                labels[i], visible[i] = np.array(store[k]), np.array(store.visibility(k))
+                if k in cache['segments']:
+                    segments[i] = cache['segments'][k]
+            else:  # new or changed, verify
+                todo.append(i)
+        if old:
+            del store  # release mapping before the store file is replaced
+
+        nm, nf, ne, nc = status.sum(0)  # number missing, found, empty, corrupted
+        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+        if todo:
+            im_files, lb_files = [self.img_files[i] for i in todo], [self.label_files[i] for i in todo]
+            l, v, offsets, lb_status, segs, errors = parse_labels(lb_files, kpt_label)  # batched
+            with Pool(num_threads) as pool:
+                pbar = tqdm(pool.imap(verify_image, im_files, chunksize=32), desc=desc, total=len(todo))
+                for j, (i, (shape, msg)) in enumerate(zip(todo, pbar)):
+                    msg = msg or errors[j]
+                    if msg:  # corrupted
+                        status[i] = (0, 0, 0, 1) if shape is None else (*lb_status[j], 1)
+                        print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_files[j]}: {msg}')
                     else:
-                        ne += 1  # label empty
-                        # print(lb_file)
-                        l = np.zeros((0, 7 *2 + 5), dtype=np.float32) if kpt_label else np.zeros((0, 5), dtype=np.float32)
-
-                else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 7 *2 + 5), dtype=np.float32) if kpt_label else np.zeros((0, 5), dtype=np.float32)
-
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-        pbar.close()
+                        status[i], shapes[i] = (*lb_status[j], 0), shape
+                        labels[i], visible[i] = l[offsets[j]:offsets[j + 1]], v[offsets[j]:offsets[j + 1]]
+                        if j in segs:
+                            segments[i] = segs[j]
+                    nm, nf, ne, nc = nm + status[i, 0], nf + status[i, 1], ne + status[i, 2], nc + status[i, 3]
+                    pbar.desc = f"{desc} {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
+                pbar.close()
+        logging.info(f'{prefix}Verified {len(todo)} new or changed files, reused {n - len(todo)} cached entries')
 
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
 
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
+        nl, nkpt = (7 * 2 + 5, 7) if kpt_label else (5, 0)  # label columns, keypoints
+        labels = [np.zeros((0, nl), dtype=np.float32) if l is None else l for l in labels]  # corrupted files are empty
+        visible = [np.zeros((0, nkpt), dtype=np.uint8) if v is None else v for v in visible]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(l) for l in labels])
+        x = {'files': self.img_files, 'fingerprints': fingerprints, 'status': status, 'shapes': shapes,
+             'segments': segments}
+        x['results'] = int(nf), int(nm), int(ne), int(nc), n
+        x['version'] = cache_version  # cache version
+        columns = {'labels': np.concatenate(labels, 0).astype(np.float32),
+                   'visible': np.concatenate(visible, 0).astype(np.uint8), 'offsets': offsets}
         try:
+            x['store'] = LabelStore.save(store_path, **columns)
             torch.save(x, path)  # save for next time
             logging.info(f'{prefix}New cache created: {path}')
         except Exception as e:
             logging.info(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # path not writeable
+            if 'store' not in x:  # map the labels from a temp file, one per cache path, overwritten by later runs
+                key = hashlib.md5(str(path.resolve()).encode()).hexdigest()[:16]
+                tmp = Path(tempfile.gettempdir()) / f'{path.stem}-{key}.labels'
+                x['store'], x['store_file'] = LabelStore.save(tmp, **columns), tmp
         return x
 
     def __len__(self):
@@ -691,7 +1096,9 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
-    if img is None:  # not cached
+    if img is None and self.img_shards is not None:  # disk cache
+        return self.img_shards.get(self.img_files[index])
+    elif img is None:  # not cached
         path = self.img_files[index]
         img = cv2.imread(path)  # BGR
         assert img is not None, 'Image Not Found ' + path
@@ -898,34 +1305,12 @@ def replicate(img, labels):
 
 
 def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
-    # Resize and pad image while meeting stride-multiple constraints
-    shape = img.shape[:2]  # current shape [height, width]
-    if isinstance(new_shape, int):
-        new_shape = (new_shape, new_shape)
-
-    # Scale ratio (new / old)
-    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
-    if not scaleup:  # only scale down, do not scale up (for better test mAP)
-        r = min(r, 1.0)
-
-    # Compute padding
-    ratio = r, r  # width, height ratios
-    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
-    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
-    if auto:  # minimum rectangle
-        dw, dh = np.mod(dw, stride), np.mod(dh, stride)  # wh padding
-    elif scaleFill:  # stretch
-        dw, dh = 0.0, 0.0
-        new_unpad = (new_shape[1], new_shape[0])
-        ratio = new_shape[1] / shape[1], new_shape[0] / shape[0]  # width, height ratios
-
-    dw /= 2  # divide padding into 2 sides
-    dh /= 2
-
-    if shape[::-1] != new_unpad:  # resize
+    # Resize and pad image while meeting stride-multiple constraints, see letterbox_into() to write into a buffer
+    new_shape = (new_shape, new_shape) if isinstance(new_shape, int) else tuple(new_shape)  # hashable
+    new_unpad, _, (top, bottom, left, right), ratio, (dw, dh) = \
+        letterbox_geometry(img.shape[:2], new_shape, auto, scaleFill, scaleup, stride)  # cached per input shape
+    if img.shape[1::-1] != new_unpad:  # resize
         img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
-    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
-    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
     img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return img, ratio, (dw, dh)
 
@@ -8,7 +8,6 @@ import platform
 import random
 import re
 import subprocess
-import time
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
@@ -21,7 +20,7 @@ import torchvision
 import yaml
 
 from utils.google_utils import gsutil_getsize
-from utils.metrics import fitness
+from utils.metrics import fitness, kpt_sigmas
 from utils.torch_utils import init_torch_seeds
 
 # Settings
@@ -398,6 +397,18 @@ def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None, kpt_label=False
     return coords
 
 
+def scale_coords_batch(coords, gain, pad, img0_shape, step=2):
+    # Rescale coords [x, y, ...] with a point every step columns from letterboxed to original shapes, for many images
+    # at once and in place. gain (..., 1), pad (..., 2) and img0_shape (..., 2) as (h, w) broadcast against coords
+    gain, pad, img0_shape = (t.to(coords.dtype) for t in (gain, pad, img0_shape))
+    x, y = coords[..., 0::step], coords[..., 1::step]
+    x.sub_(pad[..., 0:1]).div_(gain)
+    y.sub_(pad[..., 1:2]).div_(gain)
+    torch.min(x.clamp_(min=0), img0_shape[..., 1:2], out=x)  # clip
+    torch.min(y.clamp_(min=0), img0_shape[..., 0:1], out=y)
+    return coords
+
+
 def clip_coords(boxes, img_shape, step=2):
     # Clip bounding xyxy bounding boxes to image shape (height, width)
     boxes[:, 0::step].clamp_(0, img_shape[1])  # x1
@@ -483,102 +494,173 @@ def wh_iou(wh1, wh2):
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=(), kpt_label=False, nc=None, nkpt=None):
+                        labels=(), kpt_label=False, nc=None, nkpt=None, max_det=300, nms='iou'):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
     Returns:
-         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls] (+ 3 * nkpt keypoint values if kpt_label)
     """
+    out, n = non_max_suppression_batched(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels,
+                                         kpt_label, nc, nkpt, max_det, nms)
+    return [x[:k] for x, k in zip(out, n.tolist())]
 
-    kps = 7
+
+def non_max_suppression_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, labels=(), kpt_label=False, nc=None, nkpt=None, max_det=300,
+                                nms='iou'):
+    """Runs Non-Maximum Suppression (NMS) on a batch of inference results with a single batched_nms() call
+
+    Boxes of different images and classes are separated by offsetting them with their image and class index, the
+    keypoint payload is carried along in the same rows.
+    nms selects the suppression: 'iou' box IoU NMS, 'oks' keypoint OKS NMS, 'soft-gaussian' or 'soft-linear' Soft-NMS,
+    see pose_nms().
+
+    Returns:
+         (bs, max_det, 6 + 3 * nkpt) tensor of detections [xyxy, conf, cls, kpts] padded with zeros,
+         (bs,) tensor of detections per image
+    """
+    bs, _, no = prediction.shape  # batch size, number of outputs
+    if nkpt is None:
+        nkpt = 7 if kpt_label else 0
     if nc is None:
-        nc = prediction.shape[2] - 5  if not kpt_label else prediction.shape[2] - kps *3 -5 # number of classes
-    xc = prediction[..., 4] > conf_thres  # candidates
+        nc = no - 5 - 3 * nkpt if kpt_label else no - 5  # number of classes
 
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 10.0  # seconds to quit after
-    redundant = True  # require redundant detections
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.batched_nms()
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
-
-    t = time.time()
-    output = [torch.zeros((0,6), device=prediction.device)] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            l = labels[xi]
-            v = torch.zeros((len(l), nc + 5), device=x.device)
-            v[:, :4] = l[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
 
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:5+nc] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            if not kpt_label:
-                conf, j = x[:, 5:].max(1, keepdim=True)
-                x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-            else:
-                kpts = x[:, 6:]
-                conf, j = x[:, 5:6].max(1, keepdim=True)
-                x = torch.cat((box, conf, j.float(), kpts), 1)[conf.view(-1) > conf_thres]
+    bi, ni = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image, anchor index of candidates
+    x = prediction[bi, ni]
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(l) for l in labels):
+        v = torch.zeros((sum(len(l) for l in labels), no), device=x.device)
+        l = torch.cat([l for l in labels if len(l)], 0)
+        v[:, :4] = l[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        bi = torch.cat((bi, torch.cat([torch.full((len(l),), i, device=x.device) for i, l in enumerate(labels)])))
+
+    # Compute conf
+    x[:, 5:5 + nc] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx(6 + 3 * nkpt) (xyxy, conf, cls, kpts)
+    if multi_label:
+        i, j = (x[:, 5:5 + nc] > conf_thres).nonzero(as_tuple=False).T
+        x, bi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float(), x[i, 5 + nc:]), 1), bi[i]
+    else:  # best class only
+        conf, j = x[:, 5:5 + nc].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, bi = torch.cat((box, conf, j.float(), x[:, 5 + nc:]), 1)[i], bi[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, bi = x[i], bi[i]
+
+    # Check shape
+    if x.shape[0] > max_nms * bs:  # excess boxes
+        i = x[:, 4].argsort(descending=True)[:max_nms * bs]  # sort by confidence
+        x, bi = x[i], bi[i]
+
+    # Batched NMS
+    if nms == 'iou':
+        idxs = bi if agnostic else bi * nc + x[:, 5].long()  # image (and class) groups
+        i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], idxs, iou_thres)  # sorted by decreasing score
+        x, bi = x[i], bi[i]
+    else:
+        x, bi = pose_nms(x, bi, bs, iou_thres, conf_thres, nms, agnostic, nkpt if kpt_label else 0)
 
+    # Scatter into (bs, max_det) slots, keeping the best max_det detections per image
+    bi, i = bi.sort(stable=True)  # group by image, scores stay sorted within each image
+    x = x[i]
+    n = torch.bincount(bi, minlength=bs)  # detections per image
+    rank = torch.arange(len(bi), device=x.device) - (n.cumsum(0) - n)[bi]  # position within its image
+    k = rank < max_det
+    output = torch.zeros((bs, max_det, x.shape[1]), device=x.device, dtype=x.dtype)
+    output[bi[k], rank[k]] = x[k]
+    return output, n.clamp(max=max_det)
 
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
 
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
+def pose_nms(x, bi, bs, iou_thres=0.45, conf_thres=0.25, mode='oks', agnostic=False, nkpt=7, max_cand=1000,
+             sigma=0.5):
+    """Keypoint OKS-NMS and Soft-NMS for crowded scenes, where overlapping boxes belong to different animals
 
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
+    The best max_cand candidates of every image are padded to (bs, k) and compared with one (bs, k, k) similarity
+    matrix on device: keypoint OKS of overlapping boxes on the keypoints both see (conf logit > 0), box IoU otherwise.
+    'oks' keeps greedy NMS semantics, solved as a fixed point over the matrix instead of a loop over boxes.
+    'soft-gaussian' and 'soft-linear' decay scores in parallel as in Matrix NMS https://arxiv.org/abs/2003.10152
 
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
+    Arguments:
+        x: (n, 6 + 3 * nkpt) detections [xyxy, conf, cls, kpts], bi: (n,) image index of each detection
 
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            print(f'WARNING: NMS time limit {time_limit}s exceeded')
-            break  # time limit exceeded
+    Returns:
+         kept detections (conf decayed for Soft-NMS) and their image indices, sorted by decreasing conf per image
+    """
+    # Pad the best candidates of each image into (bs, k)
+    i = x[:, 4].argsort(descending=True)
+    bi, j = bi[i].sort(stable=True)
+    x = x[i[j]]
+    n = torch.bincount(bi, minlength=bs)
+    rank = torch.arange(len(bi), device=x.device) - (n.cumsum(0) - n)[bi]
+    k = min(int(n.max()) if bs else 0, max_cand)
+    m = rank < k
+    xp = torch.zeros((bs, k, x.shape[1]), device=x.device, dtype=x.dtype)
+    valid = torch.zeros((bs, k), device=x.device, dtype=torch.bool)
+    xp[bi[m], rank[m]], valid[bi[m], rank[m]] = x[m], True
+
+    # Similarity of every candidate (row) with every lower scored candidate (column) of the same image and class
+    b = xp[..., :4]
+    area = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    inter = (torch.min(b[:, :, None, 2:], b[:, None, :, 2:]) - torch.max(b[:, :, None, :2], b[:, None, :, :2])).clamp(0)
+    sim = inter.prod(3) / (area[:, :, None] + area[:, None] - inter.prod(3) + 1E-7)  # box iou
+    mask = torch.ones((k, k), device=x.device, dtype=torch.bool).triu(1) & valid[:, :, None] & valid[:, None]
+    if not agnostic:
+        mask &= xp[:, :, None, 5] == xp[:, None, :, 5]
+    sim *= mask
+    if nkpt:  # OKS of overlapping pairs only, boxes that do not overlap are not the same animal
+        bj, r, c = (sim > 0).nonzero(as_tuple=True)
+        kr, kc = xp[bj, r, 6:].view(-1, nkpt, 3), xp[bj, c, 6:].view(-1, nkpt, 3)
+        d = ((kr[..., :2] - kc[..., :2]) ** 2).sum(2)
+        v = (kr[..., 2] > 0) & (kc[..., 2] > 0)  # seen by both
+        var = (2 * kpt_sigmas(nkpt, x.device)) ** 2
+        oks = (torch.exp(-d / (2 * var * area[bj, r, None] + 1E-7)) * v).sum(1) / v.sum(1).clamp(min=1)
+        sim[bj, r, c] = torch.where(v.any(1), oks.to(sim.dtype), sim[bj, r, c])
+
+    if mode == 'oks':  # greedy NMS, a candidate is kept if no kept higher scored candidate overlaps it
+        s = sim > iou_thres
+        keep, done = valid, False
+        for j in range(16):  # converges after the longest suppression chain, usually a few iterations
+            new = valid & ~(s & keep[:, :, None]).any(1)
+            if j % 4 == 3 and torch.equal(new, keep):  # device sync every 4 iterations only
+                done = True
+                break
+            keep = new
+        if not done:  # long suppression chain (crowded frame), sequential greedy NMS on CPU instead
+            sc, kc = s.cpu().numpy(), np.zeros((bs, k), dtype=bool)
+            for b, c in zip(*np.nonzero(valid.cpu().numpy())):  # by decreasing score within each image
+                kc[b, c] = not (kc[b, :c] & sc[b, :c, c]).any()
+            keep = torch.from_numpy(kc).to(x.device)
+    elif mode in ('soft-gaussian', 'soft-linear'):  # parallel Soft-NMS
+        comp = sim.max(1)[0][:, :, None]  # max similarity of each row with its own higher scored candidates
+        if mode == 'soft-gaussian':
+            decay = torch.exp(-(sim ** 2 - comp ** 2) / sigma).min(1)[0]
+        else:
+            decay = ((1 - sim) / (1 - comp).clamp(min=1E-7)).min(1)[0]
+        xp[..., 4] *= decay.clamp(max=1)
+        keep = valid & (xp[..., 4] > conf_thres)
+    else:
+        raise ValueError(f'unknown NMS mode {mode}')
 
-    return output
+    # Kept candidates by decreasing (decayed) score
+    i = torch.where(keep, xp[..., 4], xp.new_tensor(-1)).argsort(1, descending=True)
+    xp, keep = xp.gather(1, i[..., None].expand_as(xp)), keep.gather(1, i)
+    return xp[keep], torch.arange(bs, device=x.device)[:, None].expand(bs, k)[keep]
 
 
 def non_max_suppression_export(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
@@ -6,8 +6,11 @@ import torch
 import torch.nn as nn
 
 from utils.general import bbox_iou
+from utils.metrics import kpt_sigmas
 from utils.torch_utils import is_parallel
 
+logger = logging.getLogger(__name__)
+
 
 def to_polar(x, y):
   return (x**2 + y**2).sqrt(), torch.atan(y/(x + 1e-8))
@@ -93,7 +96,7 @@ class QFocalLoss(nn.Module):
 
 class ComputeLoss:
     # Compute losses
-    def __init__(self, model, autobalance=False, kpt_label=False):
+    def __init__(self, model, autobalance=False, kpt_label=False, check_nan=False):
         super(ComputeLoss, self).__init__()
         self.kpt_label = kpt_label
         device = next(model.parameters()).device  # get model device
@@ -105,7 +108,6 @@ class ComputeLoss:
         BCE_kptv = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['obj_pw']], device=device))
         # Class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
         self.cp, self.cn = smooth_BCE(eps=h.get('label_smoothing', 0.0))  # positive, negative BCE targets
-        self.sigmas = [.056, .052, .061, .058, .061, .052, .032, ]
         # Focal loss
         g = h['fl_gamma']  # focal loss gamma
         if g > 0:
@@ -118,16 +120,26 @@ class ComputeLoss:
         self.BCEcls, self.BCEobj, self.gr, self.hyp, self.autobalance = BCEcls, BCEobj, model.gr, h, autobalance
         for k in 'na', 'nc', 'nl', 'anchors', 'nkpt':
             setattr(self, k, getattr(det, k))
-
-    def __call__(self, p, targets, training):  # predictions, targets, model
-        if training:
-            print()
-
+        self.nkpt = self.nkpt or 0  # keypoints per target
+        self.off = torch.tensor([[0, 0],
+                                 [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
+                                 # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
+                                 ], device=device).float() * 0.5  # offsets
+        self.gain = {}  # grid sizes: gains
+        self.sigmas = kpt_sigmas(self.nkpt, device)  # keypoint OKS sigmas
+        self.kpt_var = 4 * self.sigmas ** 2  # (2 * sigma) ** 2
+        # Opt-in NaN/Inf detector, steps with non-finite predictions are counted on device and read by check_anomalies()
+        self.nonfinite = torch.zeros((), dtype=torch.long, device=device) if check_nan else None
+        self.steps = 0
+
+    def __call__(self, p, targets):  # predictions, targets
         device = targets.device
-        nkpt = 7
         lcls, lbox, lobj, lkpt, lkptv = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
 
         tcls, tbox, tkpt, indices, anchors, xyi = self.build_targets(p, targets)  # targets
+        if self.nonfinite is not None:
+            self.nonfinite += torch.stack([~torch.isfinite(pi).all() for pi in p]).any()  # no host sync
+            self.steps += 1
 
         # Losses
         for i, pi in enumerate(p):  # layer index, layer predictions
@@ -137,9 +149,6 @@ class ComputeLoss:
             n = b.shape[0]  # number of targets
             if n:
                 ps = pi[b, a, gj, gi]  # prediction subset corresponding to targets
-
-                if torch.sum(torch.isnan(ps)) > 0 or torch.sum(torch.isinf(ps)) > 0:
-                    input()
                 # Regression
                 pxy = ps[:, :2].sigmoid() * 2. - 0.5
                 pwh = (ps[:, 2:4].sigmoid() * 2) ** 2 * anchors[i]
@@ -163,15 +172,13 @@ class ComputeLoss:
                     # lkpt += ((pkpt_length - tkpt[i][:, 2::3]) ** 2 * xyi[i]).mean()  #Try to make this loss based on distance instead of ordinary difference
                     # oks based loss
                     d = ((pkpt_x-tkpt[i][:, 0::2])**2 + (pkpt_y-tkpt[i][:, 1::2])**2) * kpt_mask
-                    # if not training:
-                    #     input()
                     s = torch.prod(tbox[i][:, -2:], dim=1, keepdim=True)
-                    kpt_loss_factor = (torch.sum(kpt_mask != 0) + torch.sum(kpt_mask == 0))/(torch.sum(kpt_mask != 0) + 1e-8)
+                    kpt_loss_factor = kpt_mask.numel() / (kpt_mask.sum() + 1e-8)
                     # oks based loss
                     # kl = torch.mean(
                     #     (1 - torch.exp(-d / (s * (4 * torch.tensor(self.sigmas, device=device) ** 2) + 1e-9))), dim=0)
                     # improved oks based loss
-                    kl = torch.mean((d / (s * (4 * torch.tensor(self.sigmas, device=device) ** 2))), dim=0)
+                    kl = torch.mean((d / (s * self.kpt_var)), dim=0)
                     kl = kl.mean()
                     lkpt +=kpt_loss_factor * kl
                 # Objectness
@@ -203,77 +210,68 @@ class ComputeLoss:
         loss = lbox + lobj + lcls + lkpt + lkptv
         return loss * bs, torch.cat((lbox, lobj, lcls, lkpt, lkptv, loss)).detach()
 
+    def check_anomalies(self):
+        # Logs and resets the number of steps with NaN/Inf predictions since the last call, a single host sync
+        if self.nonfinite is None:
+            return 0
+        n, steps = int(self.nonfinite), self.steps
+        self.nonfinite.zero_()
+        self.steps = 0
+        if n:
+            logger.warning(f'WARNING: NaN/Inf predictions in {n}/{steps} loss steps')
+        return n
+
+    def gains(self, p):
+        # Returns the (nl, 7 + 2 * nkpt) normalized to gridspace gains of the prediction grids, cached on device
+        key = tuple(tuple(pi.shape[2:4]) for pi in p)  # grid sizes change with multi-scale and rect batches
+        if key not in self.gain:
+            nkpt = self.nkpt if self.kpt_label else 0
+            gain = torch.ones(self.nl, 7 + 2 * nkpt, device=self.anchors.device)
+            gain[:, 2:6 + 2 * nkpt] = torch.tensor([[nx, ny] * (2 + nkpt) for ny, nx in key], device=gain.device)  # xyxy gain
+            self.gain[key] = gain
+        return self.gain[key]
+
     def build_targets(self, p, targets):
-        # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
-
-        nkpt = 7
-        tcls, tbox, tkpt, indices, anch = [], [], [], [], []
-        if self.kpt_label:
-            gain = torch.ones(7 + 2 * nkpt, device=targets.device)  # normalized to gridspace gain
-        else:
-            gain = torch.ones(7, device=targets.device)  # normalized to gridspace gain
+        # Build targets for compute_loss(), input targets(image,class,x,y,w,h,kpts)
+        # All layers, anchors, offsets and keypoints are matched at once with broadcast ops
+        nl, na, nt = self.nl, self.na, targets.shape[0]  # number of layers, anchors, targets
+        nkpt = self.nkpt if self.kpt_label else 0
+        gain = self.gains(p)  # (nl, ncol)
         ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
         targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
+        t = targets[None] * gain[:, None, None]  # (nl, na, nt, ncol)
 
+        # Matches
         g = 0.5  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
-        xyiss = []
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            if self.kpt_label:
-                gain[2:nkpt*2+6] = torch.tensor(p[i].shape)[(2+nkpt)*[3, 2]]  # xyxy gain
-            else:
-                gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain
-            if nt:
-                # Matches
-                r = t[:, :, 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1. / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                l, m = ((gxi % 1. < g) & (gxi > 1.)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gxy = t[:, 2:4]  # grid xy
-            gwh = t[:, 4:6]  # grid wh
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid xy indices
-
-            # Append
-            a = t[:, -1].long()  # anchor indices
-            indices.append((b, a, gj.clamp_(0, (gain[3] - 1).long()), gi.clamp_(0, (gain[2] - 1).long())))  # image, anchor, grid indices
-            tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
-            xyis = []
-            if self.kpt_label:
-                ### kptl = torch.zeros([t.shape[0], nkpt*2], device=t.device).float()
-                for kpt in range(nkpt):
-                    xi = t[:, 6+2*kpt] != 0
-                    yi = t[:, 6+2*kpt + 1] != 0
-                    xyi = torch.bitwise_and(xi, yi)
-                    xyis.append(xyi)
-                    t[xyi, 6+2*kpt: 6+2*(kpt+1)] -= gij[xyi]
-                tkpt.append(t[:, 6:-1])
-            anch.append(anchors[a])  # anchors
-            tcls.append(c)  # class
-            xyiss.append(torch.stack(xyis, dim=1))
-        return tcls, tbox, tkpt, indices, anch, xyiss
-
-#
-
+        r = t[..., 4:6] / self.anchors[:, :, None]  # wh ratio
+        j = torch.max(r, 1. / r).max(3)[0] < self.hyp['anchor_t']  # compare
+
+        # Offsets
+        gxy = t[..., 2:4]  # grid xy
+        gxi = gain[:, None, None, 2:4] - gxy  # inverse
+        jk = ((gxy % 1. < g) & (gxy > 1.)) & j[..., None]
+        lm = ((gxi % 1. < g) & (gxi > 1.)) & j[..., None]
+        j = torch.stack((j, jk[..., 0], jk[..., 1], lm[..., 0], lm[..., 1]), 1)  # (nl, 5, na, nt)
+        li = torch.arange(nl, device=targets.device).view(nl, 1, 1, 1).expand_as(j)[j]  # layer index
+        offsets = (torch.zeros_like(gxy)[:, None] + self.off[None, :, None, None])[j]
+        t = t[:, None].expand(-1, 5, -1, -1, -1)[j]
+
+        # Define
+        b, c = t[:, :2].long().T  # image, class
+        gxy = t[:, 2:4]  # grid xy
+        gwh = t[:, 4:6]  # grid wh
+        gij = torch.min((gxy - offsets).long().clamp_(min=0), (gain[li, 2:4] - 1).long())  # grid xy indices
+        gi, gj = gij.T
+        a = t[:, -1].long()  # anchor indices
+        tbox = torch.cat((gxy - gij, gwh), 1)  # box
+
+        # Keypoints relative to the grid cell, only for labelled (non-zero) keypoints
+        kpt = t[:, 6:6 + 2 * nkpt].view(-1, nkpt, 2)
+        xyi = (kpt != 0).all(2)  # (n, nkpt) labelled keypoints
+        tkpt = (kpt - gij[:, None] * xyi[..., None]).view(-1, 2 * nkpt)
+
+        # Split per layer
+        n = j.sum((1, 2, 3)).tolist()  # targets per layer
+        indices = list(zip(*(x.split(n) for x in (b, a, gj, gi))))  # image, anchor, grid indices
+        tcls, tbox, tkpt, anch, xyi = (x.split(n) for x in (c, tbox, tkpt, self.anchors[li, a], xyi))
+        return list(tcls), list(tbox), list(tkpt), indices, list(anch), list(xyi)
@@ -9,6 +9,113 @@ import torch
 from . import general
 
 
+mouse_kpt_sigmas = [.056, .052, .061, .058, .061, .052, .032]  # OKS sigmas of the 7 mouse keypoints
+
+
+def kpt_sigmas(nkpt=7, device=None):
+    # Returns the per-keypoint OKS sigmas as a tensor, the mouse sigmas for 7 keypoints and uniform sigmas otherwise
+    return torch.tensor(mouse_kpt_sigmas if nkpt == 7 else [1 / max(nkpt, 1)] * nkpt, device=device)
+
+
+class PoseMetrics:
+    # Matches the detections of whole batches to their labels and accumulates box matches, keypoint PCK and keypoint
+    # distances on device. Nothing is read back before compute(), a single host sync per validation run.
+    # PCK counts the labelled keypoints closer to their target than a fraction of the target box diagonal.
+    # All state is fixed-size counts, binned by confidence for the boxes, so partial results of dataset shards
+    # merge() by addition and reduce() over DDP ranks with one all_reduce per tensor
+    def __init__(self, nkpt=7, iouv=None, pck_thres=(0.02, 0.04, 0.06, 0.08, 0.1, 0.12, 0.14, 0.16, 0.18, 0.2),
+                 pck_kpt_thres=0.1, nc=1, nbins=1000, device='cpu'):
+        self.nkpt, self.nc, self.nbins = nkpt, nc, nbins
+        self.iouv = torch.linspace(0.5, 0.95, 10, device=device) if iouv is None else iouv  # iou vector for mAP
+        self.pck_thres = torch.tensor(pck_thres, device=device)
+        self.kpt_thres_index = list(pck_thres).index(pck_kpt_thres)
+        self.hist = torch.zeros((nkpt, len(pck_thres) + 1), device=device)  # pck histogram per keypoint
+        self.dist = torch.zeros(nkpt, device=device)  # summed keypoint distances of matched detections
+        self.matched = torch.zeros((), device=device)  # matched detections
+        self.tp = torch.zeros((nc, nbins, len(self.iouv)), device=device)  # true positives per class and conf bin
+        self.npred = torch.zeros((nc, nbins), device=device)  # detections per class and conf bin
+        self.nt = torch.zeros(nc, device=device)  # labels per class
+        self.seen = torch.zeros((), device=device)  # images
+
+    def state(self):
+        # Accumulated tensors, in a fixed order for merge() and reduce()
+        return self.hist, self.dist, self.matched, self.tp, self.npred, self.nt, self.seen
+
+    def process_batch(self, detections, n, labels):
+        """
+        Greedy matching in confidence order, every label is matched by its first detection of the same class with
+        the label as best IoU > 0.5. Both sets are in native image space.
+        Arguments:
+            detections (Array[B, D, 6 + 3 * nkpt]), zero-padded x1, y1, x2, y2, conf, class, keypoints (x, y, conf)
+            n (Array[B]), number of detections per image
+            labels (Array[M, 6 + 2 * nkpt]), image, class, x1, y1, x2, y2, keypoints (x, y), unlabelled at (0, 0)
+        Returns:
+            None, updates the statistics accordingly
+        """
+        bs, nd = detections.shape[:2]
+        device = detections.device
+        d = torch.arange(nd, device=device).expand(bs, nd)  # detection index
+        valid = d < n[:, None]
+        correct = torch.zeros((bs, nd, len(self.iouv)), dtype=torch.bool, device=device)
+        if len(labels):
+            iou = general.box_iou(detections[..., :4].reshape(-1, 4), labels[:, 2:6]).view(bs, nd, -1)
+            iou *= (labels[:, 0] == torch.arange(bs, device=device)[:, None, None]) & \
+                   (labels[:, 1] == detections[..., 5:6]) & valid[..., None]  # same image and class
+            best, t = iou.max(2)  # best label per detection
+            first = torch.full((len(labels),), nd, device=device).scatter_reduce_(
+                0, t.view(-1), torch.where(best > self.iouv[0], d, nd).view(-1), 'amin')  # first detection per label
+            match = (best > self.iouv[0]) & (first[t] == d)
+            correct = match[..., None] & (best[..., None] > self.iouv)
+
+            if self.nkpt:
+                lt = labels[t]  # (B, D, 6 + 2 * nkpt) label of every detection
+                pk, tk = detections[..., 6:].view(bs, nd, -1, 3)[..., :2], lt[..., 6:].view(bs, nd, -1, 2)
+                dist = ((pk - tk) ** 2).sum(3).sqrt() * (tk != 0).any(3)  # labelled keypoints only
+                pck = dist / ((lt[..., 4:6] - lt[..., 2:4]) ** 2).sum(2, keepdim=True).sqrt()  # / box diagonal
+                w = match[..., None] & (pck > 0)
+                i = torch.bucketize(pck, self.pck_thres, right=True)  # pck bin, pck < thres[j] for bins <= j
+                i += torch.arange(self.nkpt, device=device) * self.hist.shape[1]
+                self.hist.view(-1).index_add_(0, i.view(-1), w.view(-1).float())
+                self.dist += (dist * match[..., None]).sum((0, 1))
+                self.matched += match.sum()
+
+        # Confidence-binned counts
+        b = (detections[..., 4] * self.nbins).long().clamp_(0, self.nbins - 1)  # conf bin
+        i = (detections[..., 5].long().clamp_(0, self.nc - 1) * self.nbins + b).view(-1)  # class, conf bin index
+        self.npred.view(-1).index_add_(0, i, valid.view(-1).float())
+        self.tp.view(-1, len(self.iouv)).index_add_(0, i, (correct & valid[..., None]).view(-1, len(self.iouv)).float())
+        self.nt.index_add_(0, labels[:, 1].long(), torch.ones_like(labels[:, 1]))
+        self.seen += bs
+
+    def merge(self, other):
+        # Adds the counts of another accumulator, i.e. of another dataset shard or worker process
+        for a, b in zip(self.state(), other.state()):
+            a += b.to(a.device)
+        return self
+
+    def reduce(self):
+        # Sums the counts over all DDP ranks, every rank ends up with the metrics of the whole dataset
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            for x in self.state():
+                torch.distributed.all_reduce(x)
+        return self
+
+    def compute(self, plot=False, save_dir='.', names=()):
+        """
+        Returns:
+            (p, r, ap, f1, ap_class) as ap_per_class(), labels per class, keypoint mse,
+            PCK per keypoint at pck_kpt_thres and PCK of all keypoints per pck_thres
+        """
+        tp, npred, nt = self.tp.cpu().numpy(), self.npred.cpu().numpy(), self.nt.cpu().numpy()
+        hist, dist, matched = self.hist.cpu(), self.dist.cpu(), float(self.matched)
+        total = hist.sum(1)  # counted keypoints
+        pck_kpt = hist.cumsum(1)[:, self.kpt_thres_index] / (total + 1e-8)
+        pck = hist.cumsum(1)[:, :-1].sum(0) / (total.sum() + 1e-8)
+        mse = float(dist.mean() / (matched + 1e-8)) if self.nkpt else 0.
+        results = ap_per_class_binned(tp, npred, nt, plot=plot, save_dir=save_dir, names=names)
+        return results, nt.astype(np.int64), mse, pck_kpt.tolist(), pck.tolist()
+
+
 def fitness(x):
     # Model fitness as a weighted combination of metrics
     w = [0.0, 0.0, 0.6, 0.4]  # weights for [P, R, mAP@0.5, mAP@0.5:0.95]
@@ -78,6 +185,68 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
     return p[:, i], r[:, i], ap, f1[:, i], unique_classes.astype('int32')
 
 
+def ap_per_class_binned(tp, n, nt, plot=False, save_dir='.', names=()):
+    """ ap_per_class() on confidence-binned counts, as accumulated by PoseMetrics.
+    Detections within a bin share the bin centre as confidence, the curves have one point per non-empty bin.
+    # Arguments
+        tp:  True positives per class and confidence bin (nparray, nc x nbins x 10).
+        n:  Detections per class and confidence bin (nparray, nc x nbins).
+        nt:  Labels per class (nparray, nc).
+        plot:  Plot precision-recall curve at mAP@0.5
+        save_dir:  Plot save directory
+    # Returns
+        The average precision as computed in py-faster-rcnn.
+    """
+
+    # Bins in descending confidence
+    nbins = n.shape[1]
+    tp, n, conf = tp[:, ::-1], n[:, ::-1], (np.arange(nbins, 0, -1) - 0.5) / nbins
+
+    # Classes with labels
+    unique_classes = np.nonzero(nt)[0]
+    nc = unique_classes.shape[0]  # number of classes
+
+    # Create Precision-Recall curve and compute AP for each class
+    px, py = np.linspace(0, 1, 1000), []  # for plotting
+    ap, p, r = np.zeros((nc, tp.shape[2])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
+    for ci, c in enumerate(unique_classes):
+        i = n[c] > 0  # non-empty bins
+        n_l = nt[c]  # number of labels
+        n_p = n[c].sum()  # number of predictions
+
+        if n_p == 0 or n_l == 0:
+            continue
+        else:
+            # Accumulate FPs and TPs
+            tpc = tp[c, i].cumsum(0)
+            fpc = (n[c, i, None] - tp[c, i]).cumsum(0)
+
+            # Recall
+            recall = tpc / (n_l + 1e-16)  # recall curve
+            r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)  # negative x, xp because xp decreases
+
+            # Precision
+            precision = tpc / (tpc + fpc)  # precision curve
+            p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)  # p at pr_score
+
+            # AP from recall-precision curve
+            for j in range(tp.shape[2]):
+                ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j])
+                if plot and j == 0:
+                    py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+
+    # Compute F1 (harmonic mean of precision and recall)
+    f1 = 2 * p * r / (p + r + 1e-16)
+    if plot:
+        plot_pr_curve(px, py, ap, Path(save_dir) / 'PR_curve.png', names)
+        plot_mc_curve(px, f1, Path(save_dir) / 'F1_curve.png', names, ylabel='F1')
+        plot_mc_curve(px, p, Path(save_dir) / 'P_curve.png', names, ylabel='Precision')
+        plot_mc_curve(px, r, Path(save_dir) / 'R_curve.png', names, ylabel='Recall')
+
+    i = f1.mean(0).argmax()  # max F1 index
+    return p[:, i], r[:, i], ap, f1[:, i], unique_classes.astype('int32')
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves
     # Arguments
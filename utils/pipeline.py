@@ -0,0 +1,132 @@
+# Threaded stage pipeline for streaming inference, e.g. decode -> preprocess -> inference -> postprocess -> draw/encode
+# Video decode/encode (OpenCV) and torch ops release the GIL, so the stages overlap on a multi-core CPU box
+
+import queue
+import threading
+import time
+
+END = object()  # end-of-stream marker passed down the queues
+
+
+class Stage:
+    # One pipeline stage: fn applied to every item, with busy time and input queue depth statistics
+    def __init__(self, name, fn):
+        self.name, self.fn = name, fn
+        self.n, self.t = 0, 0.0  # items, busy seconds
+        self.depth, self.max_depth = 0, 0  # summed and max input queue depth, sampled on every get
+
+    def __call__(self, x):
+        t = time.perf_counter()
+        y = self.fn(x)
+        self.t += time.perf_counter() - t
+        self.n += 1
+        return y
+
+    def sample(self, q):
+        d = q.qsize()
+        self.depth += d
+        self.max_depth = max(self.max_depth, d)
+
+
+class Pipeline:
+    # Runs source -> stages[0] -> ... -> stages[-1], each stage on its own thread and connected by bounded queues of
+    # maxsize items. The source (an iterable) is read on its own thread too, and the last stage runs on the calling
+    # thread (so it may use cv2.imshow). One thread per stage keeps items in source order.
+    # maxsize=0 runs everything sequentially on the calling thread, with the same statistics
+    def __init__(self, source, stages, maxsize=4, source_name='decode'):
+        self.source = source
+        self.stages = [Stage(source_name, next)] + [Stage(name, fn) for name, fn in stages]
+        self.maxsize = maxsize
+        self.stop = threading.Event()
+        self.error = None
+        self.t = 0.0  # wall time of run()
+
+    def run(self):
+        t = time.perf_counter()
+        try:
+            if self.maxsize > 0:
+                self._run_threaded()
+            else:
+                it = iter(self.source)
+                while True:
+                    try:
+                        x = self.stages[0](it)
+                    except StopIteration:
+                        break
+                    for s in self.stages[1:]:
+                        x = s(x)
+        finally:
+            self.t = time.perf_counter() - t
+        return self
+
+    def _run_threaded(self):
+        queues = [queue.Queue(self.maxsize) for _ in self.stages[1:]]  # queues[i] feeds stages[i + 1]
+        threads = [threading.Thread(target=self._source, args=(queues[0],), daemon=True)]
+        threads += [threading.Thread(target=self._worker, args=(s, q, q_next), daemon=True)
+                    for s, q, q_next in zip(self.stages[1:-1], queues, queues[1:])]
+        for th in threads:
+            th.start()
+        try:
+            last = self.stages[-1]
+            while True:
+                x = self._get(queues[-1], last)
+                if x is END:
+                    break
+                last(x)
+        finally:
+            self.stop.set()  # unblocks the workers if the last stage raised
+            for th in threads:
+                th.join()
+        if self.error is not None:
+            raise self.error
+
+    def _source(self, q):
+        try:
+            it = iter(self.source)
+            while not self.stop.is_set():
+                self._put(q, self.stages[0](it))
+        except StopIteration:
+            pass
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._put(q, END)
+
+    def _worker(self, stage, q, q_next):
+        try:
+            while True:
+                x = self._get(q, stage)
+                if x is END:
+                    break
+                self._put(q_next, stage(x))
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._put(q_next, END)
+
+    def _get(self, q, stage):
+        stage.sample(q)
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return END
+
+    def _put(self, q, x):
+        while not self.stop.is_set():
+            try:
+                return q.put(x, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def summary(self):
+        # Per-stage timings and input queue depths. The slowest stage bounds throughput when threaded
+        n = max(self.stages[-1].n, 1)
+        s = f"{'stage':>12s}{'items':>8s}{'ms/item':>10s}{'busy':>8s}{'queue mean':>12s}{'queue max':>11s}\n"
+        for i, st in enumerate(self.stages):
+            q = (f'{st.depth / max(st.n, 1):12.2f}{st.max_depth:8d}/{self.maxsize:<2d}' if i and self.maxsize > 0
+                 else f"{'-':>12s}{'-':>11s}")
+            s += f'{st.name:>12s}{st.n:8d}{st.t * 1E3 / max(st.n, 1):10.1f}{st.t / max(self.t, 1E-9):8.0%}{q}\n'
+        return s + f'{n} items in {self.t:.3f}s ({n / max(self.t, 1E-9):.1f} items/s, ' \
+                   f"{'threaded, queue size %g' % self.maxsize if self.maxsize > 0 else 'sequential'})"
@@ -0,0 +1,88 @@
+"""
+Load generator for the pose detection server: posts images from concurrent clients and reports throughput, latency
+and the server's batching
+
+Usage:
+    $ python utils/pose_server/load_test.py --source data/images --concurrency 1 4 16 --requests 200
+"""
+import argparse
+import glob
+import http.client
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+
+IMG_FORMATS = 'bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo'
+
+
+def client(url, images, n, fmt):
+    # One keep-alive connection posting n images, returns request latencies (s)
+    u = urlsplit(url)
+    conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=60)
+    latency = []
+    try:
+        for i in range(n):
+            t = time.perf_counter()
+            conn.request('POST', f'{u.path}?format={fmt}', body=images[i % len(images)],
+                         headers={'Content-Type': 'application/octet-stream'})
+            r = conn.getresponse()
+            r.read()
+            assert r.status == 200, f'HTTP {r.status}'
+            latency.append(time.perf_counter() - t)
+    finally:
+        conn.close()
+    return latency
+
+
+def get_metrics(url):
+    u = urlsplit(url)
+    conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=10)
+    try:
+        conn.request('GET', '/metrics')
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def run(url, images, concurrency, requests, fmt):
+    # requests split over concurrency clients. Server batching is the difference of its metrics before and after
+    m0 = get_metrics(url)
+    t = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        n = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+        latency = sum(pool.map(lambda k: client(url, images, k, fmt), n), [])
+    t = time.perf_counter() - t
+    m1 = get_metrics(url)
+    batches = max(m1['batches'] - m0['batches'], 1)
+    ms = np.percentile(np.array(latency) * 1E3, (50, 90, 99))
+    print(f'{concurrency:12d}{len(latency):10d}{len(latency) / t:10.1f}{ms[0]:10.1f}{ms[1]:10.1f}{ms[2]:10.1f}'
+          f'{(m1["images"] - m0["images"]) / batches:12.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for utils/pose_server/server.py')
+    parser.add_argument('--url', default='http://localhost:5000/v1/pose-detection', help='detection endpoint')
+    parser.add_argument('--source', type=str, default='data/images', help='image file, directory or glob')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per concurrency level')
+    parser.add_argument('--format', default='json', choices=['json', 'bin'], help='response format')
+    opt = parser.parse_args()
+
+    p = opt.source
+    files = sorted(glob.glob(p, recursive=True) if '*' in p else glob.glob(os.path.join(p, '*.*')) if
+                   os.path.isdir(p) else [p])
+    files = [f for f in files if f.split('.')[-1].lower() in IMG_FORMATS]
+    assert files, f'No images found in {p}'
+    images = []
+    for f in files:
+        with open(f, 'rb') as file:
+            images.append(file.read())
+
+    print(f"{'concurrency':>12s}{'requests':>10s}{'req/s':>10s}{'p50 ms':>10s}{'p90 ms':>10s}{'p99 ms':>10s}"
+          f"{'batch size':>12s}")
+    for c in opt.concurrency:
+        run(opt.url, images, c, opt.requests, opt.format)
@@ -0,0 +1,247 @@
+"""
+Run an asynchronous HTTP inference server for pose (keypoint) detection checkpoints
+
+Concurrent requests are coalesced into micro-batches of up to --max-batch images, waiting at most --max-wait ms for
+a batch to fill, so the model does not idle between one-at-a-time requests. Standard library asyncio only.
+
+Usage:
+    $ python utils/pose_server/server.py --weights best.pt --img-size 640 --port 5000
+    $ curl -X POST --data-binary @mouse.jpg http://localhost:5000/v1/pose-detection
+    $ curl http://localhost:5000/metrics
+"""
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.append(Path(__file__).parent.parent.parent.absolute().__str__())  # to run '$ python *.py' files in subdirectories
+
+import cv2
+import numpy as np
+import torch
+
+from models.experimental import attempt_load
+from utils.general import check_img_size, non_max_suppression, scale_coords, set_logging
+from utils.preprocess import letterbox_into
+from utils.torch_utils import select_device
+
+DETECTION_URL = '/v1/pose-detection'
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+          413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class Metrics:
+    # Request, batch and latency counters. Latency percentiles over the last n requests
+    def __init__(self, n=1000):
+        self.t0 = time.time()
+        self.requests, self.errors, self.images, self.batches = 0, 0, 0, 0
+        self.latency, self.wait = collections.deque(maxlen=n), collections.deque(maxlen=n)  # seconds
+        self.inference = collections.deque(maxlen=n)  # seconds per batch
+        self.sizes = collections.Counter()  # batch size histogram
+
+    def as_dict(self):
+        t = time.time() - self.t0
+        ms = lambda x, p: round(float(np.percentile(x, p)) * 1E3, 2) if len(x) else None
+        return {'uptime_s': round(t, 1), 'requests': self.requests, 'errors': self.errors, 'images': self.images,
+                'batches': self.batches, 'images_per_s': round(self.images / max(t, 1E-9), 2),
+                'mean_batch_size': round(self.images / max(self.batches, 1), 2),
+                'batch_sizes': dict(sorted(self.sizes.items())),
+                'latency_ms': {f'p{p}': ms(self.latency, p) for p in (50, 90, 99)},
+                'queue_wait_ms': {f'p{p}': ms(self.wait, p) for p in (50, 90, 99)},
+                'inference_ms_per_batch': {f'p{p}': ms(self.inference, p) for p in (50, 90, 99)}}
+
+
+class BatchedModel:
+    # Micro-batching front of a pose model: submit() one image, get its detections. Batches run on one worker thread,
+    # the next batch collects the requests that arrive meanwhile
+    def __init__(self, opt):
+        self.device = select_device(opt.device)
+        self.half = self.device.type != 'cpu'  # half precision only supported on CUDA
+        self.model = attempt_load(opt.weights, map_location=self.device).eval()
+        if self.half:
+            self.model.half()
+        self.stride = int(self.model.stride.max())
+        self.imgsz = check_img_size(opt.img_size, s=self.stride)
+        self.names = self.model.module.names if hasattr(self.model, 'module') else self.model.names
+        self.nkpt = self.model.model[-1].nkpt or 0
+        self.max_batch, self.max_wait = opt.max_batch, opt.max_wait / 1E3
+        self.conf_thres, self.iou_thres, self.nms = opt.conf_thres, opt.iou_thres, opt.nms
+        self.buffer = np.zeros((self.max_batch, 3, self.imgsz, self.imgsz), dtype=np.uint8)  # letterboxed batch
+        self.executor = ThreadPoolExecutor(1)  # model, one batch at a time
+        self.metrics = Metrics()
+        self.queue = None
+
+    async def submit(self, img):
+        # (n, 6 + 3 * nkpt) detections [xyxy, conf, cls, kpts] of HWC BGR img, in img pixels
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        # Batching loop: first request opens a batch, which closes when full or max_wait after it was opened
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait() if not self.queue.empty() else
+                                 await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+            t = time.perf_counter()
+            self.metrics.wait.extend(t - t0 for _, _, t0 in batch)
+            try:
+                out = await loop.run_in_executor(self.executor, self.infer, [img for img, _, _ in batch])
+            except Exception as e:  # fail this batch only
+                out = [e] * len(batch)
+            self.metrics.inference.append(time.perf_counter() - t)
+            self.metrics.batches += 1
+            self.metrics.images += len(batch)
+            self.metrics.sizes[len(batch)] += 1
+            for (_, future, _), y in zip(batch, out):
+                if not future.done():  # client may have gone
+                    future.set_exception(y) if isinstance(y, Exception) else future.set_result(y)
+
+    @torch.no_grad()
+    def infer(self, imgs):
+        n = len(imgs)
+        for img, x in zip(imgs, self.buffer):
+            letterbox_into(img, x, self.imgsz, auto=False)
+        x = torch.from_numpy(self.buffer[:n]).to(self.device)
+        x = (x.half() if self.half else x.float()) / 255.0
+        pred = non_max_suppression(self.model(x)[0], self.conf_thres, self.iou_thres, kpt_label=self.nkpt > 0,
+                                   nkpt=self.nkpt, nms=self.nms)
+        for img, det in zip(imgs, pred):
+            scale_coords(x.shape[2:], det[:, :4], img.shape)
+            scale_coords(x.shape[2:], det[:, 6:], img.shape, kpt_label=self.nkpt > 0, step=3)
+        return [det.float().cpu().numpy() for det in pred]
+
+
+def decode(body, content_type):
+    # Image bytes of a raw (image/*, application/octet-stream) or multipart form ('image' field) body
+    if content_type.startswith('multipart/form-data'):
+        msg = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        parts = [p for p in msg.get_payload() if p.get_param('name', header='content-disposition') == 'image']
+        body = parts[0].get_payload(decode=True) if parts else b''
+    img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR) if body else None
+    if img is None:
+        raise ValueError('no decodable image in request')
+    return img
+
+
+def encode(det, shape, names, nkpt, fmt='json'):
+    # Compact response: JSON rows [x1, y1, x2, y2, conf, cls, kx1, ky1, kconf1, ...] rounded to 0.01 pixel, or the raw
+    # float32 (n, 6 + 3 * nkpt) little-endian array for fmt='bin'
+    if fmt == 'bin':
+        return np.ascontiguousarray(det, dtype='<f4').tobytes(), 'application/octet-stream'
+    body = {'shape': list(shape[:2]), 'nkpt': nkpt, 'names': {int(c): names[int(c)] for c in set(det[:, 5])},
+            'detections': np.round(det.astype(np.float64), 2).tolist()}  # short float reprs
+    return json.dumps(body, separators=(',', ':')).encode(), 'application/json'
+
+
+async def handle(reader, writer, model, executor, max_body):
+    # One HTTP/1.1 connection, keep-alive
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                break
+            t = time.perf_counter()
+            try:
+                method, target, version = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+            except ValueError:  # not HTTP
+                break
+            headers = {k.strip().lower(): v.strip() for k, v in
+                       (line.split(':', 1) for line in head.decode('latin-1').split('\r\n')[1:] if ':' in line)}
+            length = headers.get('content-length', '0')
+            length = int(length) if length.isdigit() else -1
+            if 'transfer-encoding' in headers:  # chunked bodies not supported, answer and close
+                status, body, ctype = 411, b'{"error":"Content-Length required"}', 'application/json'
+                headers['connection'] = 'close'
+            elif length < 0:  # body framing unknown, answer and close
+                status, body, ctype = 400, b'{"error":"invalid Content-Length"}', 'application/json'
+                headers['connection'] = 'close'
+            elif length > max_body:
+                status, body, ctype = 413, b'{"error":"image too large"}', 'application/json'
+                headers['connection'] = 'close'
+            else:
+                try:
+                    body = await reader.readexactly(length) if length else b''
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):  # client gone
+                    break
+                url = urlsplit(target)
+                status, body, ctype = await route(method, url.path, parse_qs(url.query), headers, body, model, executor)
+                if url.path == DETECTION_URL:
+                    model.metrics.requests += 1
+                    model.metrics.errors += status != 200
+                    if status == 200:
+                        model.metrics.latency.append(time.perf_counter() - t)
+            close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+            writer.write(f"HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}"
+                         f"\r\nConnection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + body)
+            await writer.drain()
+            if close:
+                break
+    finally:
+        writer.close()
+
+
+async def route(method, path, query, headers, body, model, executor):
+    # Returns status, body, content type
+    if path == '/metrics' and method == 'GET':
+        return 200, json.dumps(model.metrics.as_dict()).encode(), 'application/json'
+    if path != DETECTION_URL:
+        return 404, b'{"error":"not found"}', 'application/json'
+    if method != 'POST':
+        return 405, b'{"error":"POST an image"}', 'application/json'
+    loop = asyncio.get_running_loop()
+    try:
+        img = await loop.run_in_executor(executor, decode, body, headers.get('content-type', ''))
+    except Exception as e:
+        return 400, json.dumps({'error': str(e)}).encode(), 'application/json'
+    try:
+        det = await model.submit(img)
+    except Exception as e:  # the batch failed, counted as an error by handle()
+        return 500, json.dumps({'error': f'inference failed: {e}'}).encode(), 'application/json'
+    fmt = query.get('format', ['bin' if headers.get('accept') == 'application/octet-stream' else 'json'])[0]
+    return (200, *encode(det, img.shape, model.names, model.nkpt, fmt))
+
+
+async def serve(opt):
+    model = BatchedModel(opt)
+    executor = ThreadPoolExecutor(opt.workers)  # image decoding, cv2 releases the GIL
+    batcher = asyncio.create_task(model.run())
+    server = await asyncio.start_server(lambda r, w: handle(r, w, model, executor, opt.max_body * 2 ** 20),
+                                        opt.host, opt.port)
+    print(f'Serving {opt.weights} on http://{opt.host}:{opt.port}{DETECTION_URL} (metrics on /metrics), '
+          f'batches of up to {opt.max_batch} within {opt.max_wait:g} ms')
+    async with server:
+        await asyncio.gather(server.serve_forever(), batcher)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Asynchronous micro-batching HTTP API exposing a pose model')
+    parser.add_argument('--weights', type=str, default='yolov5s.pt', help='model.pt path')
+    parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='object confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--nms', default='iou', choices=['iou', 'oks', 'soft-gaussian', 'soft-linear'], help='NMS mode')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--max-batch', type=int, default=8, help='max images per inference batch')
+    parser.add_argument('--max-wait', type=float, default=10, help='max wait (ms) for a batch to fill')
+    parser.add_argument('--workers', type=int, default=4, help='image decoding threads')
+    parser.add_argument('--max-body', type=float, default=32, help='max request size (MB)')
+    parser.add_argument('--host', default='0.0.0.0', help='host address')
+    parser.add_argument('--port', default=5000, type=int, help='port number')
+    opt = parser.parse_args()
+    set_logging()
+    asyncio.run(serve(opt))
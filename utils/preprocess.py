@@ -0,0 +1,91 @@
+# Letterbox preprocessing into caller-owned buffers: resize, pad, BGR to RGB, HWC to CHW and scaling in one pass
+# Depends on cv2 and numpy only, so deployment scripts (onnx_inference/) can share it without torch
+
+import threading
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+_scratch = threading.local()  # per-thread resize buffers, keyed by resized shape
+
+
+def _buffer(shape, dtype):
+    # Scratch array reused per thread, shape and dtype
+    buffers = _scratch.__dict__.setdefault('buffers', {})
+    key = tuple(shape), np.dtype(dtype)
+    if key not in buffers:
+        buffers[key] = np.empty(shape, dtype=dtype)
+    return buffers[key]
+
+
+@lru_cache(maxsize=64)
+def letterbox_geometry(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Resize and pad geometry of letterbox() for an input (height, width), cached per input resolution.
+    # Returns resized (w, h), padded (h, w), border (top, bottom, left, right), ratio (w, h) and padding (dw, dh)
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+
+    # Scale ratio (new / old)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    if not scaleup:  # only scale down, do not scale up (for better test mAP)
+        r = min(r, 1.0)
+
+    # Compute padding
+    ratio = r, r  # width, height ratios
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
+    if auto:  # minimum rectangle
+        dw, dh = np.mod(dw, stride), np.mod(dh, stride)  # wh padding
+    elif scaleFill:  # stretch
+        dw, dh = 0.0, 0.0
+        new_unpad = (new_shape[1], new_shape[0])
+        ratio = new_shape[1] / shape[1], new_shape[0] / shape[0]  # width, height ratios
+
+    dw /= 2  # divide padding into 2 sides
+    dh /= 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    padded = new_unpad[1] + top + bottom, new_unpad[0] + left + right
+    return new_unpad, padded, (top, bottom, left, right), ratio, (dw, dh)
+
+
+def letterbox_into(img, out, new_shape=(640, 640), color=(114, 114, 114), auto=False, scaleFill=False, scaleup=True,
+                   stride=32, bgr2rgb=True, mean=0., scale=None):
+    # Letterboxes HWC img into out, a (3,h,w) uint8 or float32 array (e.g. one image of a preallocated batch).
+    # float32 out gets (x - mean) * scale. Scratch arrays are reused per thread and shape, and the border is filled
+    # through views of out. Returns ratio (w, h) and padding (dw, dh) like letterbox()
+    new_shape = (new_shape, new_shape) if isinstance(new_shape, int) else tuple(new_shape)  # hashable
+    new_unpad, padded, (top, bottom, left, right), ratio, pad = \
+        letterbox_geometry(img.shape[:2], new_shape, auto, scaleFill, scaleup, stride)
+    assert out.shape == (3, *padded), f'output buffer {out.shape} does not match letterbox shape {(3, *padded)}'
+
+    if img.shape[1::-1] != new_unpad:  # resize
+        img = cv2.resize(img, new_unpad, dst=_buffer(new_unpad[::-1] + img.shape[2:], img.dtype),
+                         interpolation=cv2.INTER_LINEAR)
+    if bgr2rgb:
+        color = color[::-1]
+
+    # Border, as views of out
+    h, w = out.shape[1:]
+    fill = np.asarray(color, dtype=np.float32)[:, None, None]
+    if out.dtype.kind == 'f':
+        fill = (fill - mean) * (1 if scale is None else scale)
+    for view in out[:, :top], out[:, h - bottom:], out[:, top:h - bottom, :left], out[:, top:h - bottom, w - right:]:
+        view[:] = fill
+
+    # Image, channel planes written by cv2.split() (much faster than a strided numpy copy) into uint8 views of out,
+    # or into a scratch array converted with (x - mean) * scale for float out
+    dst = out[:, top:h - bottom, left:w - right]
+    chw = dst if out.dtype == img.dtype else _buffer((3, *new_unpad[::-1]), img.dtype)
+    planes = [chw[2], chw[1], chw[0]] if bgr2rgb else [chw[0], chw[1], chw[2]]
+    if any(a is not b for a, b in zip(cv2.split(img, planes), planes)):  # not split in place, e.g. unusual strides
+        np.copyto(chw, img.transpose(2, 0, 1)[::-1] if bgr2rgb else img.transpose(2, 0, 1))
+    if out.dtype.kind == 'f':  # in out's precision, float64 temporaries would cost 3x
+        if chw is not dst:
+            np.copyto(dst, chw, casting='unsafe')
+        if mean:
+            dst -= out.dtype.type(mean)
+        if scale is not None:
+            dst *= out.dtype.type(scale)
+    return ratio, pad
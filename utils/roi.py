@@ -0,0 +1,178 @@
+# Crop-based inference for small objects in large frames: the model runs on native resolution crops instead of on the
+# whole, downscaled frame. Two-stage ROI inference crops around the previous frame's detections (or those of a low
+# resolution pass), tiled inference covers the frame with overlapping tiles
+
+import math
+import os
+
+import numpy as np
+import torch
+import torchvision
+
+from utils.general import non_max_suppression, pose_nms
+from utils.preprocess import letterbox_into
+
+
+def roi_windows(boxes, shape, size=320, margin=0.25, max_windows=8):
+    # Crop windows (k, 4) [x0, y0, x1, y1] covering boxes (n, 4) xyxy of an image of shape (h, w). Boxes expanded by
+    # margin of their width and height are packed greedily, largest first, into size x size windows. A box larger
+    # than that gets a window of its own (downscaled to size later). More than max_windows windows, or windows
+    # summing to more than the image area, are replaced by one window enclosing all boxes, so crowded frames cost
+    # at most a single (downscaled) pass
+    h, w = shape[:2]
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    wh = boxes[:, 2:] - boxes[:, :2]
+    b = np.concatenate((boxes[:, :2] - margin * wh, boxes[:, 2:] + margin * wh), 1)
+    windows = []
+    for x in b[np.argsort(-wh.prod(1), kind='stable')]:
+        for win in windows:
+            u = np.concatenate((np.minimum(win[:2], x[:2]), np.maximum(win[2:], x[2:])))  # union
+            if (u[2:] - u[:2] <= size).all():
+                win[:] = u
+                break
+        else:
+            windows.append(x.copy())
+    area = sum(min(max(win[2] - win[0], size), w) * min(max(win[3] - win[1], size), h) for win in windows)
+    if len(windows) > max_windows or area > w * h:
+        windows = [np.concatenate((b[:, :2].min(0), b[:, 2:].max(0))).clip(0, (w, h, w, h))]
+
+    # Grow to size x size around the window center, shifted inside the image
+    out = np.zeros((len(windows), 4), dtype=np.int64)
+    for j, win in enumerate(windows):
+        for a, lim in (0, w), (1, h):
+            s = min(max(math.ceil(win[a + 2] - win[a]), size), lim)
+            out[j, a] = min(max(round((win[a] + win[a + 2] - s) / 2), 0), lim - s)
+            out[j, a + 2] = out[j, a] + s
+    return out
+
+
+def tile_windows(shape, size=640, overlap=0.2):
+    # Tiles (k, 4) [x0, y0, x1, y1] of size x size covering an image of shape (h, w), evenly spaced with at least
+    # overlap of size between neighbours and the last row and column flush with the image border
+    grid = []
+    for lim in shape[1], shape[0]:
+        s = min(size, lim)
+        n = math.ceil((lim - s) / max(s * (1 - overlap), 1)) + 1  # tiles along this axis
+        grid.append([(round(x), round(x) + s) for x in np.linspace(0, lim - s, n)])
+    return np.array([(x0, y0, x1, y1) for y0, y1 in grid[1] for x0, x1 in grid[0]], dtype=np.int64).reshape(-1, 4)
+
+
+def tile_batch_size(model, size=640, fraction=0.5, max_batch=64):
+    # Tiles per forward pass that fit into fraction of the free device (or system) memory. Activation memory per tile
+    # is measured as the summed output size of all layers in one size x size pass, an upper bound
+    p = next(model.parameters())
+    nbytes = []
+    hooks = [m.register_forward_hook(lambda m, x, y: nbytes.append(sum(t.numel() * t.element_size()
+             for t in (y if isinstance(y, (list, tuple)) else [y]) if isinstance(t, torch.Tensor))))
+             for m in model.model]
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, 3, size, size, device=p.device, dtype=p.dtype))
+    finally:
+        for h in hooks:
+            h.remove()
+    try:
+        free = torch.cuda.mem_get_info(p.device)[0] if p.device.type == 'cuda' else \
+            os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):  # no sysconf (Windows)
+        return min(8, max_batch)
+    return int(min(max(fraction * free // max(sum(nbytes), 1), 1), max_batch))
+
+
+class RoiDetector:
+    """Second stage of ROI inference
+
+    Crops each image around its given boxes (see roi_windows()), runs all crops of all images through model in
+    batches of up to max_batch size x size images at native resolution (larger crops are downscaled), maps the
+    detections back to image pixels and merges objects seen by overlapping windows with NMS
+    """
+
+    def __init__(self, model, size=320, margin=0.25, max_batch=16, conf_thres=0.25, iou_thres=0.45, classes=None,
+                 agnostic=False, nms='iou', max_det=300, max_windows=8):
+        m = model.model[-1]  # Detect()
+        self.model, self.p = model, next(model.parameters())  # for device and type
+        self.nc, self.nkpt = m.nc, m.nkpt or 0
+        self.size, self.margin, self.max_batch, self.max_windows = size, margin, max_batch, max_windows
+        self.conf_thres, self.iou_thres, self.classes, self.agnostic, self.nms, self.max_det = \
+            conf_thres, iou_thres, classes, agnostic, nms, max_det
+        self.images, self.crops, self.pixels, self.frame_pixels = 0, 0, 0, 0  # statistics
+
+    @torch.no_grad()
+    def __call__(self, im0s, boxes, bgr2rgb=True):
+        # im0s: list of HWC uint8 images, boxes: list of (n, 4) xyxy ROI boxes per image (None or empty for no ROI).
+        # Returns a list of (n, 6 + 3 * nkpt) detections [xyxy, conf, cls, kpts] per image in image pixels, on CPU
+        return self.detect(im0s, [roi_windows(b if b is not None else [], im.shape, self.size, self.margin,
+                                              self.max_windows) for im, b in zip(im0s, boxes)], bgr2rgb)
+
+    @torch.no_grad()
+    def detect(self, im0s, windows, bgr2rgb=True, merge=None):
+        # Detections in crop windows (list of (k, 4) [x0, y0, x1, y1] per image), merged with NMS mode merge
+        merge = merge or self.nms
+        crops = [(i, win) for i, ws in enumerate(windows) for win in ws]
+        self.images += len(im0s)
+        self.crops += len(crops)
+        self.frame_pixels += sum(im.shape[0] * im.shape[1] for im in im0s)
+
+        # Batched crops
+        x, bi = [torch.zeros((0, 6 + 3 * self.nkpt))], [torch.zeros(0, dtype=torch.long)]
+        for j in range(0, len(crops), self.max_batch):
+            chunk = crops[j:j + self.max_batch]
+            batch = np.empty((len(chunk), 3, self.size, self.size), dtype=np.uint8)
+            geometry = []
+            for k, (i, (x0, y0, x1, y1)) in enumerate(chunk):
+                ratio, pad = letterbox_into(im0s[i][y0:y1, x0:x1], batch[k], self.size, auto=False, scaleup=False,
+                                            bgr2rgb=bgr2rgb)
+                geometry.append((ratio[0], *pad, x0, y0, x1, y1))
+                self.pixels += (x1 - x0) * (y1 - y0)
+            img = torch.from_numpy(batch).to(self.p.device).type_as(self.p) / 255.0
+            pred = non_max_suppression(self.model(img)[0], self.conf_thres, self.iou_thres, classes=self.classes,
+                                       agnostic=self.agnostic, kpt_label=self.nkpt > 0, nkpt=self.nkpt, nms=self.nms)
+
+            # Crop to image pixels, x and y every 3 keypoint columns
+            for (i, _), (r, dw, dh, x0, y0, x1, y1), det in zip(chunk, geometry, pred):
+                det = det.float().cpu()
+                xs, ys = [0, 2, *range(6, det.shape[1], 3)], [1, 3, *range(7, det.shape[1], 3)]
+                det[:, xs] = ((det[:, xs] - dw) / r + x0).clamp(x0, x1)
+                det[:, ys] = ((det[:, ys] - dh) / r + y0).clamp(y0, y1)
+                x.append(det)
+                bi.append(torch.full((len(det),), i, dtype=torch.long))
+
+        # Merge duplicates from overlapping windows
+        x, bi = torch.cat(x), torch.cat(bi)
+        if merge == 'iou':
+            i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], bi if self.agnostic else bi * self.nc + x[:, 5].long(),
+                                            self.iou_thres)
+            x, bi = x[i], bi[i]
+        else:
+            x, bi = pose_nms(x, bi, len(im0s), self.iou_thres, self.conf_thres, merge, self.agnostic, self.nkpt)
+        return [x[bi == i][:self.max_det] for i in range(len(im0s))]  # sorted by decreasing conf
+
+    def summary(self):
+        return f'ROI inference: {self.crops / max(self.images, 1):.2f} crops of {self.size}x{self.size} per image, ' \
+               f'{self.pixels / max(self.frame_pixels, 1):.1%} of frame pixels at native resolution'
+
+
+class TiledDetector(RoiDetector):
+    """Tiled inference for frames too large to downscale
+
+    Covers each image with overlapping size x size tiles, runs all tiles of all images through the model at native
+    resolution in batches of max_batch (0 to fit the free memory, see tile_batch_size()), shifts the detections to
+    image pixels and merges objects seen by several tiles. The merge is keypoint aware by default: a partial
+    detection at a tile border shares its visible keypoints with the complete one of the neighbouring tile even when
+    their boxes overlap too little for IoU NMS
+    """
+
+    def __init__(self, model, size=640, overlap=0.2, max_batch=0, conf_thres=0.25, iou_thres=0.45, classes=None,
+                 agnostic=False, nms='iou', merge=None, max_det=300):
+        super().__init__(model, size, 0., max_batch or 1, conf_thres, iou_thres, classes, agnostic, nms, max_det)
+        self.overlap = overlap
+        self.merge = merge or ('oks' if self.nkpt else 'iou')
+        if not max_batch:
+            self.max_batch = tile_batch_size(model, size)
+
+    def __call__(self, im0s, bgr2rgb=True):
+        return self.detect(im0s, [tile_windows(im.shape, self.size, self.overlap) for im in im0s], bgr2rgb, self.merge)
+
+    def summary(self):
+        return f'Tiled inference: {self.crops / max(self.images, 1):.2f} tiles of {self.size}x{self.size} per image ' \
+               f'({self.overlap:.0%} overlap) in batches of {self.max_batch}, {self.merge} merge'
@@ -0,0 +1,148 @@
+# Keypoint-aware multi-object tracking for video: detections on keyframes, Kalman-propagated boxes and keypoints between
+
+import threading
+
+import torch
+
+from utils.general import box_iou
+from utils.metrics import kpt_sigmas
+
+
+def box_kpt_similarity(a, b, nkpt=7, iou_weight=0.5, kpt_thres=0.5):
+    # (n, m) similarity of detections a and b [xyxy, conf, cls, kpts]: iou_weight * box IoU + (1 - iou_weight) * OKS
+    # on the keypoints both see (conf > kpt_thres), box IoU alone for pairs without common keypoints
+    iou = box_iou(a[:, :4], b[:, :4])
+    if not nkpt or not len(a) or not len(b):
+        return iou
+    ka, kb = a[:, None, 6:].view(len(a), 1, nkpt, 3), b[None, :, 6:].view(1, len(b), nkpt, 3)
+    d = ((ka[..., :2] - kb[..., :2]) ** 2).sum(3)
+    v = (ka[..., 2] > kpt_thres) & (kb[..., 2] > kpt_thres)  # seen by both
+    area = ((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]))[:, None, None]
+    oks = (torch.exp(-d / (2 * (2 * kpt_sigmas(nkpt, a.device)) ** 2 * area + 1E-7)) * v).sum(2) / v.sum(2).clamp(min=1)
+    return torch.where(v.any(2), iou_weight * iou + (1 - iou_weight) * oks, iou)
+
+
+class Tracker:
+    """Multi-object tracker of one video source, with persistent track ids
+
+    Tracks are associated with keyframe detections by box IoU + keypoint OKS (Hungarian matching) and corrected by a
+    constant velocity Kalman filter on every box and keypoint coordinate. Between keyframes they are propagated by
+    the filter alone, with confidence decaying per frame. schedule() decides per frame whether the model has to run:
+    every interval frames, or sooner when a track's confidence drops below min_conf. It may run ahead of
+    update()/predict() (e.g. in an earlier pipeline stage), which must then be called once per frame in order
+    """
+
+    def __init__(self, nkpt=7, interval=5, min_conf=0.3, match_thres=0.3, iou_weight=0.5, max_age=30, decay=0.95):
+        self.nkpt, self.interval, self.min_conf, self.match_thres = nkpt, interval, min_conf, match_thres
+        self.iou_weight, self.max_age, self.decay = iou_weight, max_age, decay
+        self.lock = threading.Lock()
+        self.count, self.pending = interval, 0  # frames scheduled since the last keyframe, keyframes not yet applied
+        self.next_id = 0
+        self.frame = -1  # frames seen by update()/predict()
+
+        d = 4 + 2 * nkpt  # filtered coordinates: xyxy, keypoint xy
+        self.ids = torch.zeros(0, dtype=torch.long)
+        self.x, self.v = torch.zeros(0, d), torch.zeros(0, d)  # position, velocity
+        self.p00, self.p01, self.p11 = torch.zeros(0, d), torch.zeros(0, d), torch.zeros(0, d)  # covariance
+        self.conf, self.cls = torch.zeros(0), torch.zeros(0)
+        self.kconf = torch.zeros(0, nkpt)  # keypoint confidences of the last match
+        self.last = torch.zeros(0, dtype=torch.long)  # frame of the last match
+        self.key = -1  # last keyframe
+
+    def schedule(self):
+        # True if the next frame should be a keyframe, call once per frame
+        with self.lock:
+            low = self.pending == 0 and bool(len(self.conf)) and float(self.conf.min()) < self.min_conf
+            key = self.count + 1 >= self.interval or low
+            self.count = 0 if key else self.count + 1
+            self.pending += key
+            return key
+
+    def _noise(self):
+        # Process and measurement std per coordinate, relative to box height
+        h = (self.x[:, 3] - self.x[:, 1]).clamp(min=1)[:, None]
+        return h / 20, h / 160  # position, velocity
+
+    def _predict(self):
+        # Advance all tracks one frame
+        self.frame += 1
+        if len(self.x):
+            sp, sv = self._noise()
+            self.x += self.v
+            self.p00 += 2 * self.p01 + self.p11 + sp ** 2
+            self.p01 += self.p11
+            self.p11 += sv ** 2
+
+    def _out(self, i):
+        # Detections [xyxy, conf, cls, kpts] and ids of tracks i
+        kpt = torch.cat((self.x[i, 4:].view(len(i), self.nkpt, 2), self.kconf[i, :, None]), 2).view(len(i), 3 * self.nkpt)
+        return torch.cat((self.x[i, :4], self.conf[i, None], self.cls[i, None], kpt), 1), self.ids[i]
+
+    def update(self, det):
+        # Keyframe: propagate, associate det (n, 6 + 3 * nkpt) and correct. Returns tracked detections and ids
+        with self.lock:
+            self.pending -= 1
+        self._predict()
+        self.key = self.frame
+        det = det.float().cpu()
+        n = len(self.x)
+        ti, di = torch.zeros(0, dtype=torch.long), torch.zeros(0, dtype=torch.long)
+        if n and len(det):
+            from scipy.optimize import linear_sum_assignment
+            sim = box_kpt_similarity(self._out(torch.arange(n))[0], det, self.nkpt, self.iou_weight)
+            sim[self.cls[:, None] != det[None, :, 5]] = 0  # same class only
+            ti, di = (torch.as_tensor(x, dtype=torch.long) for x in linear_sum_assignment(sim.numpy(), maximize=True))
+            k = sim[ti, di] > self.match_thres
+            ti, di = ti[k], di[k]
+
+        # Correct matched tracks, keypoints only where seen
+        if len(ti):
+            sp, _ = self._noise()
+            z = torch.cat((det[di, :4], self._kpts(det[di])[..., :2].reshape(len(di), -1)), 1)
+            seen = torch.ones_like(z, dtype=torch.bool)
+            seen[:, 4:] = (self._kpts(det[di])[..., 2] > 0.5).repeat_interleave(2, 1)
+            p00, p01 = self.p00[ti], self.p01[ti]
+            s = p00 + sp[ti] ** 2
+            k0, k1 = p00 / s * seen, p01 / s * seen
+            y = z - self.x[ti]
+            self.x[ti] += k0 * y
+            self.v[ti] += k1 * y
+            self.p11[ti] -= k1 * p01
+            self.p00[ti], self.p01[ti] = (1 - k0) * p00, (1 - k0) * p01
+            self.conf[ti], self.kconf[ti] = det[di, 4], self._kpts(det[di])[..., 2]
+            self.last[ti] = self.frame
+
+        # New tracks from unmatched detections, drop tracks unmatched for max_age frames
+        new = torch.ones(len(det), dtype=torch.bool)
+        new[di] = False
+        m = int(new.sum())
+        if m:
+            d = det[new]
+            x = torch.cat((d[:, :4], self._kpts(d)[..., :2].reshape(m, -1)), 1)
+            h = (x[:, 3] - x[:, 1]).clamp(min=1)[:, None].expand_as(x)
+            self.ids = torch.cat((self.ids, torch.arange(self.next_id, self.next_id + m)))
+            self.next_id += m
+            self.x, self.v = torch.cat((self.x, x)), torch.cat((self.v, torch.zeros_like(x)))
+            self.p00 = torch.cat((self.p00, (h / 10) ** 2))
+            self.p01 = torch.cat((self.p01, torch.zeros_like(x)))
+            self.p11 = torch.cat((self.p11, (h / 16) ** 2))
+            self.conf, self.cls = torch.cat((self.conf, d[:, 4])), torch.cat((self.cls, d[:, 5]))
+            self.kconf = torch.cat((self.kconf, self._kpts(d)[..., 2]))
+            self.last = torch.cat((self.last, torch.full((m,), self.frame, dtype=torch.long)))
+        unmatched = self.last < self.frame
+        self.conf[unmatched] *= self.decay
+        self._keep(self.frame - self.last <= self.max_age)
+        return self._out(torch.where(self.last == self.frame)[0])
+
+    def predict(self):
+        # Frame between keyframes: propagate, returns the tracks seen on the last keyframe and their ids
+        self._predict()
+        self.conf *= self.decay
+        return self._out(torch.where(self.last == self.key)[0])
+
+    def _kpts(self, det):
+        return det[:, 6:].reshape(len(det), self.nkpt, 3)
+
+    def _keep(self, k):
+        for a in 'ids', 'x', 'v', 'p00', 'p01', 'p11', 'conf', 'cls', 'kconf', 'last':
+            setattr(self, a, getattr(self, a)[k])